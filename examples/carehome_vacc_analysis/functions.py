@@ -1,48 +1,52 @@
-from abc import ABC
 from copy import copy, deepcopy
 from numpy import (
-        append, arange, around, array, cumsum, log, ones, ones_like, where,
-        zeros, concatenate, vstack, identity, tile, hstack, prod, ix_, shape,
-        atleast_2d, diag)
-from numpy.linalg import eig
-from scipy.sparse import block_diag
+        arange, around, array, bincount, cumsum, log, ones, ones_like,
+        searchsorted, unique, where, zeros, concatenate, identity, tile,
+        hstack, prod, ix_, shape, atleast_2d, diag)
+from numpy import int64 as my_int
+from scipy.sparse import csc_matrix as sparse
 from scipy.special import binom as binom_coeff
 from scipy.stats import binom
 from pandas import read_excel, read_csv
 from tqdm import tqdm
-from model.common import (sparse, my_int, build_state_matrix, RateEquations)
+from model.common import RateEquations
 from model.imports import import_model_from_spec, NoImportModel
-from model.subsystems import (inf_events,
-    progression_events, stratified_progression_events, subsystem_key)
+from model.preprocessing import (
+    CombinedHouseholdPopulation, ModelInput, get_equilibrium_distribution,
+    spectral_radius)
+from model.subsystems import moved_states, subsystem_key
 
-class CHModelInput(ABC):
+class CHModelInput(ModelInput):
     def __init__(self,
                 spec,
                 composition_list,
                 composition_distribution,
                 header=None):
+        # We do not call super constructor as contact matrices come from the
+        # spec rather than from file.
         self.spec = deepcopy(spec)
 
         self.compartmental_structure = spec['compartmental_structure']
         self.inf_compartment_list = subsystem_key[self.compartmental_structure][2]
         self.no_inf_compartments = len(self.inf_compartment_list)
 
-        self.k_home = spec['within_ch_contact']
-        self.k_ext = spec['between_ch_contact']
+        self._set_derived_attributes()
+        self.k_home = self.unscaled_k_home
+        self.k_ext = self.unscaled_k_ext
 
         self.baseline_exit_rate = spec['baseline_exit_rate']
 
         self.density_expo = spec['density_expo']
         self.composition_list = composition_list
         self.composition_distribution = composition_distribution
-        self.ave_hh_size = \
-            composition_distribution.T.dot(
-            composition_list.sum(axis=1))                                # Average household size
-        self.dens_adj_ave_hh_size = \
-            composition_distribution.T.dot((
-            composition_list.sum(axis=1))**self.density_expo)                                # Average household size adjusted for density, needed to get internal transmission rate from secondary attack prob
-        self.ave_hh_by_class = composition_distribution.T.dot(composition_list)
+        self._set_household_statistics()
 
+    derived_parameters = ('within_ch_contact', 'between_ch_contact')
+    derived_attributes = ('unscaled_k_home', 'unscaled_k_ext')
+
+    def _set_derived_attributes(self):
+        self.unscaled_k_home = self.spec['within_ch_contact']
+        self.unscaled_k_ext = self.spec['between_ch_contact']
 
 
 class SEMCRDInput(CHModelInput):
@@ -50,31 +54,45 @@ class SEMCRDInput(CHModelInput):
         super().__init__(spec, composition_list, composition_distribution)
 
         self.sus = spec['sus']
-        self.inf_scales = [spec['mild_trans_scaling'],
-                ones(shape(spec['mild_trans_scaling']))]
 
         self.covid_mortality_prob = spec['covid_mortality_prob']
 
-        home_eig = max(eig(
+        self._rescale_contact_matrices()
+
+    rescaling_parameters = CHModelInput.rescaling_parameters + (
+        'sus', 'recovery_rate', 'critical_inf_prob', 'mild_trans_scaling',
+        'AR', 'R*')
+    derived_parameters = CHModelInput.derived_parameters + (
+        'mild_trans_scaling',)
+    derived_attributes = CHModelInput.derived_attributes + ('inf_scales',)
+
+    def _set_derived_attributes(self):
+        super()._set_derived_attributes()
+        self.inf_scales = [self.spec['mild_trans_scaling'],
+                ones(shape(self.spec['mild_trans_scaling']))]
+
+    def _rescale_contact_matrices(self):
+        spec = self.spec
+        home_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_home) * spec['critical_inf_prob'] + \
+             (self.unscaled_k_home) * spec['critical_inf_prob'] + \
             (1/spec['recovery_rate']) *
-            (self.k_home ) * (1-spec['critical_inf_prob']) *
+            (self.unscaled_k_home ) * (1-spec['critical_inf_prob']) *
             spec['mild_trans_scaling'])
-            )[0])
-        ext_eig = max(eig(
+            )
+        ext_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_ext) + \
+             (self.unscaled_k_ext) + \
             (1/spec['recovery_rate']) *
-            (self.k_ext ) * (1-spec['critical_inf_prob']) *
+            (self.unscaled_k_ext ) * (1-spec['critical_inf_prob']) *
             spec['mild_trans_scaling'])
-            )[0])
+            )
 
         R_int = - log(1 - spec['AR']) * self.dens_adj_ave_hh_size
 
-        self.k_home = R_int * self.k_home / home_eig
+        self.k_home = R_int * self.unscaled_k_home / home_eig
         external_scale = spec['R*']/(self.ave_hh_size*spec['AR'])
-        self.k_ext = external_scale * self.k_ext / ext_eig
+        self.k_ext = external_scale * self.unscaled_k_ext / ext_eig
 
     @property
     def alpha(self):
@@ -88,187 +106,10 @@ class SEMCRDInput(CHModelInput):
     def gamma(self):
         return self.spec['recovery_rate']
 
-def _semcrd_ch_subsystem(self, household_spec):
-    '''This function processes a composition to create subsystems i.e.
-    matrices and vectors describing all possible epdiemiological states
-    for a given household composition
-    Assuming frequency-dependent homogeneous within-household mixing
-    composition[i] is the number of individuals in age-class i inside the
-    household'''
-
-    s_comp, e_comp, m_comp, c_comp, r_comp, d_comp = range(6)
-
-    composition = household_spec.composition
-    matrix_shape = household_spec.matrix_shape
-    sus = self.model_input.sus
-    K_home = self.model_input.k_home
-    inf_scales = copy(self.model_input.inf_scales)
-    alpha = self.model_input.alpha
-    crit_prob = self.model_input.crit_prob
-    gamma = self.model_input.gamma
-    covid_mortality_prob = self.model_input.covid_mortality_prob
-    baseline_exit_rate = self.model_input.baseline_exit_rate
-    density_expo = self.model_input.density_expo
-
-    # Set of individuals actually present here
-    class_idx = household_spec.class_indexes
-
-    K_home = K_home[ix_(class_idx, class_idx)]
-    sus = sus[class_idx]
-    r_home = atleast_2d(diag(sus).dot(K_home))
-    crit_prob = crit_prob[class_idx]
-    for i in range(len(inf_scales)):
-        inf_scales[i] = inf_scales[i][class_idx]
-    covid_mortality_prob = covid_mortality_prob[class_idx]
-    baseline_exit_rate = baseline_exit_rate[class_idx]
-
-    states, \
-        reverse_prod, \
-        index_vector, \
-        rows = build_state_matrix(household_spec)
-
-    Q_int = sparse(household_spec.matrix_shape,)
-    inf_event_row = array([], dtype=my_int)
-    inf_event_col = array([], dtype=my_int)
-    inf_event_class = array([], dtype=my_int)
-
-    Q_int, inf_event_row, inf_event_col, inf_event_class = inf_events(s_comp,
-                e_comp,
-                [m_comp, c_comp],
-                inf_scales,
-                r_home,
-                density_expo,
-                6,
-                composition,
-                states,
-                index_vector,
-                reverse_prod,
-                class_idx,
-                matrix_shape,
-                Q_int,
-                inf_event_row,
-                inf_event_col,
-                inf_event_class)
-    Q_int = stratified_progression_events(e_comp,
-                    m_comp,
-                    alpha*(1-crit_prob),
-                    6,
-                    states,
-                    index_vector,
-                    reverse_prod,
-                    class_idx,
-                    matrix_shape,
-                    Q_int)
-    Q_int = stratified_progression_events(e_comp,
-                    c_comp,
-                    alpha*crit_prob,
-                    6,
-                    states,
-                    index_vector,
-                    reverse_prod,
-                    class_idx,
-                    matrix_shape,
-                    Q_int)
-    Q_int = progression_events(m_comp,
-                    r_comp,
-                    gamma,
-                    6,
-                    states,
-                    index_vector,
-                    reverse_prod,
-                    class_idx,
-                    matrix_shape,
-                    Q_int)
-    Q_int = stratified_progression_events(c_comp,
-                    r_comp,
-                    gamma*(1-covid_mortality_prob),
-                    6,
-                    states,
-                    index_vector,
-                    reverse_prod,
-                    class_idx,
-                    matrix_shape,
-                    Q_int)
-    Q_int = stratified_progression_events(c_comp,
-                    d_comp,
-                    gamma*covid_mortality_prob,
-                    6,
-                    states,
-                    index_vector,
-                    reverse_prod,
-                    class_idx,
-                    matrix_shape,
-                    Q_int)
-
-    # '''Now do the non-disease related exit (to D) events - we can just cycle
-    # over the numerical index of the compartments since all compartments progress
-    # identically. This cycle only goes to range 5 since we assume no D->D
-    # events.'''
-    # for i in range(5):
-    #     Q_int = stratified_progression_events(i,
-    #                     d_comp,
-    #                     baseline_exit_rate,
-    #                     6,
-    #                     states,
-    #                     index_vector,
-    #                     reverse_prod,
-    #                     class_idx,
-    #                     matrix_shape,
-    #                     Q_int)
-    #
-    # Q_int = stratified_progression_events(d_comp,
-    #                 s_comp,
-    #                 baseline_exit_rate,
-    #                 6,
-    #                 states,
-    #                 index_vector,
-    #                 reverse_prod,
-    #                 class_idx,
-    #                 matrix_shape,
-    #                 Q_int)
-
-    S = Q_int.sum(axis=1).getA().squeeze()
-    Q_int += sparse((
-        -S, (
-            arange(household_spec.total_size),
-            arange(household_spec.total_size)
-        )))
-    return tuple((
-        Q_int,
-        states,
-        array(inf_event_row, dtype=my_int, ndmin=1),
-        array(inf_event_col, dtype=my_int, ndmin=1),
-        array(inf_event_class, dtype=my_int, ndmin=1)))
-
 def combine_household_populations(hh_pop_list, weightings):
-    combined_pop = hh_pop_list[0]
-    combined_pop.composition_distribution = weightings[0] * \
-                                        combined_pop.composition_distribution
-    for i in range(1, len(hh_pop_list)):
-        hh_pop = hh_pop_list[i]
-        combined_pop.Q_int = block_diag((combined_pop.Q_int,hh_pop.Q_int))
-        combined_pop.which_composition =  append(combined_pop.which_composition,
-                                                hh_pop.which_composition)
-        combined_pop.inf_event_row = append(combined_pop.inf_event_row,
-                                            hh_pop.inf_event_row)
-        combined_pop.inf_event_col = append(combined_pop.inf_event_col,
-                                            hh_pop.inf_event_col)
-        combined_pop.inf_event_class = append(combined_pop.inf_event_class,
-                                            hh_pop.inf_event_class)
-        combined_pop.cum_sizes = append(combined_pop.cum_sizes,
-                                hh_pop.cum_sizes + combined_pop.cum_sizes[-1])
-        combined_pop.system_sizes = append(combined_pop.system_sizes,
-                                        hh_pop.system_sizes)
-        combined_pop.offsets = append(combined_pop.offsets,
-                                    hh_pop.offsets + combined_pop.offsets[-1])
-        combined_pop.states = vstack((combined_pop.states, hh_pop.states))
-        combined_pop.composition_list = vstack((combined_pop.composition_list,
-                                                hh_pop.composition_list))
-        combined_pop.composition_distribution = append(
-                        combined_pop.composition_distribution,
-                        weightings[i] * hh_pop.composition_distribution)
-
-    return combined_pop
+    '''Returns the populations in hh_pop_list combined with the given
+    weightings, leaving the populations themselves unchanged'''
+    return CombinedHouseholdPopulation(hh_pop_list, weightings)
 
 
 class SEMCRDRateEquations(RateEquations):
@@ -288,25 +129,140 @@ class SEMCRDRateEquations(RateEquations):
     def states_emp_only(self):
         return self.household_population.states[:, 5::self.no_compartments]
 
-'''Note that the following function isn't currently working!'''
-def initialise_carehome(household_population):
-    total_size = len(household_population.which_composition)
-    Q_int_aug = sparsevstack([household_population.Q_int, ones(total_size).T])
-    print(Q_int_aug.shape)
-
-    b = zeros(total_size+1)
-    b[total_size] = 1
-    x0 = zeros(total_size)
-    x0[0]=1
+class SEMCRDRateTemplate:
+    '''Stores every within-home event of a care home population, so that
+    Q_int for new rate parameters, e.g. at each point of a vaccine uptake
+    sweep, only needs its rates recomputing instead of its events rebuilding.
+    Events are enumerated with the same machinery as _semcrd_ch_subsystem,
+    including any whose rate is zero under the population's own input.'''
+    def __init__(self, household_population):
+        self.household_population = household_population
+        no_compartments = \
+            household_population.num_of_epidemiological_compartments
+        self.no_compartments = no_compartments
+        s_comp, e_comp, m_comp, c_comp, r_comp, d_comp = range(no_compartments)
+        # Infection comes first, followed by progression. Like
+        # _semcrd_ch_subsystem, there are no resident exit or replacement
+        # events.
+        self.transitions = [
+            (s_comp, e_comp),
+            (e_comp, m_comp),
+            (e_comp, c_comp),
+            (m_comp, r_comp),
+            (c_comp, r_comp),
+            (c_comp, d_comp)]
+
+        rows, cols, classes, kinds, counts = [], [], [], [], []
+        offsets = household_population.offsets
+        for i, composition in enumerate(household_population.composition_list):
+            class_idx = where(composition > 0)[0]
+            state_cols = (
+                no_compartments * class_idx.reshape(-1, 1)
+                + arange(no_compartments)).ravel()
+            states = household_population.states[
+                offsets[i]:offsets[i+1], state_cols].astype(my_int)
+            for kind, (from_comp, to_comp) in enumerate(self.transitions):
+                for j in range(len(class_idx)):
+                    from_present = where(
+                        states[:, no_compartments*j+from_comp] > 0)[0]
+                    rows.append(from_present + offsets[i])
+                    cols.append(moved_states(
+                        states,
+                        from_present,
+                        no_compartments*j + from_comp,
+                        no_compartments*j + to_comp,
+                        household_population.index_vector[i],
+                        household_population.reverse_prod[i]))
+                    classes.append(class_idx[j] * ones(
+                        len(from_present), dtype=my_int))
+                    kinds.append(kind * ones(len(from_present), dtype=my_int))
+                    counts.append(states[from_present, no_compartments*j+from_comp])
+        self.event_row = concatenate(rows)
+        self.event_col = concatenate(cols)
+        self.event_class = concatenate(classes)
+        self.event_kind = concatenate(kinds)
+        self.event_count = concatenate(counts)
+        self.infection = where(self.event_kind == 0)[0]
+
+        # Each event adds its rate to its entry of Q_int and subtracts it
+        # from the diagonal. We fix the sparsity pattern of Q_int here and
+        # keep a map from event rates to its stored values.
+        total_size = offsets[-1]
+        no_events = len(self.event_row)
+        entry_rows = concatenate((self.event_row, self.event_row))
+        entry_cols = concatenate((self.event_col, self.event_row))
+        keys = entry_cols * total_size + entry_rows
+        pattern = unique(keys)
+        self.indices = pattern % total_size
+        self.indptr = concatenate((
+            [0],
+            cumsum(bincount(pattern // total_size, minlength=total_size))))
+        self.assembly = sparse((
+            concatenate((ones(no_events), -ones(no_events))),
+            (searchsorted(pattern, keys), concatenate((
+                arange(no_events), arange(no_events))))),
+            shape=(len(pattern), no_events)).tocsr()
+        self.shape = (total_size, total_size)
+
+    def _transition_rates(self, model_input):
+        '''Returns the rate per individual of each progression event for each
+        class'''
+        alpha = model_input.alpha
+        gamma = model_input.gamma
+        crit_prob = model_input.crit_prob
+        mortality = model_input.covid_mortality_prob
+        return array([
+            zeros(len(crit_prob)),
+            alpha * (1 - crit_prob),
+            alpha * crit_prob,
+            gamma * ones(len(crit_prob)),
+            gamma * (1 - mortality),
+            gamma * mortality])
+
+    def event_rates(self, model_input):
+        '''Returns the rate of every event under model_input'''
+        rates = self._transition_rates(model_input)[
+            self.event_kind, self.event_class] * self.event_count
+
+        inf_rows = self.event_row[self.infection]
+        inf_classes = self.event_class[self.infection]
+        states = self.household_population.states[inf_rows]
+        composition = self.household_population.composition_by_state[inf_rows]
+        composition = where(composition > 0, composition, 1) \
+            ** model_input.density_expo
+        infs = zeros(composition.shape)
+        for ic, inf_comp in enumerate(model_input.inf_compartment_list):
+            infs += model_input.inf_scales[ic] * \
+                states[:, inf_comp::self.no_compartments] / composition
+        rates[self.infection] = self.event_count[self.infection] \
+            * model_input.sus[inf_classes] \
+            * (infs * model_input.k_home[inf_classes, :]).sum(axis=1)
+        return rates
+
+    def Q_int(self, model_input):
+        '''Returns the internal transition matrix under model_input'''
+        return sparse(
+            (self.assembly.dot(self.event_rates(model_input)),
+                self.indices,
+                self.indptr),
+            shape=self.shape)
+
+    def population(self, model_input):
+        '''Returns a view of the population with the rates of model_input,
+        sharing its states and event arrays'''
+        view = copy(self.household_population)
+        view.model_input = model_input
+        view.Q_int = self.Q_int(model_input)
+        return view
 
-    x, istop, itn, r1norm = lsqr(Q_int_aug,b,x0=x0)[:4] # Finds leading eigenvector of Q_int
-    H0 = x/sum(x)
-    print(max(H0),min(H0))
-    print(sum(H0))
 
+def initialise_carehome(household_population):
+    '''Returns the equilibrium distribution of care home states in the
+    absence of infection, so that we do not have to integrate the rate
+    equations for years to reach the empty bed equilibrium.'''
+    H0 = get_equilibrium_distribution(household_population)
     print('Initial infection is',H0.T.dot(household_population.states[:,2::6]))
-
-subsystem_key['carehome_SEMCRD'] = [_semcrd_ch_subsystem,6,[2,3]]
+    return H0
 
 THREE_CLASS_CH_EPI_SPEC = {
     'compartmental_structure': 'carehome_SEMCRD', # This is which subsystem key to use
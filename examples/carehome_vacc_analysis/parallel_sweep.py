@@ -1,12 +1,11 @@
 '''This sets up and runs a single solve of the care homes vaccine model'''
-from copy import deepcopy
 from argparse import ArgumentParser
 from numpy import array, hstack, ones, meshgrid, stack, zeros
 from time import time as get_time
 from scipy.integrate import solve_ivp
 from model.preprocessing import (
     HouseholdPopulation, make_initial_condition)
-from functions import THREE_CLASS_CH_EPI_SPEC, THREE_CLASS_CH_SPEC, SEMCRDInput, SEMCRDRateEquations, combine_household_populations, simple_initialisation
+from functions import THREE_CLASS_CH_EPI_SPEC, THREE_CLASS_CH_SPEC, SEMCRDInput, SEMCRDRateEquations, SEMCRDRateTemplate, combine_household_populations, simple_initialisation
 from model.imports import FixedImportModel, NoImportModel
 from pickle import dump
 from multiprocessing import Pool
@@ -27,13 +26,16 @@ composition_list = array(
 comp_dist = array([1.0])
 
 class DeathReductionComputation:
-    def __init__(self):
+    def __init__(self, i_scale):
         self.model_input = SEMCRDInput(SPEC, composition_list, comp_dist)
 
         self.baseline_population = HouseholdPopulation(
             composition_list, comp_dist, self.model_input)
+        # The composition is fixed across the sweep, so we enumerate the care
+        # home events once and only recompute their rates at each point
+        self.rate_template = SEMCRDRateTemplate(self.baseline_population)
 
-        self.import_array = import_array
+        self.import_array = i_scale*UNSCALED_IMPORT_ARRAY
         ''' Project baseline outbreak with no vaccination '''
 
         no_vacc_rhs = SEMCRDRateEquations(
@@ -102,56 +104,32 @@ class DeathReductionComputation:
     def _compute_death_reduction(self, p):
         '''Assume vaccinated staff and agency workers are split evenly
         across vaccinated and unvaccinated homes'''
-        model_input_unvacc = deepcopy(self.model_input)
-        model_input_unvacc.crit_prob[1] = \
-            (p[1] * (1-death_red) + (1-p[1])) \
-            * model_input_unvacc.crit_prob[1]
-        model_input_unvacc.inf_scales[0][1] = \
-            p[0] \
-            * model_input_unvacc.inf_scales[0][1]
-        model_input_unvacc.crit_prob[2] = \
-            (p[2] * (1-death_red) + (1-p[2])) \
-            * model_input_unvacc.crit_prob[2]
-        model_input_unvacc.inf_scales[0][2] = \
-            p[0] \
-            * model_input_unvacc.inf_scales[0][2]
-        model_input_unvacc.sus = array([1,
-                                        (1 - p[1]) + (1 - sus_red) * p[1] ,
-                                        (1 - p[2]) + (1 - sus_red) * p[2]]) * \
-                                model_input_unvacc.sus
-
-        model_input_vacc_P = deepcopy(self.model_input)
-        model_input_unvacc.crit_prob[0] = \
-            (1-death_red) \
-            * model_input_unvacc.crit_prob[0]
-        model_input_vacc_P.inf_scales[0][0] = \
-            p[0] \
-            * model_input_vacc_P.inf_scales[0][0]
-        model_input_vacc_P.crit_prob[1] = \
-            (p[1]  * (1-death_red) + (1-p[1])) \
-            * model_input_vacc_P.crit_prob[1]
-        model_input_vacc_P.inf_scales[0][1] = \
-            p[0] \
-            * model_input_vacc_P.inf_scales[0][1]
-        model_input_vacc_P.crit_prob[2] = \
-            (p[2]  * (1-death_red) + (1-p[2])) \
-            * model_input_vacc_P.crit_prob[2]
-        model_input_vacc_P.inf_scales[0][2] = \
-            p[0] \
-            * model_input_vacc_P.inf_scales[0][2]
-        model_input_vacc_P.sus = array([1-sus_red,
-                                        (1 - p[1]) + (1 - sus_red) * p[1] ,
-                                        (1 - p[2]) + (1 - sus_red) * p[2]]) * \
-                                model_input_vacc_P.sus
-
-        hh_pop_unvacc = HouseholdPopulation(
-            composition_list,
-            comp_dist,
-            model_input_unvacc)
-        hh_pop_P = HouseholdPopulation(
-            composition_list,
-            comp_dist,
-            model_input_vacc_P)
+        crit_prob = self.model_input.crit_prob
+        inf_scales = self.model_input.inf_scales
+        sus = self.model_input.sus
+        staff_death_scale = p[1] * (1-death_red) + (1-p[1])
+        agency_death_scale = p[2] * (1-death_red) + (1-p[2])
+        staff_sus_scale = (1 - p[1]) + (1 - sus_red) * p[1]
+        agency_sus_scale = (1 - p[2]) + (1 - sus_red) * p[2]
+
+        model_input_unvacc = self.model_input.with_updates(
+            rescale=False,
+            critical_inf_prob=array([
+                1, staff_death_scale, agency_death_scale]) * crit_prob,
+            inf_scales=[array([1, p[0], p[0]]) * inf_scales[0]]
+                + inf_scales[1:],
+            sus=array([1, staff_sus_scale, agency_sus_scale]) * sus)
+
+        model_input_vacc_P = self.model_input.with_updates(
+            rescale=False,
+            critical_inf_prob=array([
+                1-death_red, staff_death_scale, agency_death_scale])
+                * crit_prob,
+            inf_scales=[p[0] * inf_scales[0]] + inf_scales[1:],
+            sus=array([1-sus_red, staff_sus_scale, agency_sus_scale]) * sus)
+
+        hh_pop_unvacc = self.rate_template.population(model_input_unvacc)
+        hh_pop_P = self.rate_template.population(model_input_vacc_P)
 
         combined_pop = combine_household_populations(
             [hh_pop_unvacc, hh_pop_P],
@@ -196,9 +174,7 @@ class DeathReductionComputation:
 # H0 = hstack((solution.y[:,-1], solution.y[:,-1]))
 
 def main(i_scale, no_of_workers):
-    import_array = i_scale*UNSCALED_IMPORT_ARRAY
-
-    compute_death_reduction = DeathReductionComputation()
+    compute_death_reduction = DeathReductionComputation(i_scale)
     results = []
     inf_red_range = [0.7, 1.0]
     staff_uptake_range = [0.0, 0.2, 0.4, 0.6, 0.8, 1.0]
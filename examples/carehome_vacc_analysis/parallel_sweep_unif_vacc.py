@@ -1,5 +1,4 @@
 '''This sets up and runs a single solve of the care homes vaccine model'''
-from copy import deepcopy
 from argparse import ArgumentParser
 from numpy import array, hstack, ones, meshgrid, stack, zeros
 from time import time as get_time
@@ -115,29 +114,19 @@ class DeathReductionComputation:
         '''Assume vaccinated staff and agency workers are split evenly
         across vaccinated and unvaccinated homes'''
 
-        model_input_vacc = deepcopy(self.model_input)
-        model_input_vacc.crit_prob[0] = \
-            (PATIENT_UPTAKE*(1-death_red) + (1-PATIENT_UPTAKE)) \
-            * model_input_vacc.crit_prob[0]
-        model_input_vacc.inf_scales[0][0] = \
-            p[0] \
-            * model_input_vacc.inf_scales[0][0]
-        model_input_vacc.crit_prob[1] = \
-            (p[1]  * (1-death_red) + (1-p[1])) \
-            * model_input_vacc.crit_prob[1]
-        model_input_vacc.inf_scales[0][1] = \
-            p[0] \
-            * model_input_vacc.inf_scales[0][1]
-        model_input_vacc.crit_prob[2] = \
-            (p[2]  * (1-death_red) + (1-p[2])) \
-            * model_input_vacc.crit_prob[2]
-        model_input_vacc.inf_scales[0][2] = \
-            p[0] \
-            * model_input_vacc.inf_scales[0][2]
-        model_input_vacc.sus = array([1-sus_red,
-                                        (1 - p[1]) + (1 - sus_red) * p[1] ,
-                                        (1 - p[2]) + (1 - sus_red) * p[2]]) * \
-                                model_input_vacc.sus
+        model_input_vacc = self.model_input.with_updates(
+            rescale=False,
+            critical_inf_prob=array([
+                PATIENT_UPTAKE*(1-death_red) + (1-PATIENT_UPTAKE),
+                p[1]  * (1-death_red) + (1-p[1]),
+                p[2]  * (1-death_red) + (1-p[2])])
+                * self.model_input.crit_prob,
+            inf_scales=[p[0] * self.model_input.inf_scales[0]]
+                + self.model_input.inf_scales[1:],
+            sus=array([1-sus_red,
+                       (1 - p[1]) + (1 - sus_red) * p[1] ,
+                       (1 - p[2]) + (1 - sus_red) * p[2]])
+                * self.model_input.sus)
 
         hh_pop_vacc = HouseholdPopulation(
             self.model_input.composition_list,
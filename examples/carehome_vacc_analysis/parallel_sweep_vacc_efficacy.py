@@ -1,5 +1,4 @@
 '''This sets up and runs a single solve of the care homes vaccine model'''
-from copy import deepcopy
 from argparse import ArgumentParser
 from numpy import array, hstack, ones, meshgrid, stack, zeros
 from time import time as get_time
@@ -103,40 +102,28 @@ class DetermineCriticality:
         '''Assume vaccinated staff and agency workers are split evenly
         across vaccinated and unvaccinated homes'''
 
-        this_spec = deepcopy(SPEC)
-        this_spec['within_ch_contact'] = p[0]*this_spec['within_ch_contact']
+        within_ch_contact = p[0]*SPEC['within_ch_contact']
         for diag_id in range(3):
-            this_spec['within_ch_contact'][diag_id,diag_id] = 1
-
-        self.model_input = SEMCRDInput(
-            this_spec, scenario2composition[self.scenario], comp_dist)
-
-        model_input_vacc = deepcopy(self.model_input)
-        model_input_vacc.crit_prob[0] = \
-            ((1-PATIENT_UPTAKE)) \
-            * model_input_vacc.crit_prob[0]
-        model_input_vacc.inf_scales[0][0] = \
-            (1-p[1]) \
-            * model_input_vacc.inf_scales[0][0]
-        model_input_vacc.crit_prob[1] = \
-            ((1-STAFF_UPTAKE)) \
-            * model_input_vacc.crit_prob[1]
-        model_input_vacc.inf_scales[0][1] = \
-            (1-p[2]) \
-            * model_input_vacc.inf_scales[0][1]
-        model_input_vacc.crit_prob[2] = \
-            ((1-STAFF_UPTAKE)) \
-            * model_input_vacc.crit_prob[2]
-        model_input_vacc.inf_scales[0][2] = \
-            (1-p[2]) \
-            * model_input_vacc.inf_scales[0][2]
+            within_ch_contact[diag_id,diag_id] = 1
+
+        model_input = self.model_input.with_updates(
+            unscaled_k_home=within_ch_contact)
+
+        model_input_vacc = model_input.with_updates(
+            rescale=False,
+            critical_inf_prob=array([
+                1-PATIENT_UPTAKE, 1-STAFF_UPTAKE, 1-STAFF_UPTAKE])
+                * model_input.crit_prob,
+            inf_scales=[array([1-p[1], 1-p[2], 1-p[2]])
+                * model_input.inf_scales[0]]
+                + model_input.inf_scales[1:])
         # model_input_vacc.sus = array([(1-PATIENT_UPTAKE),
         #                                 (1 - STAFF_UPTAKE),
         #                                 (1 - STAFF_UPTAKE)]) * \
         #                         model_input_vacc.sus
 
         hh_pop_vacc = HouseholdPopulation(
-            self.model_input.composition_list,
+            model_input.composition_list,
             comp_dist,
             model_input_vacc)
 
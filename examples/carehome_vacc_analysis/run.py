@@ -3,9 +3,8 @@ from copy import copy
 from numpy import array, hstack, ones, vstack, zeros
 from time import time as get_time
 from scipy.integrate import solve_ivp
-from model.preprocessing import (
-    SEPIRInput, HouseholdPopulation, make_initial_condition)
-from functions import THREE_CLASS_CH_EPI_SPEC, THREE_CLASS_CH_SPEC, SEMCRDInput, SEMCRDRateEquations, combine_household_populations
+from model.preprocessing import SEPIRInput, HouseholdPopulation
+from functions import THREE_CLASS_CH_EPI_SPEC, THREE_CLASS_CH_SPEC, SEMCRDInput, SEMCRDRateEquations, combine_household_populations, initialise_carehome
 from model.common import SEPIRRateEquations
 from model.imports import FixedImportModel, NoImportModel
 from pickle import load, dump
@@ -28,20 +27,11 @@ model_input = SEMCRDInput(SPEC, composition_list, comp_dist)
 baseline_population = HouseholdPopulation(
     composition_list, comp_dist,model_input)
 
-'''We initialise the model by solving for 10 years with no infection to reach
-the equilibrium level of empty beds'''
+'''We initialise the model at the equilibrium level of empty beds, which we
+solve for directly rather than integrating for 10 years with no infection'''
 
-no_inf_rhs = SEMCRDRateEquations(
-    model_input,
-    baseline_population,
-    NoImportModel(6,2))
-
-no_inf_H0 = make_initial_condition(
-    baseline_population, no_inf_rhs, 0)
-
-tspan = (0.0, 10*365.0)
 initialise_start = get_time()
-solution = solve_ivp(no_inf_rhs, tspan, no_inf_H0, first_step=0.001)
+H0_no_vacc = initialise_carehome(baseline_population)
 initialise_end = get_time()
 
 print(
@@ -49,9 +39,9 @@ print(
     initialise_end-initialise_start,
     ' seconds.')
 
-H0 = hstack((solution.y[:,-1], solution.y[:,-1]))
+H0 = hstack((H0_no_vacc, H0_no_vacc))
 
-import_array = (1e-5)*ones(2)
+import_array = (1e-5)*ones(3)
 
 '''Now create populations with vaccine.'''
 
@@ -125,7 +115,7 @@ for i in range(len(patient_uptake_range)):
             rhs = SEMCRDRateEquations(
                 model_input,
                 combined_pop,
-                FixedImportModel(6,2,import_array))
+                FixedImportModel(6,3,import_array))
 
             tspan = (0.0, 365.0)
             solver_start = get_time()
@@ -0,0 +1,33 @@
+'''Checks of the care home rate templates against populations built from
+scratch'''
+from numpy import array
+from numpy.linalg import norm
+from model.preprocessing import HouseholdPopulation
+from examples.carehome_vacc_analysis.functions import (
+    THREE_CLASS_CH_EPI_SPEC, THREE_CLASS_CH_SPEC, SEMCRDInput,
+    SEMCRDRateTemplate)
+
+def test_care_home_rate_template():
+    '''Check template populations match care homes built from scratch'''
+    spec = {**THREE_CLASS_CH_EPI_SPEC, **THREE_CLASS_CH_SPEC}
+    composition_list = array([[2, 1, 1]])
+    composition_distribution = array([1.0])
+    model_input = SEMCRDInput(spec, composition_list, composition_distribution)
+    template = SEMCRDRateTemplate(HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False))
+
+    # One point of the vaccine uptake sweep in parallel_sweep.py
+    vaccinated_input = model_input.with_updates(
+        rescale=False,
+        critical_inf_prob=array([0.1, 0.46, 0.64]) * model_input.crit_prob,
+        inf_scales=[array([0.7, 0.7, 0.7]) * model_input.inf_scales[0]]
+            + model_input.inf_scales[1:],
+        sus=array([0.5, 0.8, 0.7]) * model_input.sus)
+    view = template.population(vaccinated_input)
+    rebuilt = HouseholdPopulation(
+        composition_list, composition_distribution, vaccinated_input, False)
+    assert norm((view.Q_int - rebuilt.Q_int).toarray()) < 1e-12
+    assert (view.states == rebuilt.states).all()
+    assert (view.inf_event_row == rebuilt.inf_event_row).all()
+    assert (view.inf_event_col == rebuilt.inf_event_col).all()
+    assert template.household_population.model_input is model_input
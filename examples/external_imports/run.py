@@ -3,7 +3,7 @@ impact of different import functions on execution time'''
 
 from os.path import isfile
 from pickle import load, dump
-from numpy import arange, array
+from numpy import arange, array, outer
 from numpy.random import rand
 from time import time as get_time
 from scipy.integrate import solve_ivp
@@ -41,12 +41,15 @@ external_prev = rand(no_days)
 detected_profile = array([0.1, 0.9])
 undetected_profile = array([0.9, 0.1])
 import_times = arange(no_days)
+# Each age class is infected at a rate proportional to the prevalence, with
+# detected and undetected cases both contributing
+import_rates = outer(detected_profile + undetected_profile, external_prev)
 
 step_import_model = StepImportModel(
+    2,
+    2,
     import_times,
-    external_prev,
-    detected_profile,
-    undetected_profile)
+    import_rates)
 
 step_import_rhs = RateEquations(
     model_input,
@@ -76,8 +79,9 @@ with open('simple-results.pkl', 'wb') as f:
     dump((time, H, D, U, model_input.coarse_bds), f)
 
 fixed_import_model = FixedImportModel(
-    step_import_model.detected(0.0),
-    step_import_model.undetected(0.0))
+    2,
+    2,
+    step_import_model.cases(0.0))
 
 fixed_rhs = RateEquations(
     model_input,
@@ -0,0 +1,85 @@
+''' Common utilities for long-term support bubble calculation.
+'''
+from numpy import (
+    arange, argsort, bincount, cumprod, hstack, repeat, sort, tile, unique,
+    vstack, where, zeros)
+
+
+class SupportBubbleCompositions:
+    '''This class holds the compositions which can result from a support
+    bubble policy, i.e. the observed compositions plus every composition formed
+    by an elligible household joining another household. Households with at
+    most max_adults adults are elligible to join a bubble; if max_adults is
+    None every household is treated as elligible, so that the composition set
+    covers any smaller max_adults. Compositions are matched through integer
+    codes, so the set is built in a single vectorised pass and the
+    distribution for any bubble_prob and max_adults is a weighted sum over the
+    stored pairings. The 2-age class structure with children in age class 0 and
+    adults in age class 1 is "hard-wired" into this class as we only use it for
+    this specific example.'''
+    def __init__(
+            self,
+            composition_list,
+            composition_distribution,
+            max_adults=None):
+        no_comps = composition_list.shape[0]
+        if max_adults is None:
+            elligible_comp_locs = arange(no_comps)
+        else:
+            elligible_comp_locs = where(
+                composition_list[:, 1] <= max_adults)[0]
+
+        # Every pairing of an elligible household with any household
+        self.pair_first = repeat(elligible_comp_locs, no_comps)
+        self.pair_second = tile(arange(no_comps), len(elligible_comp_locs))
+        bubbled_comps = composition_list[self.pair_first] + \
+            composition_list[self.pair_second]
+
+        all_comps = vstack((composition_list, bubbled_comps))
+        radix = cumprod(hstack(([1], all_comps.max(axis=0)[:-1] + 1)))
+        _, first_loc, comp_index = unique(
+            all_comps.dot(radix), return_index=True, return_inverse=True)
+        # Number compositions in order of first appearance, so the observed
+        # compositions keep their positions
+        order = zeros(len(first_loc), dtype=int)
+        order[argsort(first_loc)] = arange(len(first_loc))
+        comp_index = order[comp_index]
+
+        self.composition_list = all_comps[sort(first_loc)]
+        self.composition_distribution = composition_distribution
+        self.pair_index = comp_index[no_comps:]
+        self.pair_weight = composition_distribution[self.pair_first] * \
+            composition_distribution[self.pair_second]
+
+    def distribution(self, bubble_prob, max_adults):
+        '''Returns the distribution over self.composition_list when households
+        with at most max_adults adults join a bubble with probability
+        bubble_prob.'''
+        no_comps = len(self.composition_distribution)
+        elligible = where(
+            self.composition_list[:no_comps, 1] <= max_adults,
+            1 - bubble_prob,
+            1)
+        pair_elligible = \
+            self.composition_list[self.pair_first, 1] <= max_adults
+        mixed_comp_dist = bincount(
+            self.pair_index,
+            weights=bubble_prob * pair_elligible * self.pair_weight,
+            minlength=len(self.composition_list))
+        mixed_comp_dist[:no_comps] += elligible * self.composition_distribution
+        return mixed_comp_dist
+
+
+def build_support_bubbles(
+        composition_list,
+        composition_distribution,
+        max_adults,
+        bubble_prob):
+    '''This function returns the composition list and distribution which results
+    from a support bubble policy. max_adults specifies the maximum number of adults
+    which can be present in a household for that household to be
+    elligible to join a support bubble.'''
+    bubbles = SupportBubbleCompositions(
+        composition_list, composition_distribution, max_adults)
+    return bubbles.composition_list, bubbles.distribution(
+        bubble_prob, max_adults)
@@ -4,7 +4,7 @@ bubble policy where '''
 from os.path import isfile
 from pickle import load, dump
 from copy import deepcopy
-from numpy import append, arange, array, exp, vstack, log, sum, where
+from numpy import arange, array, exp, log, sum
 from numpy.linalg import eig
 from numpy.random import rand
 from pandas import read_csv
@@ -17,47 +17,7 @@ from model.preprocessing import (
 from model.specs import TWO_AGE_SEPIR_SPEC, TWO_AGE_UK_SPEC
 from model.common import SEPIRRateEquations
 from model.imports import NoImportModel
-
-def build_support_bubbles(
-        composition_list,
-        composition_distribution,
-        max_adults,
-        bubble_prob):
-    '''This function returns the composition list and distribution which results
-    from a support bubble policy. max_adults specifies the maximum number of adults
-    which can be present in a household for that household to be
-    elligible to join a support bubble. The 2-age class structure with
-    children in age class 0 and adults in age class 1 is "hard-wired" into this
-    function as we only use the function for this specific example.'''
-
-    no_comps = composition_list.shape[0]
-
-    elligible_comp_locs = where(composition_list[:,1]<=max_adults)[0]
-    no_elligible_comps = len(elligible_comp_locs)
-
-    mixed_comp_list = deepcopy(composition_list)
-    mixed_comp_dist = deepcopy(composition_distribution)
-
-    index = 0
-
-    for hh1 in elligible_comp_locs:
-        mixed_comp_dist[hh1] = (1-bubble_prob) * mixed_comp_dist[hh1]
-        for hh2 in range(no_comps):
-
-            bubbled_comp = composition_list[hh1,] + composition_list[hh2,]
-
-            if bubbled_comp.tolist() in mixed_comp_list.tolist():
-                bc_loc = where((mixed_comp_list==bubbled_comp).all(axis=1))
-                mixed_comp_dist[bc_loc] += bubble_prob * \
-                                          composition_distribution[hh1] * \
-                                          composition_distribution[hh2]
-            else:
-                mixed_comp_list = vstack((mixed_comp_list, bubbled_comp))
-                mixed_comp_dist = append(mixed_comp_dist, array([bubble_prob *
-                                       composition_distribution[hh1] *
-                                       composition_distribution[hh2]]))
-
-    return mixed_comp_list, mixed_comp_dist
+from examples.long_term_bubbles.common import SupportBubbleCompositions
 
 
 SPEC = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
@@ -74,11 +34,11 @@ comp_dist = read_csv(
 bubble_prob = 0.5
 max_adults = 1
 
-mixed_comp_list, mixed_comp_dist = build_support_bubbles(
-        composition_list,
-        comp_dist,
-        max_adults,
-        bubble_prob)
+# The composition set only depends on max_adults, so the bubbled population
+# can be reused for any bubble_prob by giving it a new distribution
+bubbles = SupportBubbleCompositions(composition_list, comp_dist, max_adults)
+mixed_comp_list = bubbles.composition_list
+mixed_comp_dist = bubbles.distribution(bubble_prob, max_adults)
 
 mixed_comp_dist = mixed_comp_dist/sum(mixed_comp_dist)
 
@@ -87,8 +47,9 @@ bubbled_model_input = SEPIRInput(SPEC, mixed_comp_list, mixed_comp_dist)
 bubbled_model_input.k_home = deepcopy(baseline_model_input.k_home)
 bubbled_model_input.k_ext = deepcopy(baseline_model_input.k_ext)
 
-if isfile('sb_vars.pkl') is True:
-    with open('sb_vars.pkl', 'rb') as f:
+population_file = 'sb_vars_max_adults_{0}.pkl'.format(max_adults)
+if isfile(population_file) is True:
+    with open(population_file, 'rb') as f:
         baseline_population, bubbled_population = load(f)
 else:
     # With the parameters chosen, we calculate Q_int:
@@ -96,8 +57,9 @@ else:
         composition_list, comp_dist, baseline_model_input)
     bubbled_population = HouseholdPopulation(
         mixed_comp_list, mixed_comp_dist, bubbled_model_input)
-    with open('sb_vars.pkl', 'wb') as f:
+    with open(population_file, 'wb') as f:
         dump((baseline_population, bubbled_population), f)
+bubbled_population = bubbled_population.with_distribution(mixed_comp_dist)
 
 bubbled_rhs = SEPIRRateEquations(bubbled_model_input, bubbled_population, NoImportModel(5,2))
 baseline_rhs = SEPIRRateEquations(baseline_model_input, baseline_population, NoImportModel(5,2))
@@ -0,0 +1,69 @@
+'''Checks of the support bubble compositions against the loop builder they
+replaced'''
+from numpy import append, array, vstack, where
+from numpy.testing import assert_almost_equal
+from pandas import read_csv
+from examples.long_term_bubbles.common import SupportBubbleCompositions
+
+COMPOSITION_LIST = read_csv(
+    'inputs/eng_and_wales_adult_child_composition_list.csv',
+    header=0).to_numpy()
+COMPOSITION_DISTRIBUTION = read_csv(
+    'inputs/eng_and_wales_adult_child_composition_dist.csv',
+    header=0).to_numpy().squeeze()
+
+def loop_support_bubbles(
+        composition_list,
+        composition_distribution,
+        max_adults,
+        bubble_prob):
+    '''Builds the bubbled compositions one pairing at a time. Elligible
+    compositions are scaled by (1 - bubble_prob) before any bubbled mass is
+    added; the original loop did this inside the pairing loop and so lost
+    mass which had already landed on them.'''
+    no_comps = composition_list.shape[0]
+    elligible_comp_locs = where(composition_list[:, 1] <= max_adults)[0]
+    mixed_comp_list = composition_list.copy()
+    mixed_comp_dist = composition_distribution.copy()
+    mixed_comp_dist[elligible_comp_locs] *= 1 - bubble_prob
+    for hh1 in elligible_comp_locs:
+        for hh2 in range(no_comps):
+            bubbled_comp = composition_list[hh1, ] + composition_list[hh2, ]
+            weight = bubble_prob * composition_distribution[hh1] * \
+                composition_distribution[hh2]
+            if bubbled_comp.tolist() in mixed_comp_list.tolist():
+                bc_loc = where((mixed_comp_list == bubbled_comp).all(axis=1))
+                mixed_comp_dist[bc_loc] += weight
+            else:
+                mixed_comp_list = vstack((mixed_comp_list, bubbled_comp))
+                mixed_comp_dist = append(mixed_comp_dist, array([weight]))
+    return mixed_comp_list, mixed_comp_dist
+
+def test_support_bubble_distribution():
+    '''Check bubbled distributions sum to one and match the loop builder,
+    both for a composition set built for the policy and for one built to
+    cover every policy'''
+    full_bubbles = SupportBubbleCompositions(
+        COMPOSITION_LIST, COMPOSITION_DISTRIBUTION)
+    for max_adults in [1, 2]:
+        bubbles = SupportBubbleCompositions(
+            COMPOSITION_LIST, COMPOSITION_DISTRIBUTION, max_adults)
+        for bubble_prob in [0.0, 0.3, 1.0]:
+            comp_list, comp_dist = loop_support_bubbles(
+                COMPOSITION_LIST,
+                COMPOSITION_DISTRIBUTION,
+                max_adults,
+                bubble_prob)
+            mixed_comp_dist = bubbles.distribution(bubble_prob, max_adults)
+            assert (bubbles.composition_list == comp_list).all()
+            assert_almost_equal(mixed_comp_dist, comp_dist)
+            assert_almost_equal(mixed_comp_dist.sum(), 1.0)
+
+            full_dist = full_bubbles.distribution(bubble_prob, max_adults)
+            assert_almost_equal(full_dist.sum(), 1.0)
+            for comp, prob in zip(full_bubbles.composition_list, full_dist):
+                loc = where((comp_list == comp).all(axis=1))[0]
+                if len(loc) == 0:
+                    assert prob == 0
+                else:
+                    assert_almost_equal(prob, comp_dist[loc[0]])
@@ -4,13 +4,13 @@ from numpy import (
     ones, prod, shape, sum, hstack, unique, where, zeros)
 from numpy import int64 as my_int
 from numpy import exp, log
-from numpy.linalg import eig
-from pandas import read_csv
 import pdb
 from scipy.sparse import csc_matrix as sparse
 from scipy.special import factorial
 from scipy.stats import multinomial
-from model.preprocessing import aggregate_contact_matrix, ModelInput
+from model.preprocessing import (
+    aggregate_contact_matrix, read_pop_pyramid, spectral_radius,
+    ModelInput)
 from model.common import build_state_matrix, build_external_import_matrix_SEPIRQ
 from model.imports import NoImportModel
 
@@ -51,11 +51,7 @@ class SEPIRInput(ModelInput):
         fine_bds = arange(0, 81, 5)
         self.coarse_bds = array([0, 20])
 
-        # pop_pyramid = read_csv(
-        #     'inputs/United Kingdom-2019.csv', index_col=0)
-        pop_pyramid = read_csv(
-            spec['pop_pyramid_file_name'], index_col=0)
-        pop_pyramid = (pop_pyramid['F'] + pop_pyramid['M']).to_numpy()
+        pop_pyramid = read_pop_pyramid(spec['pop_pyramid_file_name'])
 
         self.k_home = aggregate_contact_matrix(
             self.k_home, fine_bds, self.coarse_bds, pop_pyramid)
@@ -65,52 +61,52 @@ class SEPIRInput(ModelInput):
         self.tau = spec['prodromal_trans_scaling']
         self.sus = spec['sus']
 
-        home_eig = max(eig(
+        home_eig = spectral_radius(
 
             self.sus * ((1/spec['recovery_rate']) *
              (self.k_home) + \
             (1/spec['symp_onset_rate']) *
             (self.k_home ) * self.tau)
 
-            )[0])
-        ext_eig = max(eig(
+            )
+        ext_eig = spectral_radius(
 
             self.sus * ((1/spec['recovery_rate']) *
              (self.k_ext) + \
             (1/spec['symp_onset_rate']) *
             (self.k_ext ) * self.tau)
 
-            )[0])
+            )
 
         R_int = - log(1 - spec['AR'])
 
         self.k_home = R_int * self.k_home / home_eig
-        print('Internal eigenvalue is',max(eig(
+        print('Internal eigenvalue is',spectral_radius(
 
             self.sus * ((1/spec['recovery_rate']) *
              (self.k_home) + \
             (1/spec['symp_onset_rate']) *
             (self.k_home ) * self.tau)
 
-            )[0]))
+            ))
         external_scale = min((spec['R*']/(2.3*spec['AR'])),2-R_int)
         self.k_ext = external_scale * self.k_ext / ext_eig
-        print('External eigenvalue is',max(eig(
+        print('External eigenvalue is',spectral_radius(
 
             self.sus * ((1/spec['recovery_rate']) *
              (self.k_ext) + \
             (1/spec['symp_onset_rate']) *
             (self.k_ext ) * self.tau)
 
-            )[0]))
-        print('Estimated R* is',2.3*spec['AR']*max(eig(
+            ))
+        print('Estimated R* is',2.3*spec['AR']*spectral_radius(
 
             self.sus * ((1/spec['recovery_rate']) *
              (self.k_ext) + \
             (1/spec['symp_onset_rate']) *
             (self.k_ext ) * self.tau)
 
-            )[0]))
+            ))
         self.density_expo = spec['density_expo']
         self.import_model = NoImportModel()
 
@@ -4,7 +4,6 @@ between-household transmission by doing a 2D parameter sweep'''
 from argparse import ArgumentParser
 from os.path import isfile
 from pickle import load, dump
-from copy import deepcopy
 from multiprocessing import Pool
 from numpy import arange, array, exp, log, sum
 from numpy.linalg import eig
@@ -44,6 +43,8 @@ AR=1.0 # Starting attack ratio - visited households are fully recovered
 class MixingAnalysis:
     def __init__(self):
         self.basic_spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+        self.model_input = SEPIRInput(
+            self.basic_spec, composition_list, comp_dist)
 
     def __call__(self, p):
         try:
@@ -55,11 +56,10 @@ class MixingAnalysis:
         return result
 
     def _implement_mixing(self, p):
-        this_spec = deepcopy(self.basic_spec)
-        this_spec['AR'] = p[0]
-        model_input = SEPIRInput(this_spec, composition_list, comp_dist)
-        model_input.k_home = (1 - p[1]) * model_input.k_home
-        model_input.k_ext = (1 - p[2]) * model_input.k_ext
+        model_input = self.model_input.with_updates(AR=p[0])
+        model_input = model_input.with_updates(
+            k_home=(1 - p[1]) * model_input.k_home,
+            k_ext=(1 - p[2]) * model_input.k_ext)
 
         household_population = HouseholdPopulation(
             composition_list, comp_dist, model_input)
@@ -3,7 +3,6 @@ between-household transmission by doing a 2D parameter sweep'''
 
 from os.path import isfile
 from pickle import load, dump
-from copy import deepcopy
 from numpy import arange, array, exp, log, sum
 from numpy.linalg import eig
 from numpy.random import rand
@@ -54,12 +53,13 @@ AR_len = len(AR_range)
 internal_mix_len = len(internal_mix_range)
 external_mix_len = len(external_mix_range)
 
+base_input = SEPIRInput(basic_spec, composition_list, comp_dist)
+
 for i in range(AR_len):
 
     filename_stem_i = 'mix_sweep_results_AR' + str(AR_range[i])
 
-    spec = deepcopy(basic_spec)
-    spec['AR'] = AR_range[i]
+    AR_input = base_input.with_updates(AR=AR_range[i])
 
     for j in range(internal_mix_len):
 
@@ -71,9 +71,9 @@ for i in range(AR_len):
 
             iter_start = get_time()
 
-            model_input = SEPIRInput(spec, composition_list, comp_dist)
-            model_input.k_home = (1-internal_mix_range[j]) * model_input.k_home
-            model_input.k_ext = (1-external_mix_range[k]) * model_input.k_ext
+            model_input = AR_input.with_updates(
+                k_home=(1-internal_mix_range[j]) * AR_input.k_home,
+                k_ext=(1-external_mix_range[k]) * AR_input.k_ext)
 
             household_population = HouseholdPopulation(
                 composition_list, comp_dist, model_input)
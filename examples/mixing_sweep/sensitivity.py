@@ -0,0 +1,84 @@
+''' In this script we compute local derivatives of peak prevalence and
+final size with respect to within- and between-household transmission, as a
+cheap complement to the 2D parameter sweep in run.py. Each attack ratio
+takes one solve of the rate equations augmented with sensitivities instead
+of a solve per point of the sweep.'''
+
+from pickle import dump
+from numpy import arange, array
+from pandas import read_csv
+from time import time as get_time
+from scipy.integrate import solve_ivp
+from model.preprocessing import (
+        SEPIRInput, HouseholdPopulation, make_initial_condition_with_recovereds)
+from model.specs import TWO_AGE_SEPIR_SPEC, TWO_AGE_UK_SPEC
+from model.common import SEPIRRateEquations, SensitivityEquations
+from model.imports import FixedImportModel
+
+IMPORT_ARRAY = array([1e-5, 1e-5])
+PARAMETERS = ['k_home', 'k_ext']
+
+basic_spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+# List of observed household compositions
+composition_list = read_csv(
+    'inputs/eng_and_wales_adult_child_composition_list.csv',
+    header=0).to_numpy()
+# Proportion of households which are in each composition
+comp_dist = read_csv(
+    'inputs/eng_and_wales_adult_child_composition_dist.csv',
+    header=0).to_numpy().squeeze()
+
+prev=1.0e-2 # Starting prevalence
+antibody_prev=0 # Starting antibody prev/immunity
+AR=1.0 # Starting attack ratio - visited households are fully recovered
+
+AR_range = array([0.3, 0.45, 0.6])
+
+base_input = SEPIRInput(basic_spec, composition_list, comp_dist)
+
+results = {}
+for AR_val in AR_range:
+    iter_start = get_time()
+
+    model_input = base_input.with_updates(AR=AR_val)
+    household_population = HouseholdPopulation(
+        composition_list, comp_dist, model_input)
+    rhs = SEPIRRateEquations(
+        model_input, household_population, FixedImportModel(6, 2, IMPORT_ARRAY))
+    sensitivities = SensitivityEquations(rhs, PARAMETERS)
+
+    H0 = make_initial_condition_with_recovereds(
+        household_population, rhs, prev, antibody_prev, AR)
+
+    no_days = 365
+    tspan = (0.0, no_days)
+    solution = solve_ivp(
+        sensitivities,
+        tspan,
+        sensitivities.initial_condition(H0),
+        first_step=0.001,
+        atol=1e-16,
+        t_eval=arange(0.0, no_days, 0.25))
+
+    ave_hh_size = household_population.ave_hh_size
+    I = household_population.states[:, 3::5].sum(axis=1) / ave_hh_size
+    R = household_population.states[:, 4::5].sum(axis=1) / ave_hh_size
+
+    # Derivatives are with respect to the log of each contact matrix scaling,
+    # so a 10% reduction in that mixing changes the outcome by about 0.1 times
+    # minus the derivative
+    peak_I, d_peak_I = sensitivities.peak_sensitivities(
+        solution.t, solution.y, I)
+    final_R, d_final_R = sensitivities.outcome_sensitivities(
+        solution.y[:, -1], R)
+    results[AR_val] = (peak_I, d_peak_I, final_R, d_final_R)
+    iter_end = get_time()
+
+    print('AR', AR_val, 'took', iter_end - iter_start, 'seconds.')
+    for parameter, d_peak, d_final in zip(PARAMETERS, d_peak_I, d_final_R):
+        print(
+            '    d(peak prevalence)/dlog', parameter, '=', d_peak,
+            ', d(final size)/dlog', parameter, '=', d_final)
+
+with open('mix_sweep_sensitivities.pkl', 'wb') as f:
+    dump((PARAMETERS, results), f)
@@ -1,17 +1,24 @@
 ''' Common utilities for transient bubble calculation.
 '''
+from hashlib import sha1
+from os import makedirs
+from os.path import isfile, join
+from pickle import load, dump
+from itertools import combinations_with_replacement
 from numpy import (
-    append, arange, around, array, atleast_2d, concatenate, copy,
-    diag, hstack, isnan, ix_,
-    ones, prod, shape, sum, unique, where, zeros, exp, log, repeat)
+    append, arange, argsort, around, array, atleast_2d, bincount,
+    concatenate, copy, cumprod, cumsum, diag, errstate, hstack, indices, isnan,
+    ix_, minimum, moveaxis, multiply, ones, prod, searchsorted, shape, sort,
+    sum, unique, vstack, where, zeros, exp, log, repeat)
 from numpy import int64 as my_int
 from scipy.sparse import csc_matrix as sparse
-from scipy.special import factorial
+from scipy.special import factorial, gammaln
 from scipy.stats import multinomial
 from model.preprocessing import ModelInput, HouseholdPopulation, SEIRInput
 from model.common import (
         build_state_matrix, build_external_import_matrix_SEPIRQ)
 from model.imports import NoImportModel
+from model.subsystems import subsystem_key
 
 
 def build_mixed_compositions_pairwise(
@@ -141,27 +148,13 @@ def pairwise_merged_initial_condition(H_unmerged,
                             hh_dimension,
                             pairings,
                             no_compartments=5):
-    H0_len = sum(merged_population.system_sizes)
-    H0 = zeros((H0_len,))
-    reverse_prod = unmerged_population.reverse_prod
-    index_vector_list = unmerged_population.index_vector
-    which_composition = merged_population.which_composition
-    merged_states = merged_population.states
-
-    for i in range(H0_len):
-        comp_0 = pairings[0][which_composition[i]]
-        comp_1 = pairings[1][which_composition[i]]
-        state_0 = merged_states[i, :no_compartments]
-        state_1 = merged_states[i, no_compartments:]
-        index_vector_0 = index_vector_list[comp_0]
-        index_vector_1 = index_vector_list[comp_1]
-        index_0 = index_vector_0[
-            state_0.dot(reverse_prod[comp_0]) + state_0[-1], 0]
-        index_1 = index_vector_1[
-            state_1.dot(reverse_prod[comp_1]) + state_1[-1], 0]
-        H0[i] = H_unmerged[index_0] * H_unmerged[index_1]
-
-    return H0
+    state_match = match_merged_states_to_unmerged(
+        unmerged_population,
+        merged_population,
+        array(pairings).T,
+        2,
+        no_compartments)
+    return prod(H_unmerged[state_match], axis=1)
 
 
 def initialise_merged_system_threewise(
@@ -169,25 +162,21 @@ def initialise_merged_system_threewise(
         unmerged_population,
         merged_population,
         state_match):
+    return composition_merge_weights(
+        unmerged_population, merged_population, state_match) \
+        * prod(H0_unmerged[state_match], axis=1)
 
+
+def composition_merge_weights(
+        unmerged_population, merged_population, state_match):
+    '''Ratio of the probability of each merged composition to the product
+    of the probabilities of the unmerged compositions it is made from,
+    evaluated at every merged state.'''
     wc_um = unmerged_population.which_composition
     wc_m = merged_population.which_composition
     cd_um = unmerged_population.composition_distribution
     cd_m = merged_population.composition_distribution
-    no_merged_states = len(wc_m)
-    H0_merged = zeros((no_merged_states,))
-    for state_no in range(no_merged_states):
-        this_H0_merged = \
-            cd_m[wc_m[state_no]] \
-            * prod(H0_unmerged[state_match[state_no, :]]) \
-            / prod(cd_um[wc_um[state_match[state_no, :]]])
-        # for hh in range(3):
-        #     this_H0_merged = this_H0_merged * \
-        #                         H0_unmerged[state_match[state_no, hh]] / \
-        #                         cd_um[wc_um[state_match[state_no, hh]]]
-        H0_merged[state_no] = this_H0_merged
-
-    return H0_merged
+    return cd_m[wc_m] / prod(cd_um[wc_um[state_match]], axis=1)
 
 
 def pairwise_demerged_initial_condition(
@@ -197,28 +186,12 @@ def pairwise_demerged_initial_condition(
         hh_dimension,
         pairings,
         no_compartments=5):
-    H0_len = sum(unmerged_population.system_sizes)
-    H0 = zeros((H0_len,))
-    reverse_prod = unmerged_population.reverse_prod
-    index_vector_list = unmerged_population.index_vector
-    which_composition = merged_population.which_composition
-    merged_states = merged_population.states
-
-    for i in range(len(H_merged)):
-        comp_0 = pairings[0][which_composition[i]]
-        comp_1 = pairings[1][which_composition[i]]
-        state_0 = merged_states[i, :no_compartments]
-        state_1 = merged_states[i, no_compartments:]
-        index_vector_0 = index_vector_list[comp_0]
-        index_vector_1 = index_vector_list[comp_1]
-        index_0 = index_vector_0[
-            state_0.dot(reverse_prod[comp_0]) + state_0[-1], 0]
-        index_1 = index_vector_1[
-            state_1.dot(reverse_prod[comp_1]) + state_1[-1], 0]
-        H0[index_0] += 0.5*H_merged[i]
-        H0[index_1] += 0.5*H_merged[i]
-
-    return H0
+    return MergeMap(
+        unmerged_population,
+        merged_population,
+        array(pairings).T,
+        2,
+        no_compartments).demerge(H_merged)
 
 
 def build_mixed_compositions(
@@ -226,6 +199,12 @@ def build_mixed_compositions(
         composition_distribution,
         no_hh=2,
         max_size=12):
+    '''Builds the compositions of bubbles formed by merging no_hh households.
+    Each merged composition is a multiset of unmerged compositions, listed by
+    composition index in pairings, with multinomial probability. Merges with
+    more than max_size members are folded into the merged composition
+    obtained by repeatedly removing an individual from the largest entry, and
+    comp_scaler records how much this inflates each remaining probability.'''
 
     no_comps = composition_list.shape[0]
 
@@ -233,97 +212,86 @@ def build_mixed_compositions(
         hh_dimension = 1
     else:
         hh_dimension = composition_list.shape[1]
-
-    no_mixed_comps = 0
-
-    mixed_comp_list = []
-    mixed_comp_dist = []
-
-    hhi = no_hh*[0]
-    pairings = []
-    for pairing_index in range(no_hh):
-        pairings.append([])
-    coeff = [] # This stores number of appearances each combination would make in a "full" merged list
-
-    def comp_iterator(depth, no_hh):
-        if depth < no_hh:
-            for i in range(hhi[depth-1], no_comps):
-                hhi[depth] = i
-                comp_iterator(depth+1, no_hh)
-        else:
-            index = 0
-            for hh in range(no_hh):
-                index +=  hhi[hh] * no_comps**(no_hh - 1 - hh)
-                pairings[hh].append(hhi[hh])
-            this_mix_comp = zeros((no_hh*hh_dimension,))
-            hist = zeros((no_comps,))
-            for hh in range(no_hh):
-                this_mix_comp[hh*hh_dimension:(hh+1)*hh_dimension] = \
-                 composition_list[hhi[hh], ]  # TODO: What happens after the comma?
-                hist[hhi[hh]] += 1
-            this_mix_prob = multinomial.pmf(
-                hist, n=no_hh, p=composition_distribution)
-            mixed_comp_list.append(this_mix_comp)
-            mixed_comp_dist.append(this_mix_prob)
-            coeff.append(factorial(no_hh)/prod(factorial(hist)))
-
-    comp_iterator(0, no_hh)
-    mixed_comp_list = array(mixed_comp_list, dtype=my_int)
-    mixed_comp_dist = array(mixed_comp_dist)
-    coeff = array(coeff)
-    pairings = array(pairings).T
-    print(
-        'Before checking for big households, sum(dist)=',
-        sum(mixed_comp_dist))
-
-    reverse_prod = hstack(([0], no_comps**arange(1, no_hh)))
-    no_mixed_comps = len(mixed_comp_dist)
-    rows = [
-        mixed_comp_list[k, :].dot(reverse_prod) + mixed_comp_list[k, 0]
-        for k in range(no_mixed_comps)]
-    mixed_comp_index_vector = sparse((
-        arange(no_mixed_comps),
-        (rows, [0]*no_mixed_comps)), dtype=my_int)
+    composition_list = composition_list.reshape(no_comps, hh_dimension)
+
+    # Rows are in lexicographic order, so their codes in base no_comps with
+    # the first household most significant are increasing
+    pairings = array(
+        list(combinations_with_replacement(range(no_comps), no_hh)),
+        dtype=my_int).reshape(-1, no_hh)
+    pairing_radix = no_comps ** arange(no_hh - 1, -1, -1)
+    pairing_codes = pairings.dot(pairing_radix)
+    no_mixed_comps = len(pairings)
+    mixed_comp_list = composition_list[pairings].reshape(
+        no_mixed_comps, no_hh * hh_dimension)
+
+    # The product over households of their rank among identical households
+    # in the same bubble is the product of factorials of the multiplicities
+    log_multiplicity_factorials = zeros((no_mixed_comps,))
+    for hh in range(1, no_hh):
+        rank = 1 + sum(pairings[:, :hh] == pairings[:, [hh]], axis=1)
+        log_multiplicity_factorials += log(rank)
+    log_coeff = gammaln(no_hh + 1) - log_multiplicity_factorials
+    with errstate(divide='ignore'):
+        log_comp_dist = log(composition_distribution)
+    mixed_comp_dist = exp(log_coeff + log_comp_dist[pairings].sum(axis=1))
+    coeff = around(exp(log_coeff)) # This stores number of appearances each combination would make in a "full" merged list
 
     mixed_sizes = mixed_comp_list.sum(axis=1)
     large_merges = where(mixed_sizes > max_size)[0]
 
-    ref_dist = deepcopy(mixed_comp_dist)
-
-    for merge_no in large_merges:
-        this_prob = mixed_comp_dist[merge_no]
-        this_comp = mixed_comp_list[merge_no, :]
-        current_size = mixed_sizes[merge_no]
-        while current_size > max_size:
-            this_comp[this_comp.argmax()] -= 1
-            current_size -= 1
-        new_comp_loc = mixed_comp_index_vector[
-            this_comp.dot(reverse_prod) + this_comp[0], 0]
-        mixed_comp_dist[new_comp_loc] += this_prob
-
-    print(
-        'After checking for big households, sum(dist)=',
-        sum(mixed_comp_dist))
+    folded_comps = mixed_comp_list[large_merges]
+    excess = mixed_sizes[large_merges] - max_size
+    while (excess > 0).any():
+        still_large = where(excess > 0)[0]
+        largest_entry = folded_comps[still_large].argmax(axis=1)
+        folded_comps[still_large, largest_entry] -= 1
+        excess[still_large] -= 1
+
+    # Identify each folded household with its unmerged composition, sort the
+    # households of each bubble and look the bubble up by its code
+    comp_radix = cumprod(hstack(([1], composition_list.max(axis=0)[:-1] + 1)))
+    comp_codes = composition_list.dot(comp_radix)
+    comp_order = argsort(comp_codes)
+    folded_codes = folded_comps.reshape(-1, hh_dimension).dot(comp_radix)
+    folded_locs = comp_order[minimum(
+        searchsorted(comp_codes[comp_order], folded_codes), no_comps - 1)]
+    if (comp_codes[folded_locs] != folded_codes).any():
+        raise ValueError(
+            'Folding merges larger than {0} produces household compositions '
+            'which are not in composition_list'.format(max_size))
+    folded_pairings = sort(folded_locs.reshape(-1, no_hh), axis=1)
+    new_comp_locs = searchsorted(
+        pairing_codes, folded_pairings.dot(pairing_radix))
+
+    ref_dist = copy(mixed_comp_dist)
+    mixed_comp_dist += bincount(
+        new_comp_locs,
+        weights=mixed_comp_dist[large_merges],
+        minlength=no_mixed_comps)
+
     # Stores level of inflation of probability caused by adding prob of
     # compositions with size>max to ones with size<=max
     comp_scaler = mixed_comp_dist / ref_dist
 
-    print(large_merges)
-    print('Before deletion mixed_comp_list.shape=', mixed_comp_list.shape)
-    mixed_comp_list = delete(mixed_comp_list, large_merges, axis=0)
-    print('After deletion mixed_comp_list.shape=', mixed_comp_list.shape)
-    print('Before deletion mixed_comp_dist.shape=', mixed_comp_dist.shape)
-    mixed_comp_dist = delete(mixed_comp_dist, large_merges, axis=0)
-    print('After deletion mixed_comp_dist.shape=', mixed_comp_dist.shape)
-    print('Before deletion coeff.shape=', coeff.shape)
-    coeff = delete(coeff, large_merges, axis=0)
-    print('After deletion coeff.shape=', coeff.shape)
-    print('Before deletion pairings.shape=', pairings.shape)
-    pairings = delete(pairings, large_merges, axis=0)
-    print('After deletion pairings.shape=', pairings.shape)
-    print('Before deletion comp_scaler.shape=', comp_scaler.shape)
-    comp_scaler = delete(comp_scaler, large_merges, axis=0)
-    print('After deletion comp_scaler.shape=', comp_scaler.shape)
+    kept = mixed_sizes <= max_size
+    mixed_comp_list = mixed_comp_list[kept]
+    mixed_comp_dist = mixed_comp_dist[kept]
+    coeff = coeff[kept]
+    pairings = pairings[kept]
+    comp_scaler = comp_scaler[kept]
+
+    # Index of each merged composition from the code
+    # mixed_comp.dot(reverse_prod) + mixed_comp[0]
+    mixed_comp_radix = cumprod(hstack((
+        [1], mixed_comp_list.max(axis=0)[:-1] + 1)))
+    reverse_prod = hstack(([0], mixed_comp_radix[1:]))
+    rows = mixed_comp_list.dot(mixed_comp_radix)
+    mixed_comp_index_vector = sparse((
+        arange(len(rows)),
+        (rows, zeros(len(rows), dtype=my_int))),
+        shape=(rows.max() + 1, 1),
+        dtype=my_int)
 
     return \
         mixed_comp_list, \
@@ -341,31 +309,351 @@ def match_merged_states_to_unmerged(
         merged_population,
         pairings,
         no_hh,
-        no_compartments):
-
+        no_compartments,
+        hh_dimension=1):
+    '''Returns an array whose (i, hh) entry is the index in the unmerged
+    system of the state of household hh in merged state i. pairings[c, hh] is
+    the unmerged composition of household hh in merged composition c. Lookups
+    are done at once for all merged states sharing an unmerged composition.'''
     rp_um = unmerged_population.reverse_prod
     iv_um = unmerged_population.index_vector
     states_m = merged_population.states
     wc_m = merged_population.which_composition
-
-    # pdb.set_trace()
-    # iv_shifter = hstack((array(0),cumsum(unmerged_population.system_sizes))) # This shifts the index vectors so that they give you indices in the  full state list rather than in the individual matrix blocks
+    block_size = hh_dimension * no_compartments
 
     state_match = zeros((len(wc_m), no_hh), dtype=my_int)
 
-    for state_no in range(len(wc_m)):
-        merged_comp = wc_m[state_no]
-        for hh in range(no_hh):
-            unmerged_comp = pairings[merged_comp, hh]
-            this_iv = iv_um[unmerged_comp]
-            this_state = states_m[
-                state_no, hh * no_compartments:(hh+1) * no_compartments]
-            index = this_iv[
-                this_state.dot(rp_um[unmerged_comp]) + this_state[-1], 0]
-            state_match[state_no, hh] = index
+    for hh in range(no_hh):
+        unmerged_comps = pairings[wc_m, hh]
+        hh_states = states_m[:, hh * block_size:(hh+1) * block_size]
+        for comp in unique(unmerged_comps):
+            rows = where(unmerged_comps == comp)[0]
+            codes = (
+                hh_states[rows].dot(rp_um[comp]) + hh_states[rows, -1]
+                ).astype(my_int)
+            state_match[rows, hh] = iv_um[comp][codes, 0].toarray().ravel()
 
     return state_match
 
+
+class MergeMap:
+    '''Maps household distributions between an unmerged population and a
+    population of merged bubbles. The state matching and the sparse demerging
+    matrix are built once per pair of populations, so moving H across when a
+    bubble opens or closes is a single vectorised operation.'''
+    def __init__(
+            self,
+            unmerged_population,
+            merged_population,
+            pairings,
+            no_hh,
+            no_compartments,
+            hh_dimension=1,
+            composition_weighted=False):
+        self.state_match = match_merged_states_to_unmerged(
+            unmerged_population,
+            merged_population,
+            pairings,
+            no_hh,
+            no_compartments,
+            hh_dimension)
+        no_merged_states = self.state_match.shape[0]
+        if composition_weighted:
+            self.merge_weights = composition_merge_weights(
+                unmerged_population, merged_population, self.state_match)
+        else:
+            self.merge_weights = ones((no_merged_states,))
+        # Each merged state sends an equal share of its probability to the
+        # states of its constituent households
+        self.demerge_matrix = sparse((
+            ones((no_merged_states * no_hh,)) / no_hh,
+            (
+                self.state_match.ravel(),
+                repeat(arange(no_merged_states), no_hh))),
+            shape=(
+                len(unmerged_population.which_composition),
+                no_merged_states))
+
+    def merge(self, H_unmerged):
+        return self.merge_weights * prod(H_unmerged[self.state_match], axis=1)
+
+    def demerge(self, H_merged):
+        return self.demerge_matrix.dot(H_merged)
+
+
+# Version of the entries pickled by MergeTopologyCache. It enters every key,
+# so bumping it whenever the cached objects or the subsystems they are built
+# from change stops earlier pickles from being served.
+MERGE_CACHE_VERSION = 2
+
+
+def merge_topology_key(
+        composition_list,
+        composition_distribution,
+        no_hh,
+        max_size,
+        compartmental_structure,
+        rates=()):
+    '''Returns a string identifying everything the merged compositions,
+    pairings and state matches depend on, including the cache version. Rates
+    do not enter these, so the same key is shared by every sweep point.
+    Entries which do depend on some rates, such as Kronecker blocks, pass
+    them in rates.'''
+    digest = sha1()
+    digest.update('v{0}'.format(MERGE_CACHE_VERSION).encode())
+    for arr in (composition_list, composition_distribution, rates):
+        arr = array(arr, dtype=float)
+        digest.update(str(arr.shape).encode())
+        digest.update(arr.tobytes())
+    digest.update(
+        '{0}_{1}_{2}'.format(no_hh, max_size, compartmental_structure).encode())
+    return digest.hexdigest()
+
+
+class MergeTopologyCache:
+    '''Persistent store for the parts of a merged system which are shared
+    by every sweep point, i.e. the merged composition lists and
+    distributions, the pairings and the Kronecker blocks of the unmerged
+    population. Entries are kept in memory once built or loaded, and pickled
+    into directory so that later runs can reuse them.'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}
+        makedirs(directory, exist_ok=True)
+
+    def get(self, name, key, build):
+        '''Returns the entry stored under name and key, calling build to
+        create it if it is not in memory or on disk.'''
+        if (name, key) not in self.entries:
+            file_name = join(self.directory, '{0}_{1}.pkl'.format(name, key))
+            if isfile(file_name):
+                with open(file_name, 'rb') as f:
+                    entry = load(f)
+            else:
+                entry = build()
+                with open(file_name, 'wb') as f:
+                    dump(entry, f)
+            self.entries[(name, key)] = entry
+        return self.entries[(name, key)]
+
+
+class KroneckerBlocks:
+    '''The parts of a KroneckerMergedSystem which come from the unmerged
+    population alone. For each unmerged composition these are the
+    progression generator with within-household infection stripped out, the
+    generator for infection of one susceptible at unit force, and the
+    infectious compartment counts of each state. None of them depend on the
+    contact matrices or the density exponent, so a sweep over these can
+    build them once and share them between its merged systems.
+
+    Only single-class populations are supported: household size is read
+    from the single column of the composition list and the unit-force
+    infection generator carries one force of infection per state, so
+    populations with several risk groups are rejected.'''
+    def __init__(self, unmerged_population):
+        if (unmerged_population.no_risk_groups != 1) or \
+                (unmerged_population.composition_list.shape[1] != 1):
+            raise ValueError(
+                'KroneckerBlocks needs a single-class population, got {0} '
+                'risk groups'.format(unmerged_population.no_risk_groups))
+        inf_compartment_list = subsystem_key[
+            unmerged_population.compartmental_structure][2]
+        offsets = unmerged_population.offsets
+        states = unmerged_population.states
+        sizes = unmerged_population.composition_list[:, 0]
+        inf_row = unmerged_population.inf_event_row
+        inf_col = unmerged_population.inf_event_col
+        self.blocks = []
+        self.progression = []
+        self.infection = []
+        self.hh_size = []
+        self.inf_by_state = []
+        for comp in range(len(offsets) - 1):
+            block = slice(offsets[comp], offsets[comp + 1])
+            block_size = offsets[comp + 1] - offsets[comp]
+            in_block = (inf_row >= offsets[comp]) & (inf_row < offsets[comp+1])
+            row = inf_row[in_block] - offsets[comp]
+            col = inf_col[in_block] - offsets[comp]
+            sus_count = states[block, 0]
+            Q_block = unmerged_population.Q_int[block, block].tocsr()
+            # Strip out within-household infection, which is added back at
+            # the merged rates
+            off_diag = Q_block - sparse(
+                (Q_block[row, col].A.ravel(), (row, col)),
+                shape=Q_block.shape)
+            diag_idx = (arange(block_size), arange(block_size))
+            off_diag = off_diag - sparse(
+                (off_diag.diagonal(), diag_idx), shape=Q_block.shape)
+            self.progression.append((
+                off_diag - sparse(
+                    (off_diag.sum(axis=1).A.ravel(), diag_idx),
+                    shape=Q_block.shape)).tocsr())
+            self.infection.append(sparse(
+                (
+                    hstack((sus_count[row], -sus_count[row])),
+                    (hstack((row, row)), hstack((col, row)))),
+                shape=Q_block.shape).tocsr())
+            self.hh_size.append(sizes[comp])
+            self.inf_by_state.append(
+                states[block][:, inf_compartment_list])
+            self.blocks.append(block_size)
+
+
+class KroneckerMergedSystem:
+    '''Rate equations for a population of bubbles formed from independent
+    households, applied without enumerating the merged state space. The
+    distribution over bubbles of merged composition c is held as a tensor
+    with one axis per constituent household, each indexed by the states of
+    that household in the unmerged population. Within-household progression
+    acts on one axis at a time, so the generator is the Kronecker sum of the
+    unmerged progression blocks plus infection terms whose rates are sums of
+    per-household infectiousness vectors broadcast across the axes. Merging
+    and demerging are outer products and marginal sums of the same tensors.
+    The unmerged blocks are built from unmerged_population unless a
+    KroneckerBlocks for it is passed in blocks.'''
+    def __init__(
+            self,
+            unmerged_population,
+            merged_input,
+            pairings,
+            merged_comp_dist,
+            import_model,
+            epsilon=1.0,
+            blocks=None):
+        if blocks is None:
+            blocks = KroneckerBlocks(unmerged_population)
+        self.unmerged_population = unmerged_population
+        self.pairings = atleast_2d(pairings)
+        self.no_hh = self.pairings.shape[1]
+        self.import_model = import_model
+        self.epsilon = epsilon
+        self.r_home = diag(merged_input.sus).dot(merged_input.k_home)
+        self.ext_matrix_list = [
+            diag(merged_input.sus).dot(merged_input.k_ext).dot(diag(scales))
+            for scales in merged_input.inf_scales]
+
+        self.blocks = blocks.blocks
+        self.progression = blocks.progression
+        self.infection = blocks.infection
+        self.hh_size = blocks.hh_size
+        self.inf_by_state = blocks.inf_by_state
+        # Infectiousness of each household state in each bubble slot
+        self.weighted_inf = [
+            array([
+                inf_by_state.dot(array([
+                    scales[hh] for scales in merged_input.inf_scales]))
+                / hh_size**merged_input.density_expo
+                for hh in range(self.no_hh)])
+            for inf_by_state, hh_size in zip(self.inf_by_state, self.hh_size)]
+
+        self.shapes = [
+            tuple(self.blocks[c] for c in pairing)
+            for pairing in self.pairings]
+        merged_sizes = array([prod(shape) for shape in self.shapes])
+        self.offsets = concatenate(([0], cumsum(merged_sizes)))
+        unmerged_dist = unmerged_population.composition_distribution
+        self.merge_weights = array(merged_comp_dist).ravel() / prod(
+            unmerged_dist[self.pairings], axis=1)
+
+    def _block(self, H, mc):
+        return H[self.offsets[mc]:self.offsets[mc+1]].reshape(
+            self.shapes[mc])
+
+    def _marginal(self, X, hh):
+        return X.sum(axis=tuple(
+            ax for ax in range(self.no_hh) if ax != hh))
+
+    def _broadcast(self, vector, hh):
+        shape = ones((self.no_hh,), dtype=my_int)
+        shape[hh] = -1
+        return vector.reshape(shape)
+
+    def get_FOI_by_class(self, t, H):
+        '''Returns the external force of infection on each bubble slot,
+        calculated from the marginal distributions of each slot.'''
+        no_inf_compartments = len(self.ext_matrix_list)
+        denom = zeros((self.no_hh,))
+        inf_total = zeros((no_inf_compartments, self.no_hh))
+        for mc, pairing in enumerate(self.pairings):
+            X = self._block(H, mc)
+            for hh, comp in enumerate(pairing):
+                marginal = self._marginal(X, hh)
+                denom[hh] += marginal.sum() * self.hh_size[comp]
+                inf_total[:, hh] += marginal.dot(self.inf_by_state[comp])
+        inf_by_class = zeros(shape(inf_total))
+        inf_by_class[:, denom > 0] = inf_total[:, denom > 0] / denom[denom > 0]
+        FOI = self.import_model.cases(t) * ones((self.no_hh,))
+        for ic in range(no_inf_compartments):
+            FOI += self.ext_matrix_list[ic].dot(
+                self.epsilon * inf_by_class[ic])
+        return FOI
+
+    def __call__(self, t, H):
+        if (H < 0).any():
+            H[where(H < 0)[0]] = 0
+        if isnan(H).any():
+            raise ValueError('State vector contains NaNs at t={0}'.format(t))
+        FOI = self.get_FOI_by_class(t, H)
+        dH = zeros(shape(H))
+        for mc, pairing in enumerate(self.pairings):
+            X = self._block(H, mc)
+            inf_terms = [
+                self._broadcast(self.weighted_inf[comp][hh], hh)
+                for hh, comp in enumerate(pairing)]
+            dX = zeros(self.shapes[mc])
+            for i, comp in enumerate(pairing):
+                rate = FOI[i] * ones(self.shapes[mc])
+                for j in range(self.no_hh):
+                    rate = rate + self.r_home[i, j] * inf_terms[j]
+                X_i = moveaxis(X, i, -1).reshape(-1, self.blocks[comp])
+                rate_i = moveaxis(rate, i, -1).reshape(
+                    -1, self.blocks[comp])
+                dX_i = self.progression[comp].T.dot(X_i.T).T \
+                    + self.infection[comp].T.dot((rate_i * X_i).T).T
+                dX += moveaxis(
+                    dX_i.reshape(moveaxis(X, i, -1).shape), -1, i)
+            dH[self.offsets[mc]:self.offsets[mc+1]] = dX.ravel()
+        return dH
+
+    def merge(self, H_unmerged):
+        '''Returns the distribution over bubbles formed from households drawn
+        independently from H_unmerged.'''
+        offsets = self.unmerged_population.offsets
+        H_merged = zeros((self.offsets[-1],))
+        for mc, pairing in enumerate(self.pairings):
+            X = array(self.merge_weights[mc])
+            for comp in pairing:
+                X = multiply.outer(X, H_unmerged[offsets[comp]:offsets[comp+1]])
+            H_merged[self.offsets[mc]:self.offsets[mc+1]] = X.ravel()
+        return H_merged
+
+    def demerge(self, H_merged):
+        '''Returns the distribution over unmerged households, with each bubble
+        sending an equal share of its probability to each of its households.'''
+        offsets = self.unmerged_population.offsets
+        H_unmerged = zeros((offsets[-1],))
+        for mc, pairing in enumerate(self.pairings):
+            X = self._block(H_merged, mc)
+            for hh, comp in enumerate(pairing):
+                H_unmerged[offsets[comp]:offsets[comp+1]] += \
+                    self._marginal(X, hh) / self.no_hh
+        return H_unmerged
+
+    @property
+    def states(self):
+        '''Epidemiological states of the bubbles in the same layout as a
+        merged HouseholdPopulation, built on request for post-processing.'''
+        offsets = self.unmerged_population.offsets
+        unmerged_states = self.unmerged_population.states
+        blocks = []
+        for mc, pairing in enumerate(self.pairings):
+            idx = indices(self.shapes[mc]).reshape(self.no_hh, -1)
+            blocks.append(hstack([
+                unmerged_states[offsets[comp] + idx[hh]]
+                for hh, comp in enumerate(pairing)]))
+        return vstack(blocks)
+
+
 def initialise_merged_system(H0_unmerged,
                             merged_population,
                             state_match,
@@ -374,20 +662,8 @@ def initialise_merged_system(H0_unmerged,
                             no_hh):
 
     wc_m = merged_population.which_composition
-    no_merged_states = len(wc_m)
-    H0_merged = zeros((no_merged_states,))
-    for state_no in range(no_merged_states):
-        log_H0_merged = 0
-        for hh in range(no_hh):
-            # print(hh)
-            # print(state_no)
-            # print(state_match[state_no, hh])
-            log_H0_merged += log(H0_unmerged[state_match[state_no, hh]])
-        H0_merged[state_no] = coeff[wc_m[state_no]] * \
-                              comp_scaler[wc_m[state_no]] * \
-                              exp(log_H0_merged)
-
-    return H0_merged
+    return coeff[wc_m] * comp_scaler[wc_m] \
+        * prod(H0_unmerged[state_match[:, :no_hh]], axis=1)
 
 
 
@@ -485,26 +761,13 @@ def demerged_initial_condition(H_merged,
                             pairings,
                             no_hh =2,
                             no_compartments = 5):
-    H0_len = sum(unmerged_population.system_sizes)
-    H0 = zeros((H0_len,))
-    reverse_prod = unmerged_population.reverse_prod
-    index_vector_list = unmerged_population.index_vector
-    which_composition = merged_population.which_composition
-    merged_states = merged_population.states
-    unmerged_states = unmerged_population.states
-
-    for i in range(len(H_merged)):
-        for hh in range(no_hh):
-            comp = pairings[which_composition[i], hh]
-            state = merged_states[i,
-                hh * hh_dimension * no_compartments :
-                (hh+1) * hh_dimension * no_compartments]
-            index_vector = index_vector_list[comp]
-            index = index_vector[
-                state.dot(reverse_prod[comp]) + state[-1], 0]
-            H0[index] += (1 / no_hh) * H_merged[i]
-
-    return H0
+    return MergeMap(
+        unmerged_population,
+        merged_population,
+        pairings,
+        no_hh,
+        no_compartments,
+        hh_dimension).demerge(H_merged)
 
 SINGLE_AGE_CLASS_SPEC = {
     # Interpretable parameters:
@@ -1,8 +1,8 @@
 from argparse import ArgumentParser
 from numpy import arange, array, atleast_2d, hstack
 from os import makedirs
-from os.path import exists,isfile
-from pickle import load, dump
+from os.path import exists
+from pickle import dump
 from pandas import read_csv
 from scipy.integrate import solve_ivp
 from time import time
@@ -14,14 +14,13 @@ from model.common import SEIRRateEquations
 from model.imports import NoImportModel
 from examples.temp_bubbles.common import (
         DataObject,
+        KroneckerBlocks,
+        KroneckerMergedSystem,
         MergedSEIRInput,
-        demerged_initial_condition,
+        MergeTopologyCache,
+        merge_topology_key,
         build_mixed_compositions_pairwise,
-        pairwise_merged_initial_condition,
-        pairwise_demerged_initial_condition,
-        match_merged_states_to_unmerged,
-        build_mixed_compositions_threewise,
-        initialise_merged_system_threewise)
+        build_mixed_compositions_threewise)
 
 '''If there is not already a results folder assigned to the outputs from this
 script, create one now.'''
@@ -38,6 +37,10 @@ NO_COMPARTMENTS = 4 # We use an SEIR model, hence 4 compartments
 MAX_MERGED_SIZE = 10 # We only allow merges where total individuals is at most 12
 MAX_UNMERGED_SIZE = 4 # As usual, we model the chunk of the population in households of size 6 or fewer
 
+# Merged compositions only depend on the composition lists, and the Kronecker
+# blocks on these and the progression rates, so we keep them between runs
+MERGE_CACHE_DIR = 'outputs/temp_bubbles/merge_cache'
+
 
 def create_unmerged_context(p):
     return UnmergedContext(*p)
@@ -117,51 +120,50 @@ def create_merged_systems(p):
     return MergedSystems(*p)
 
 class MergedSystems:
+    '''The merged systems act directly on the states of the unmerged
+    population, so there is no merged state space to enumerate. Each system
+    serves as both the rate equations and the merge map for its bubbles.'''
     def __init__(
             self,
             merged_exp,
-            merged_comp_list_2,
+            unmerged_population,
+            kronecker_blocks,
+            pairings_2,
             merged_comp_dist_2,
-            merged_comp_list_3,
+            pairings_3,
             merged_comp_dist_3
             ):
 
         merged_input2 = MergedSEIRInput(
                         SPEC, composition_list, comp_dist, 2, 1)
         merged_input2.density_expo = merged_exp
-        self.merged_population2 = HouseholdPopulation(
-            merged_comp_list_2,
-            merged_comp_dist_2,
-            merged_input2,
-            True)
-        self.rhs_merged2 = SEIRRateEquations(
+        self.merged_population2 = KroneckerMergedSystem(
+            unmerged_population,
             merged_input2,
-            self.merged_population2,
-            NoImportModel(NO_COMPARTMENTS, 2))
+            pairings_2,
+            merged_comp_dist_2,
+            NoImportModel(NO_COMPARTMENTS, 2),
+            blocks=kronecker_blocks)
+        self.rhs_merged2 = self.merged_population2
 
         merged_input3 = MergedSEIRInput(
             SPEC, composition_list, comp_dist, 3, 1)
         merged_input3.density_expo = merged_exp
-        self.merged_population3 = HouseholdPopulation(
-            merged_comp_list_3,
-            merged_comp_dist_3,
-            merged_input3,
-            True)
-        self.rhs_merged3 = SEIRRateEquations(
+        self.merged_population3 = KroneckerMergedSystem(
+            unmerged_population,
             merged_input3,
-            self.merged_population3,
-            NoImportModel(NO_COMPARTMENTS, 3))
+            pairings_3,
+            merged_comp_dist_3,
+            NoImportModel(NO_COMPARTMENTS, 3),
+            blocks=kronecker_blocks)
+        self.rhs_merged3 = self.merged_population3
 
 
 def run_merge(
         i,
         j,
-        pairings_2,
-        pairings_3,
-        hh_dimension,
         unmerged,
         merged,
-        state_match,
         t_start,
         t_end,
         merge_start,
@@ -181,19 +183,17 @@ def run_merge(
     merged_population3 = merged.merged_population3
     rhs_merged2 = merged.rhs_merged2
     rhs_merged3 = merged.rhs_merged3
+    merge_map_2 = merged.merged_population2
+    merge_map_3 = merged.merged_population3
 
     merge_results.t_merge_1, \
         merge_results.H_merge_1, \
         merge_results.t_postmerge_1, \
         merge_results.H_postmerge_1 = \
-        simulate_merge3(
-            unmerged.population,
-            merged_population3,
+        simulate_merge(
+            merge_map_3,
             unmerged.rhs,
             rhs_merged3,
-            hh_dimension,
-            pairings_3,
-            state_match,
             [2],
             0,
             unmerged.baseline_H0,
@@ -203,13 +203,10 @@ def run_merge(
         merge_results.H_merge_3, \
         merge_results.t_postmerge_3, \
         merge_results.H_postmerge_3 = \
-        simulate_merge2(
-            unmerged.population,
-            merged_population2,
+        simulate_merge(
+            merge_map_2,
             unmerged.rhs,
             rhs_merged2,
-            hh_dimension,
-            pairings_2,
             [1],
             0,
             merge_results.H_postmerge_1[:, -1],
@@ -231,13 +228,10 @@ def run_merge(
         merge_results.H_merge_2, \
         merge_results.t_postmerge_2, \
         merge_results.H_postmerge_2 = \
-        simulate_merge2(
-            unmerged.population,
-            merged_population2,
+        simulate_merge(
+            merge_map_2,
             unmerged.rhs,
             rhs_merged2,
-            hh_dimension,
-            pairings_2,
             [1, 1],
             1,
             unmerged.baseline_H0,
@@ -247,13 +241,10 @@ def run_merge(
         merge_results.H_merge_4, \
         merge_results.t_postmerge_4, \
         merge_results.H_postmerge_4 = \
-        simulate_merge2(
-            unmerged.population,
-            merged_population2,
+        simulate_merge(
+            merge_map_2,
             unmerged.rhs,
             rhs_merged2,
-            hh_dimension,
-            pairings_2,
             [1],
             0,
             merge_results.H_postmerge_2[:, -1],
@@ -301,13 +292,10 @@ unmerged_exponents = array([0.0, 0.5, 1.0])
 merged_exponents = array([0.0, 0.5, 1.0])
 
 
-def simulate_merge2(
-        unmerged_population,
-        merged_population,
+def simulate_merge(
+        merge_map,
         rhs_unmerged,
         rhs_merged,
-        hh_dimension,
-        pairings,
         duration_list,
         switches,
         premerge_H0,
@@ -315,13 +303,7 @@ def simulate_merge2(
         t_end):
     for switch in range(switches+1):
         # print('Initialising merge number',switch,'...')
-        H0 = pairwise_merged_initial_condition(
-            premerge_H0,
-            unmerged_population,
-            merged_population,
-            hh_dimension,
-            pairings,
-            4)
+        H0 = merge_map.merge(premerge_H0)
         tspan = (t0, t0 + duration_list[switch])
         # print('Integrating over merge period number',switch,'...')
         solution = solve_ivp(
@@ -334,13 +316,7 @@ def simulate_merge2(
         temp_time = solution.t
         temp_H = solution.y
         t0 = t0 + duration_list[switch]
-        premerge_H0 = pairwise_demerged_initial_condition(
-            temp_H[:, -1],
-            unmerged_population,
-            merged_population,
-            hh_dimension,
-            pairings,
-            4)
+        premerge_H0 = merge_map.demerge(temp_H[:, -1])
         if switch == 0:
             merge_time = temp_time
             merge_H = temp_H
@@ -349,13 +325,7 @@ def simulate_merge2(
             merge_H = hstack((merge_H, temp_H))
 
     # print('Initialising post-merge period...')
-    H0 = pairwise_demerged_initial_condition(
-        merge_H[:, -1],
-        unmerged_population,
-        merged_population,
-        hh_dimension,
-        pairings,
-        4)
+    H0 = merge_map.demerge(merge_H[:, -1])
     tspan = (t0, t_end)
     # print('Integrating over post-merge period...')
     solution = solve_ivp(
@@ -371,117 +341,32 @@ def simulate_merge2(
     return merge_time, merge_H, postmerge_time, postmerge_H
 
 
-def simulate_merge3(
-        unmerged_population,
-        merged_population,
-        rhs_unmerged,
-        rhs_merged,
-        hh_dimension,
-        pairings,
-        state_match,
-        duration_list,
-        switches,
-        premerge_H0,
-        t0,
-        t_end):
-    for switch in range(switches+1):
-        # print('Initialising merge number',switch,'...')
-        H0 = initialise_merged_system_threewise(
-            premerge_H0,
-            unmerged_population,
-            merged_population,
-            state_match)
-        tspan = (t0, t0 + duration_list[switch])
-        # print('Integrating over merge period number',switch,'...')
-        # t_mer = time()
-        solution = solve_ivp(
-            rhs_merged,
-            tspan,
-            H0/sum(H0),
-            first_step=0.001,
-            atol=ATOL)
-        # print('Integration over merge period took',time()-t_mer,'seconds.')
-        temp_time = solution.t
-        temp_H = solution.y
-        t0 = t0 + duration_list[switch]
-        premerge_H0 = demerged_initial_condition(
-            temp_H[:, -1],
-            unmerged_population,
-            merged_population,
-            hh_dimension,
-            pairings,
-            hh_to_merge,
-            4)
-        if switch == 0:
-            merge_time = temp_time
-            merge_H = temp_H
-        else:
-            merge_time = hstack((
-                merge_time,
-                temp_time))
-            merge_H = hstack((merge_H, temp_H))
-
-    # print('Initialising post-merge period...')
-    H0 = demerged_initial_condition(
-        merge_H[:, -1],
-        unmerged_population,
-        merged_population,
-        hh_dimension,
-        pairings,
-        hh_to_merge,
-        4)
-    tspan = (t0, t_end)
-    # print('Integrating over post-merge period...')
-    # t_post = time()
-    solution = solve_ivp(
-        rhs_unmerged,
-        tspan,
-        H0,
-        first_step=0.001,
-        atol=ATOL)
-    # print('Integration over post-merge period took',time()-t_post,'seconds.')
-    postmerge_time = solution.t
-    postmerge_H = solution.y
-
-    return merge_time, merge_H, postmerge_time, postmerge_H
-
-
 def main(no_of_workers):
-    if isfile('threewise_merge_comps.pkl') is True:
-        with open('threewise_merge_comps.pkl', 'rb') as f:
-            print('Loading merged composition distribution...')
-            merged_comp_list_2, \
-                merged_comp_dist_2, \
-                pairings_2, \
-                merged_comp_list_3, \
-                merged_comp_dist_3, \
-                hh_dimension, \
-                pairings_3 = load(f)
-    else:
-        print('Building merged composition distribution...')
-        merged_comp_list_2, \
-            merged_comp_dist_2, \
-            hh_dimension, \
-            pairings_2 = build_mixed_compositions_pairwise(
-                composition_list, comp_dist)
-        merged_comp_list_3, \
-            merged_comp_dist_3, \
-            hh_dimension, \
-            pairings_3 = build_mixed_compositions_threewise(
-                composition_list, comp_dist, MAX_MERGED_SIZE)
-
-        with open('threewise_merge_comps.pkl', 'wb') as f:
-            dump(
-                (
-                    merged_comp_list_2,
-                    merged_comp_dist_2,
-                    pairings_2,
-                    merged_comp_list_3,
-                    merged_comp_dist_3,
-                    hh_dimension,
-                    pairings_3
-                ),
-                f)
+    topology_cache = MergeTopologyCache(MERGE_CACHE_DIR)
+    key_2 = merge_topology_key(
+        composition_list, comp_dist, 2, None, SPEC['compartmental_structure'])
+    key_3 = merge_topology_key(
+        composition_list,
+        comp_dist,
+        hh_to_merge,
+        MAX_MERGED_SIZE,
+        SPEC['compartmental_structure'])
+    merged_comp_list_2, \
+        merged_comp_dist_2, \
+        hh_dimension, \
+        pairings_2 = topology_cache.get(
+            'compositions',
+            key_2,
+            lambda: build_mixed_compositions_pairwise(
+                composition_list, comp_dist))
+    merged_comp_list_3, \
+        merged_comp_dist_3, \
+        hh_dimension, \
+        pairings_3 = topology_cache.get(
+            'compositions',
+            key_3,
+            lambda: build_mixed_compositions_threewise(
+                composition_list, comp_dist, MAX_MERGED_SIZE))
     # December 1st
     t0 = 335.0
     # December 25th
@@ -495,35 +380,40 @@ def main(no_of_workers):
         params.append((i, e, t0, t_end, merge_start))
     with Pool(no_of_workers) as pool:
         unmerged_results = pool.map(create_unmerged_context, params)
+    # The unmerged state space does not depend on the density exponent, so
+    # any of the unmerged populations can carry the merged systems. Nor do
+    # the Kronecker blocks, which only see its progression rates.
+    kronecker_blocks = topology_cache.get(
+        'kronecker_blocks',
+        merge_topology_key(
+            composition_list,
+            comp_dist,
+            1,
+            None,
+            SPEC['compartmental_structure'],
+            (SPEC['incubation_rate'], SPEC['recovery_rate'])),
+        lambda: KroneckerBlocks(unmerged_results[0].population))
     params = []
     for e in merged_exponents:
         params.append((
             e,
-            merged_comp_list_2,
+            unmerged_results[0].population,
+            kronecker_blocks,
+            array(pairings_2).T,
             merged_comp_dist_2,
-            merged_comp_list_3,
+            pairings_3,
             merged_comp_dist_3
             ))
     with Pool(no_of_workers) as pool:
         merged_populations = pool.map(create_merged_systems, params)
 
-    state_match = match_merged_states_to_unmerged(
-        unmerged_results[0].population,
-        merged_populations[0].merged_population3,
-        pairings_3,
-        hh_to_merge,
-        NO_COMPARTMENTS)
-
     params = []
     for i, ei in enumerate(unmerged_exponents):
         for j, ej in enumerate(merged_exponents):
             params.append((
                 i, j,
-                pairings_2, pairings_3,
-                hh_dimension,
                 unmerged_results[i],
                 merged_populations[j],
-                state_match,
                 t0, t_end, merge_start, merge_end))
     with Pool(no_of_workers) as pool:
         pool.map(unpack_paramas_and_run_merge, params)
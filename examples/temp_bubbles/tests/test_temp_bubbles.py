@@ -0,0 +1,220 @@
+'''Checks of the temporary bubble utilities against the loop versions they
+replaced'''
+from numpy import arange, array, atleast_2d, bincount, prod, where, zeros
+from numpy.random import default_rng
+from numpy.testing import assert_almost_equal
+from pytest import raises
+from scipy.special import factorial
+from scipy.stats import multinomial
+from model.preprocessing import HouseholdPopulation, SEIRInput
+from model.imports import NoImportModel
+from model.specs import (
+    SINGLE_AGE_SEIR_SPEC, SINGLE_AGE_UK_SPEC, TWO_AGE_SEIR_SPEC,
+    TWO_AGE_UK_SPEC)
+from examples.temp_bubbles.common import (
+    KroneckerBlocks, KroneckerMergedSystem, MergedSEIRInput, MergeMap,
+    MergeTopologyCache, build_mixed_compositions,
+    build_mixed_compositions_pairwise, build_mixed_compositions_threewise,
+    merge_topology_key)
+
+SPEC = {**SINGLE_AGE_UK_SPEC, **SINGLE_AGE_SEIR_SPEC}
+NO_COMPARTMENTS = 4
+COMPOSITION_LIST = atleast_2d(arange(1, 4)).T
+COMPOSITION_DISTRIBUTION = array([0.5, 0.3, 0.2])
+
+def make_populations():
+    '''Returns the unmerged population with its pairwise and threewise
+    merges, and the pairings of each merge'''
+    unmerged = HouseholdPopulation(
+        COMPOSITION_LIST,
+        COMPOSITION_DISTRIBUTION,
+        SEIRInput(SPEC, COMPOSITION_LIST, COMPOSITION_DISTRIBUTION),
+        False)
+    merged_comp_list_2, merged_comp_dist_2, _, pairings_2 = \
+        build_mixed_compositions_pairwise(
+            COMPOSITION_LIST, COMPOSITION_DISTRIBUTION)
+    merged_2 = HouseholdPopulation(
+        merged_comp_list_2,
+        merged_comp_dist_2.ravel(),
+        MergedSEIRInput(
+            SPEC, COMPOSITION_LIST, COMPOSITION_DISTRIBUTION, 2, 1),
+        False)
+    merged_comp_list_3, merged_comp_dist_3, _, pairings_3 = \
+        build_mixed_compositions_threewise(
+            COMPOSITION_LIST, COMPOSITION_DISTRIBUTION, 6)
+    merged_3 = HouseholdPopulation(
+        merged_comp_list_3,
+        merged_comp_dist_3,
+        MergedSEIRInput(
+            SPEC, COMPOSITION_LIST, COMPOSITION_DISTRIBUTION, 3, 1),
+        False)
+    return (
+        unmerged,
+        (merged_2, array(pairings_2).T),
+        (merged_3, pairings_3))
+
+def loop_state_match(unmerged, merged, pairings, no_hh):
+    '''Matches merged states to unmerged ones one lookup at a time'''
+    state_match = zeros((len(merged.which_composition), no_hh), dtype=int)
+    for state_no, merged_comp in enumerate(merged.which_composition):
+        for hh in range(no_hh):
+            comp = pairings[merged_comp, hh]
+            state = merged.states[
+                state_no, hh * NO_COMPARTMENTS:(hh+1) * NO_COMPARTMENTS]
+            code = state.dot(unmerged.reverse_prod[comp]) + state[-1]
+            state_match[state_no, hh] = \
+                unmerged.index_vector[comp][int(code), 0]
+    return state_match
+
+def test_merge_maps():
+    '''Check vectorised merge maps match state by state merging'''
+    unmerged, *merges = make_populations()
+    rng = default_rng(0)
+    H = rng.random(len(unmerged.which_composition))
+    cd_um = unmerged.composition_distribution
+    wc_um = unmerged.which_composition
+    for no_hh, (merged, pairings) in enumerate(merges, 2):
+        merge_map = MergeMap(
+            unmerged,
+            merged,
+            pairings,
+            no_hh,
+            NO_COMPARTMENTS,
+            composition_weighted=True)
+        state_match = loop_state_match(unmerged, merged, pairings, no_hh)
+        assert (merge_map.state_match == state_match).all()
+
+        H_merged = rng.random(len(merged.which_composition))
+        merged_H = zeros(len(merged.which_composition))
+        demerged_H = zeros(len(wc_um))
+        for state_no, match in enumerate(state_match):
+            merged_H[state_no] = merged.composition_distribution[
+                merged.which_composition[state_no]] \
+                * H[match].prod() / cd_um[wc_um[match]].prod()
+            for index in match:
+                demerged_H[index] += H_merged[state_no] / no_hh
+        assert_almost_equal(merge_map.merge(H), merged_H)
+        assert_almost_equal(merge_map.demerge(H_merged), demerged_H)
+
+def test_merge_topology_cache(tmp_path):
+    '''Check cached merge maps come back from disk unchanged'''
+    unmerged, (merged, pairings), _ = make_populations()
+    key = merge_topology_key(
+        COMPOSITION_LIST, COMPOSITION_DISTRIBUTION, 2, None, 'SEIR')
+    assert key != merge_topology_key(
+        COMPOSITION_LIST, COMPOSITION_DISTRIBUTION, 2, None, 'SEPIR')
+    built = MergeTopologyCache(tmp_path).get(
+        'merge_map_2',
+        key,
+        lambda: MergeMap(unmerged, merged, pairings, 2, NO_COMPARTMENTS))
+
+    def fail():
+        raise AssertionError('cached entry was rebuilt')
+    loaded = MergeTopologyCache(tmp_path).get('merge_map_2', key, fail)
+    assert loaded is not built
+    assert (loaded.state_match == built.state_match).all()
+    assert (loaded.merge_weights == built.merge_weights).all()
+    assert (loaded.demerge_matrix != built.demerge_matrix).nnz == 0
+
+def loop_mixed_compositions(
+        composition_list, composition_distribution, no_hh, max_size):
+    '''Builds merged compositions by recursing over multisets of
+    compositions and folding oversize merges one at a time'''
+    no_comps = len(composition_list)
+    hhi = no_hh * [0]
+    mixed_comp_list, mixed_comp_dist, pairings, coeff = [], [], [], []
+
+    def comp_iterator(depth):
+        if depth < no_hh:
+            for i in range(hhi[depth-1], no_comps):
+                hhi[depth] = i
+                comp_iterator(depth+1)
+        else:
+            hist = bincount(hhi, minlength=no_comps)
+            pairings.append(list(hhi))
+            mixed_comp_list.append(composition_list[hhi].ravel())
+            mixed_comp_dist.append(multinomial.pmf(
+                hist, n=no_hh, p=composition_distribution))
+            coeff.append(factorial(no_hh) / prod(factorial(hist)))
+
+    comp_iterator(0)
+    mixed_comp_list = array(mixed_comp_list)
+    mixed_comp_dist = array(mixed_comp_dist)
+    ref_dist = mixed_comp_dist.copy()
+    for merge_no in where(mixed_comp_list.sum(axis=1) > max_size)[0]:
+        folded = mixed_comp_list[merge_no].copy()
+        while folded.sum() > max_size:
+            folded[folded.argmax()] -= 1
+        new_loc = [
+            k for k, comp in enumerate(mixed_comp_list)
+            if (comp == folded).all()][0]
+        mixed_comp_dist[new_loc] += mixed_comp_dist[merge_no]
+    kept = mixed_comp_list.sum(axis=1) <= max_size
+    return (
+        mixed_comp_list[kept],
+        mixed_comp_dist[kept],
+        array(pairings)[kept],
+        array(coeff)[kept],
+        (mixed_comp_dist / ref_dist)[kept])
+
+def test_mixed_compositions():
+    '''Check vectorised bubble compositions match the recursive builder'''
+    composition_list = atleast_2d(arange(1, 5)).T
+    composition_distribution = array([0.3, 0.3, 0.25, 0.15])
+    for no_hh, max_size in [(2, 6), (3, 7), (4, 9)]:
+        mixed_comp_list, mixed_comp_dist, _, pairings, _, _, coeff, \
+            comp_scaler = build_mixed_compositions(
+                composition_list, composition_distribution, no_hh, max_size)
+        reference = loop_mixed_compositions(
+            composition_list, composition_distribution, no_hh, max_size)
+        assert (mixed_comp_list == reference[0]).all()
+        assert_almost_equal(mixed_comp_dist, reference[1])
+        assert (pairings == reference[2]).all()
+        assert_almost_equal(coeff, reference[3])
+        assert_almost_equal(comp_scaler, reference[4])
+        assert_almost_equal(mixed_comp_dist.sum(), 1.0)
+
+def test_kronecker_merged_system():
+    '''Check the Kronecker rate equations match the enumerated merged
+    generator, with external infection switched off'''
+    unmerged, *merges = make_populations()
+    rng = default_rng(0)
+    for no_hh, (merged, pairings) in enumerate(merges, 2):
+        merged_input = MergedSEIRInput(
+            SPEC, COMPOSITION_LIST, COMPOSITION_DISTRIBUTION, no_hh, 1)
+        system = KroneckerMergedSystem(
+            unmerged,
+            merged_input,
+            pairings,
+            merged.composition_distribution,
+            NoImportModel(1, 1),
+            epsilon=0.0)
+        # Position of each Kronecker state in the enumerated population
+        kron_states = system.states
+        perm = zeros(len(kron_states), dtype=int)
+        for mc in range(len(pairings)):
+            kron_block = range(system.offsets[mc], system.offsets[mc+1])
+            merged_block = where(merged.which_composition == mc)[0]
+            lookup = {
+                tuple(merged.states[i]): i for i in merged_block}
+            for i in kron_block:
+                perm[i] = lookup[tuple(kron_states[i])]
+        assert len(set(perm)) == merged.Q_int.shape[0]
+        H = rng.random(len(perm))
+        H_enum = zeros(len(perm))
+        H_enum[perm] = H
+        assert_almost_equal(
+            system(0.0, H.copy()), merged.Q_int.T.dot(H_enum)[perm])
+
+def test_kronecker_blocks_single_class():
+    '''Check Kronecker blocks reject populations with several classes'''
+    composition_list = array([[1, 0], [0, 1], [1, 1]])
+    composition_distribution = array([0.4, 0.4, 0.2])
+    spec = {**TWO_AGE_UK_SPEC, **TWO_AGE_SEIR_SPEC}
+    population = HouseholdPopulation(
+        composition_list,
+        composition_distribution,
+        SEIRInput(spec, composition_list, composition_distribution),
+        False)
+    with raises(ValueError):
+        KroneckerBlocks(population)
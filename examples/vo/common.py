@@ -1,13 +1,20 @@
-from os.path import isfile
-from copy import deepcopy
-from pickle import load, dump
+from os.path import getmtime, isfile, splitext
+from copy import copy, deepcopy
 from numpy import (
-        arange, array, histogram, isnan, log, ones, prod, where, zeros)
+        add, arange, argsort, array, bincount, ceil, concatenate, cumsum,
+        exp, histogram, hstack, isnan, log, nan, ones, prod, repeat, savez,
+        searchsorted, vstack, where, zeros)
+from numpy import load as load_npz
+from numpy import unique as unique_rows
 from scipy.integrate import solve_ivp
-from pandas import read_csv, unique
+from scipy.optimize import minimize
+from scipy.sparse import (
+    block_diag as sparse_block_diag, bmat as sparse_bmat, csr_matrix)
+from scipy.sparse.linalg import expm_multiply
+from pandas import factorize, read_csv, unique
 from model.specs import VO_SPEC
 from model.preprocessing import VoInput, HouseholdPopulation
-from model.common import RateEquations
+from model.common import RateEquations, sparse
 from model.imports import ExponentialImportModel
 
 AGE_GROUPS = [
@@ -40,6 +47,54 @@ def get_symptoms_by_test(test, symptoms):
     return symp_locs, asym_locs
 
 
+def observation_mask(states, observation):
+    '''Returns a boolean array marking the rows of states which are
+    consistent with an observation as returned by
+    HouseholdTestData.get_observation.'''
+    min_symps_by_age, min_asyms_by_age, max_inf_by_age = observation
+    # The next line finds all the lines consistent with the min/max
+    # number of infecteds by multiplying truth values for each
+    # comparision along the rows
+    return array(
+        prod(states[:, 2::5] >= min_symps_by_age, axis=1)
+        * prod(states[:, 3::5] >= min_asyms_by_age, axis=1)
+        * prod(states[:, 2::5] + states[:, 3::5] <= max_inf_by_age, axis=1),
+        dtype=bool)
+
+
+class TestObservationModel:
+    '''Cache of the masks relating household states to test results. Tests
+    only see the numbers of symptomatic and asymptomatic infections by age, so
+    the states of each composition are indexed by their distinct profiles of
+    these counts and a mask is found by checking each profile once. Masks are
+    stored against the composition and the observed outcome; the state space
+    of a composition does not depend on the model parameters, so they are
+    reused across every likelihood evaluation.'''
+    def __init__(self):
+        self.profiles = {}
+        self.masks = {}
+
+    def mask(self, composition, states, observation):
+        '''Returns the mask of the states of composition which are
+        consistent with observation.'''
+        composition = tuple(composition)
+        key = (composition, observation)
+        if key not in self.masks:
+            if composition not in self.profiles:
+                self.profiles[composition] = unique_rows(
+                    hstack((states[:, 2::5], states[:, 3::5])),
+                    axis=0,
+                    return_inverse=True)
+            profiles, profile_index = self.profiles[composition]
+            no_age_classes = profiles.shape[1] // 2
+            profile_states = zeros((len(profiles), 5 * no_age_classes))
+            profile_states[:, 2::5] = profiles[:, :no_age_classes]
+            profile_states[:, 3::5] = profiles[:, no_age_classes:]
+            self.masks[key] = observation_mask(
+                profile_states, observation)[profile_index.ravel()]
+        return self.masks[key]
+
+
 class HouseholdTestData:
     def __init__(self, ages, symptoms, tests):
         self.ages = ages
@@ -49,23 +104,53 @@ class HouseholdTestData:
         self.composition = histogram(
             ages, bins=arange(0, len(AGE_GROUPS)+1))[0]
 
-    def get_test_probability(self, rhs, H0, test_start_date, t_end):
-        '''In the following function, t0 is the time point from which we run
-        the master equations, start_date is the first day in the Vo data. This
-        function assumes the ages are in numeric form (zero-based numbering),
-        i.e. index 0 for first age class, index 1 for second age class etc.'''
+    def get_observation(self, test_index):
+        '''Returns the minimum numbers of symptomatic and asymptomatic
+        infections and the maximum number of infections by age which are
+        consistent with the results of the tests in column test_index.'''
+        test = self.tests[:, test_index]
+        symp_locs, asym_locs = get_symptoms_by_test(test, self.symptoms)
+        no_age_classes = len(self.composition)
+        min_symps_by_age = bincount(
+            self.ages[symp_locs], minlength=no_age_classes)
+        min_asyms_by_age = bincount(
+            self.ages[asym_locs], minlength=no_age_classes)
+        max_inf_by_age = self.composition - bincount(
+            self.ages[test == 0], minlength=no_age_classes)
+        return tuple(min_symps_by_age), \
+            tuple(min_asyms_by_age), \
+            tuple(max_inf_by_age)
 
-        nn, tt = self.tests.shape
+    def get_test_mask(self, states, test_index, observation_model=None):
+        '''Returns a boolean array marking the rows of states which are
+        consistent with the results of the tests in column test_index, taking
+        it from observation_model if one is given.'''
+        observation = self.get_observation(test_index)
+        if observation_model is None:
+            return observation_mask(states, observation)
+        return observation_model.mask(self.composition, states, observation)
+
+    def get_test_days(self, test_start_date):
+        '''Returns the sorted days on which this household has a test
+        result.'''
         # Find all locations where we have a test result
         test_days = unique(
             test_start_date + where(~isnan(self.tests))[1])
+        test_days.sort()
+        return test_days
+
+    def get_test_probability(
+            self, rhs, H0, test_start_date, t_end, observation_model=None):
+        '''In the following function, t0 is the time point from which we run
+        the master equations, start_date is the first day in the Vo data. This
+        function assumes the ages are in numeric form (zero-based numbering),
+        i.e. index 0 for first age class, index 1 for second age class etc.'''
 
         H_start = H0
         t_start = 0.0
         result_prob = []
-        test_days.sort()
 
-        for t_next_test in test_days:
+        for t_next_test in self.get_test_days(test_start_date):
             solution = solve_ivp(
                 rhs,
                 (t_start, t_next_test),
@@ -74,60 +159,17 @@ class HouseholdTestData:
                 atol=1e-12)
             H = solution.y
             H_end = H[:, -1]
-            # print('H = ', H_end)
-            # print('After initial run sum(H_end)=',sum(H_end))
-            # H_end[H_end<0]=0
-            # print('Throwing away bad values, sum(H_end)=',sum(H_end))
-
-            # Now calculate total positives and negatives by age class on this
-            # date
-            symp_locs, asym_locs = get_symptoms_by_test(
-                self.tests[:, int(t_next_test) - test_start_date],
-                self.symptoms)
-            symp_ages = self.ages[symp_locs]
-            # print('symp_ages=', symp_ages)
-            asym_ages = self.ages[asym_locs]
-            # print('asym_ages=',asymp_ages)
-            neg_ages = self.ages[
-                self.tests[:, int(t_next_test) - test_start_date] == 0]
-
-            min_symps_by_age = zeros((len(AGE_GROUPS),))
-            for i in symp_ages:
-                min_symps_by_age[i] += 1
-            min_asyms_by_age = zeros((len(AGE_GROUPS),))
-            # Index is needed because composition is inside an array
-            for i in asym_ages:
-                min_asyms_by_age[i] += 1
-            max_inf_by_age = list(self.composition)
-            # print(composition)
-            for i in neg_ages:
-                max_inf_by_age[i] -= 1
-            # print('min_symps=',min_symps_by_age)
-            # print('min_asymps_by_age=',min_asymps_by_age)
-            # print('max_inf_by_age=',max_inf_by_age)
-
-            # The next line finds all the lines consistent with the min/max
-            # number of infecteds by multiplying truth values for each
-            # comparision along the rows
-
-            states = rhs.household_population.states
-            mask = array(
-                prod(states[:, 2::5] >= min_symps_by_age, axis=1)
-                * prod(states[:, 3::5] >= min_asyms_by_age, axis=1)
-                * prod(states[:, 2::5] + states[:, 3::5] <= max_inf_by_age, axis=1),
-                dtype=bool)
-            # print('Number of valid states is ', len(valid_locs))
-            # print('Number of invalid states is ', len(H_end) - len(valid_locs))
-            # print('Valid probability is ', H_end[mask].sum())
-            # print('Invalid probability is ', H_end[~mask].sum())
+
+            mask = self.get_test_mask(
+                rhs.household_population.states,
+                int(t_next_test) - test_start_date,
+                observation_model)
             result_prob.append(H_end[mask].sum())
             H_start = 0.0 * H_start
             H_start[mask] = H_end[mask]
             if H_start.sum() == 0.0:
                 raise ValueError
             H_start = H_start / H_start.sum()
-            # print('New starting probability is ', H_start.sum())
-            # print('H_start = ', H_start)
             t_start = t_next_test
         return sum(log((result_prob)))
 
@@ -154,62 +196,100 @@ class HouseholdTestData:
         fig.savefig(file_name, dpi=300)
 
 
+def load_vo_testing_data(
+        csv_file='examples/vo/vo_data.csv',
+        npz_file=None):
+    '''Returns the Vo testing data as arrays over individuals grouped by
+    household, in order of first appearance in the data: the offsets of each
+    household, the age class of each individual, their symptom status and
+    their results on each test day (1 for positive, 0 for negative, nan for
+    untested). The parsed arrays are saved to npz_file, by default next to
+    the csv, which is read instead of the csv on later calls unless the csv
+    has changed since.'''
+    if npz_file is None:
+        npz_file = splitext(csv_file)[0] + '.npz'
+    if isfile(npz_file) and (getmtime(npz_file) >= getmtime(csv_file)):
+        with load_npz(npz_file) as data:
+            return (
+                data['household_offsets'],
+                data['ages'],
+                data['symptoms'],
+                data['tests'])
+
+    df = read_csv(csv_file, dtype={'household_id': str})
+    testday_columns = range(104, 123)
+    household_codes, _ = factorize(df.household_id)
+    order = argsort(household_codes, kind='stable')
+    household_offsets = concatenate((
+        [0], cumsum(bincount(household_codes))))
+    ages = df.age_group.map(HH_AGE_DICT).to_numpy(dtype=int)[order]
+    symptoms = df.symptomatic.to_numpy(dtype=str)[order]
+    raw_tests = df.iloc[:, testday_columns].to_numpy()[order]
+    tests = where(
+        raw_tests == 'Pos', 1.0, where(raw_tests == 'Neg', 0.0, nan))
+    savez(
+        npz_file,
+        household_offsets=household_offsets,
+        ages=ages,
+        symptoms=symptoms,
+        tests=tests)
+    return household_offsets, ages, symptoms, tests
+
+
 class LikelihoodCalculation:
     ''''''
-    def __init__(self):
-        if isfile('vo-testing-data.pkl') is True:
-            with open('vo-testing-data.pkl', 'rb') as f:
-                tests, ages, symptoms = load(f)
-        else:
-            df = read_csv(
-                'examples/vo/vo_data.csv',
-                dtype={
-                    'household_id': str})
-            hhids = unique(df.household_id)
-            testday_columns = range(104, 123)
-            tests = []
-            ages = []
-            symptoms = []
-            for hid in hhids:
-                dfh = df[df.household_id == hid]
-                test = dfh.iloc[:, testday_columns].values
-                age_groups = dfh.age_group.values
-                ss = dfh.symptomatic.values
-                test[test == 'Neg'] = 0
-                test[test == 'Pos'] = 1
-                tests.append(test.astype(float))
-                ages.append(
-                    array([HH_AGE_DICT[ag] for ag in age_groups]))
-                symptoms.append(ss)
-            with open('vo-testing-data.pkl', 'wb') as f:
-                dump((tests, ages, symptoms), f)
-
+    def __init__(self, npz_file=None):
+        household_offsets, ages, symptoms, tests = load_vo_testing_data(
+            npz_file=npz_file)
+        # Households hold views into the contiguous arrays, so workers forked
+        # from this process share the data rather than copying it
         self.households = [
-            HouseholdTestData(a, s, t)
-            for a, s, t in zip(ages, symptoms, tests)]
+            HouseholdTestData(
+                ages[start:end], symptoms[start:end], tests[start:end])
+            for start, end in zip(
+                household_offsets[:-1], household_offsets[1:])]
+        # The model input is built for the compositions of the households we
+        # can fit, weighted by how often each appears
+        groups = {}
+        for i, household in enumerate(self.households):
+            if self.is_acceptable(household):
+                groups.setdefault(tuple(household.composition), []).append(i)
+        self.composition_list = array(list(groups.keys()))
+        self.household_groups = list(groups.values())
+        group_sizes = array([len(group) for group in self.household_groups])
+        self.composition_distribution = group_sizes / group_sizes.sum()
         self.t_first_test = 14
         self.t_end = self.t_first_test + 20.0
         self.epsilon = 0.0
+        self.observation_model = TestObservationModel()
 
     def __call__(self, r, a):
-        spec = deepcopy(VO_SPEC)
-        spec['external_importation']['exponent'] = r
-        spec['external_importation']['alpha'] = a
-        self.model_input = VoInput(spec)
+        self.set_parameters(r, a)
         unfiltered_probabilities = self._process_households()
         probabilities = [
             prob for prob in unfiltered_probabilities
             if prob is not None]
         return sum(probabilities)
 
-    def compute_probability(self, household):
+    def set_parameters(self, r, a):
+        '''Sets the model input for import growth rate r and import scale a.'''
+        spec = deepcopy(VO_SPEC)
+        spec['external_importation']['exponent'] = r
+        spec['external_importation']['alpha'] = a
+        self.model_input = VoInput(
+            spec, self.composition_list, self.composition_distribution)
+
+    @staticmethod
+    def is_acceptable(household):
         # There are a few huge households which we skip
-        household_is_acceptable = (
+        return (
             (household.composition.sum() < 8)
             and
             (household.composition.sum() == household.tests.shape[0]))
+
+    def compute_probability(self, household):
         try:
-            if household_is_acceptable:
+            if self.is_acceptable(household):
                 return self._compute_probability_for_valid(household)
             else:
                 return None
@@ -233,6 +313,7 @@ class LikelihoodCalculation:
         rhs = RateEquations(
             self.model_input,
             household_population,
+            self.model_input.import_model,
             self.epsilon)
         return H0, rhs
 
@@ -242,4 +323,359 @@ class LikelihoodCalculation:
             rhs,
             H0,
             self.t_first_test,
-            self.t_end)
+            self.t_end,
+            self.observation_model)
+
+
+def sparse_combination(matrices):
+    '''Returns a CSR matrix whose pattern covers all of matrices, and an
+    array whose jth column holds the entries of matrices[j] on that pattern.
+    Any linear combination of matrices is then found by setting the data of
+    the template to the product of this array with the coefficients, without
+    building a new sparse matrix.'''
+    no_rows, no_cols = matrices[0].shape
+    entries = [m.tocoo() for m in matrices]
+    locations = [
+        e.row.astype(int) * no_cols + e.col.astype(int) for e in entries]
+    pattern = unique_rows(concatenate(locations))
+    basis = zeros((len(pattern), len(matrices)))
+    for j, (e, loc) in enumerate(zip(entries, locations)):
+        add.at(basis[:, j], searchsorted(pattern, loc), e.data)
+    # Pattern locations are in row-major order, which is the order of the
+    # data of a canonical CSR matrix
+    template = csr_matrix(
+        (ones((len(pattern),)), (pattern // no_cols, pattern % no_cols)),
+        shape=(no_rows, no_cols))
+    return template, basis
+
+
+class BatchedBlockPropagator:
+    '''Propagates the columns of a matrix of distributions over the states
+    of one composition block of a household population, for households which
+    do not infect each other. The generator is Q_int plus the external
+    infection rates, assembled from one unit-rate infection generator per
+    age class so that no full-population Q_ext is needed. All columns are
+    moved with expm_multiply. If the import model is time invariant this is
+    exact over any interval; otherwise the interval is split into steps of at
+    most max_step and the imports are frozen at the midpoint of each step,
+    which is second order accurate in the step length.'''
+    def __init__(
+            self,
+            household_population,
+            composition,
+            import_model,
+            max_step=0.1):
+        no_compartments = \
+            household_population.num_of_epidemiological_compartments
+        start = household_population.offsets[composition]
+        end = household_population.offsets[composition+1]
+        block_size = end - start
+        self.no_compartments = no_compartments
+        self.states = household_population.states[start:end]
+        self.Q_int = household_population.Q_int[start:end, start:end]
+        self.import_model = import_model
+        self.max_step = max_step
+
+        in_block = (household_population.inf_event_row >= start) \
+            & (household_population.inf_event_row < end)
+        row = household_population.inf_event_row[in_block] - start
+        col = household_population.inf_event_col[in_block] - start
+        inf_class = household_population.inf_event_class[in_block].astype(int)
+        rate = self.states[row, no_compartments * inf_class]
+        self.import_generators = []
+        for k in range(household_population.no_risk_groups):
+            this_class = inf_class == k
+            self.import_generators.append(
+                sparse(
+                    (rate[this_class], (row[this_class], col[this_class])),
+                    shape=(block_size, block_size))
+                - sparse(
+                    (rate[this_class], (row[this_class], row[this_class])),
+                    shape=(block_size, block_size)))
+
+        # The transposed generator at any time is a linear combination of
+        # these, so it is held on one sparse pattern whose entries are
+        # recomputed from the import rates at each step
+        self.transposed_basis = [self.Q_int.T] + [
+            G.T for G in self.import_generators]
+        self.transposed_template, self.transposed_entries = \
+            sparse_combination(self.transposed_basis)
+        self.augmented_templates = {}
+
+    def _transposed_generator(self, t):
+        coefficients = concatenate(([1.0], self.import_model.cases(t)))
+        self.transposed_template.data = \
+            self.transposed_entries.dot(coefficients)
+        return self.transposed_template
+
+    def _augmented_template(self, no_params):
+        '''Returns the pattern and entries of the transposed generator
+        augmented with the sensitivities to no_params import parameters.
+        The basis holds Q_int and each unit-rate infection generator on the
+        block diagonal, then each infection generator in the sensitivity
+        block of each parameter.'''
+        if no_params not in self.augmented_templates:
+            no_blocks = no_params + 1
+            block_size = self.Q_int.shape[0]
+            basis = [
+                sparse_block_diag([M] * no_blocks)
+                for M in self.transposed_basis]
+            for p in range(no_params):
+                for G in self.import_generators:
+                    blocks = [
+                        [None] * no_blocks for _ in range(no_blocks)]
+                    for i in range(no_blocks):
+                        blocks[i][i] = sparse((block_size, block_size))
+                    blocks[p+1][0] = G.T
+                    basis.append(sparse_bmat(blocks))
+            self.augmented_templates[no_params] = sparse_combination(basis)
+        return self.augmented_templates[no_params]
+
+    def __call__(self, H, t_start, t_end):
+        '''Returns the columns of H propagated from t_start to t_end.'''
+        if self.import_model.time_invariant:
+            no_steps = 1
+        else:
+            no_steps = int(ceil((t_end - t_start) / self.max_step))
+        step = (t_end - t_start) / max(no_steps, 1)
+        for n in range(no_steps):
+            t_mid = t_start + (n + 0.5) * step
+            H = expm_multiply(step * self._transposed_generator(t_mid), H)
+        return H
+
+    def propagate_sensitivities(
+            self, H, S, t_start, t_end, case_derivatives):
+        '''Returns the columns of H and their derivatives S with respect to a
+        set of import parameters, propagated from t_start to t_end. S has one
+        leading entry per parameter, and case_derivatives(t) returns the
+        derivatives of the import model's cases with one row per parameter.
+        Each step solves the system augmented with the sensitivities
+        exactly, so S is the derivative of the propagated H.'''
+        no_params = len(S)
+        block_size = H.shape[0]
+        if self.import_model.time_invariant:
+            no_steps = 1
+        else:
+            no_steps = int(ceil((t_end - t_start) / self.max_step))
+        step = (t_end - t_start) / max(no_steps, 1)
+        template, entries = self._augmented_template(no_params)
+        for n in range(no_steps):
+            t_mid = t_start + (n + 0.5) * step
+            template.data = entries.dot(concatenate((
+                [1.0],
+                self.import_model.cases(t_mid),
+                case_derivatives(t_mid).ravel())))
+            X = expm_multiply(step * template, vstack((H,) + tuple(S)))
+            H = X[:block_size]
+            S = X[block_size:].reshape((no_params,) + H.shape)
+        return H, S
+
+
+class GroupedLikelihoodCalculation(LikelihoodCalculation):
+    '''Likelihood calculation which builds a single household population
+    holding each distinct composition in the data once per parameter set,
+    rather than a population per household. With no transmission between
+    households (epsilon=0) each household evolves independently under the
+    within-household dynamics of its composition and the imports, so all
+    households sharing a composition are propagated together as the columns
+    of one matrix, and each column is conditioned on its own tests.'''
+    def _process_households(self):
+        if self.epsilon != 0.0:
+            raise ValueError(
+                'Grouped likelihoods assume no transmission between households')
+        household_population = HouseholdPopulation(
+            self.composition_list,
+            self.composition_distribution,
+            self.model_input,
+            print_progress=False)
+        probabilities = [None] * len(self.households)
+        for i, group in enumerate(self.household_groups):
+            log_probs = self._compute_group_probabilities(
+                household_population,
+                i,
+                [self.households[h] for h in group])
+            for h, log_prob in zip(group, log_probs):
+                probabilities[h] = log_prob
+        return probabilities
+
+    def _compute_group_probabilities(
+            self, household_population, composition, households):
+        '''Returns the log-likelihood of the tests of each household in
+        households, all of which have the given composition, or None for
+        households whose tests are impossible under the model.'''
+        propagator = BatchedBlockPropagator(
+            household_population,
+            composition,
+            self.model_input.import_model)
+        no_compartments = household_population.num_of_epidemiological_compartments
+        states = propagator.states
+        block_size = len(states)
+
+        no_hh = len(households)
+        # Every household starts fully susceptible, so a single column is
+        # propagated up to the first test and then copied for each household
+        H = zeros((block_size, 1))
+        fully_sus = where(
+            states[:, ::no_compartments].sum(axis=1) == states.sum(axis=1))[0]
+        H[fully_sus, :] = 1
+        test_days = [h.get_test_days(self.t_first_test) for h in households]
+        log_probs = zeros((no_hh,))
+        feasible = ones((no_hh,), dtype=bool)
+
+        t_start = 0.0
+        for t_next_test in sorted(set(concatenate(test_days))):
+            H = propagator(H, t_start, t_next_test)
+            if H.shape[1] == 1:
+                H = repeat(H, no_hh, axis=1)
+            for j, household in enumerate(households):
+                if (not feasible[j]) or (t_next_test not in test_days[j]):
+                    continue
+                mask = household.get_test_mask(
+                    states,
+                    int(t_next_test) - self.t_first_test,
+                    self.observation_model)
+                result_prob = H[mask, j].sum()
+                H[~mask, j] = 0.0
+                if result_prob == 0.0:
+                    feasible[j] = False
+                    continue
+                log_probs[j] += log(result_prob)
+                H[:, j] = H[:, j] / result_prob
+            t_start = t_next_test
+        return [
+            log_prob if ok else None
+            for log_prob, ok in zip(log_probs, feasible)]
+
+
+class GradientLikelihoodFit(GroupedLikelihoodCalculation):
+    '''Maximum likelihood fitting of the import growth rate r and import
+    scale a. The gradient of the log-likelihood comes from forward
+    sensitivities of the household distributions with respect to r and a,
+    propagated alongside them and carried through the conditioning on each
+    test, so a gradient costs one augmented pass over the data. Only the
+    imports depend on r and a, so the household population, the
+    propagators and the observation masks are built once and shared by every
+    evaluation, and evaluations are remembered in case the optimiser returns
+    to a point.'''
+    def __init__(self, npz_file=None):
+        super().__init__(npz_file)
+        self.base_input = None
+        self.propagators = None
+        self.evaluations = {}
+
+    def set_parameters(self, r, a):
+        if self.base_input is None:
+            super().set_parameters(r, a)
+            self.base_input = self.model_input
+        self.model_input = copy(self.base_input)
+        self.model_input.import_model = ExponentialImportModel.make_from_spec(
+            {'exponent': r, 'alpha': a}, self.base_input.det)
+        self.r = r
+        self.a = a
+
+    def _build_propagators(self):
+        household_population = HouseholdPopulation(
+            self.composition_list,
+            self.composition_distribution,
+            self.model_input,
+            print_progress=False)
+        self.propagators = [
+            BatchedBlockPropagator(
+                household_population, i, self.model_input.import_model)
+            for i in range(len(self.composition_list))]
+
+    def case_derivatives(self, t):
+        '''Returns the derivatives of the import rates at time t with respect
+        to r and a.'''
+        cases = self.model_input.import_model.cases(t)
+        return array([t * cases, cases / self.a])
+
+    def log_likelihood_and_gradient(self, r, a):
+        '''Returns the log-likelihood at (r, a) and its gradient with respect
+        to r and a.'''
+        if (r, a) not in self.evaluations:
+            if self.epsilon != 0.0:
+                raise ValueError(
+                    'Grouped likelihoods assume no transmission between '
+                    'households')
+            self.set_parameters(r, a)
+            if self.propagators is None:
+                self._build_propagators()
+            log_likelihood = 0.0
+            gradient = zeros((2,))
+            for propagator, group in zip(
+                    self.propagators, self.household_groups):
+                propagator.import_model = self.model_input.import_model
+                for result in self._compute_group_gradients(
+                        propagator, [self.households[h] for h in group]):
+                    if result is not None:
+                        log_likelihood += result[0]
+                        gradient += result[1]
+            self.evaluations[(r, a)] = (log_likelihood, gradient)
+        return self.evaluations[(r, a)]
+
+    def fit(self, r0, a0, **options):
+        '''Returns the maximum likelihood estimate of (r, a) found by L-BFGS-B
+        starting from (r0, a0), and the optimiser result. The search is over
+        the logs of the parameters, which keeps them positive.'''
+        def objective(x):
+            log_likelihood, gradient = self.log_likelihood_and_gradient(
+                *exp(x))
+            return -log_likelihood, -gradient * exp(x)
+        result = minimize(
+            objective,
+            log([r0, a0]),
+            jac=True,
+            method='L-BFGS-B',
+            options=options)
+        return exp(result.x), result
+
+    def _compute_group_gradients(self, propagator, households):
+        '''Returns the log-likelihood and its gradient for each household in
+        households, all of which share the composition of propagator, or None
+        for households whose tests are impossible under the model.'''
+        no_compartments = propagator.no_compartments
+        states = propagator.states
+        block_size = len(states)
+        no_hh = len(households)
+        H = zeros((block_size, 1))
+        S = zeros((2, block_size, 1))
+        fully_sus = where(
+            states[:, ::no_compartments].sum(axis=1) == states.sum(axis=1))[0]
+        H[fully_sus, :] = 1
+        test_days = [h.get_test_days(self.t_first_test) for h in households]
+        log_probs = zeros((no_hh,))
+        gradients = zeros((no_hh, 2))
+        feasible = ones((no_hh,), dtype=bool)
+
+        t_start = 0.0
+        for t_next_test in sorted(set(concatenate(test_days))):
+            H, S = propagator.propagate_sensitivities(
+                H, S, t_start, t_next_test, self.case_derivatives)
+            if H.shape[1] == 1:
+                H = repeat(H, no_hh, axis=1)
+                S = repeat(S, no_hh, axis=2)
+            for j, household in enumerate(households):
+                if (not feasible[j]) or (t_next_test not in test_days[j]):
+                    continue
+                mask = household.get_test_mask(
+                    states,
+                    int(t_next_test) - self.t_first_test,
+                    self.observation_model)
+                result_prob = H[mask, j].sum()
+                H[~mask, j] = 0.0
+                S[:, ~mask, j] = 0.0
+                if result_prob == 0.0:
+                    feasible[j] = False
+                    continue
+                d_result_prob = S[:, mask, j].sum(axis=1)
+                log_probs[j] += log(result_prob)
+                gradients[j] += d_result_prob / result_prob
+                H[:, j] = H[:, j] / result_prob
+                S[:, :, j] = (
+                    S[:, :, j] - d_result_prob[:, None] * H[:, j]
+                    ) / result_prob
+            t_start = t_next_test
+        return [
+            (log_prob, gradient) if ok else None
+            for log_prob, gradient, ok in zip(log_probs, gradients, feasible)]
@@ -0,0 +1,16 @@
+'''In this example we fit the growth rate and scale of the exponential imports
+to the age-stratified testing data for Vo by maximum likelihood, using
+gradients from forward sensitivities instead of a grid search'''
+from pickle import dump
+from numpy import log
+from examples.vo.common import GradientLikelihoodFit
+
+
+if __name__ == '__main__':
+    calculator = GradientLikelihoodFit()
+    (r, alpha), result = calculator.fit(log(2) / 7, 1e-4)
+    print(
+        'Maximum likelihood estimate r={0}, alpha={1} found after {2} '
+        'likelihood evaluations'.format(r, alpha, result.nfev))
+    with open('vo_fit.pkl', 'wb') as f:
+        dump([r, alpha, result], f)
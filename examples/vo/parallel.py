@@ -1,15 +1,18 @@
 '''In this example we import the age-stratified testing data for Vo and run
 each household as an independent example with exponential imports'''
 from pickle import dump
-from numpy import log, zeros
+from time import time as get_time
+from numpy import array, log, unique, zeros
 from multiprocessing import Pool
 from tqdm import tqdm
-from examples.vo.common import LikelihoodCalculation
+from model.preprocessing import HouseholdPopulation
+from examples.vo.common import (
+    GroupedLikelihoodCalculation, LikelihoodCalculation)
 
 
 class MPLikelihoodCalculation(LikelihoodCalculation):
-    def __init__(self, no_of_workers):
-        super().__init__()
+    def __init__(self, no_of_workers, npz_file=None):
+        super().__init__(npz_file)
         self.no_of_workers = no_of_workers
 
     def _process_households(self):
@@ -26,17 +29,104 @@ class MPLikelihoodCalculation(LikelihoodCalculation):
         return likelihoods
 
 
+# Each worker of the grid pool holds its own calculator, set once when the
+# worker starts, so that tasks only carry indices
+_worker_calculator = None
+
+
+def _initialise_worker(calculator):
+    global _worker_calculator
+    _worker_calculator = calculator
+
+
+def _compute_task(task):
+    return _worker_calculator.compute_task(task)
+
+
+class GridLikelihoodScheduler(GroupedLikelihoodCalculation):
+    '''Evaluates the likelihood over a grid of (r, alpha) points with one
+    persistent pool. Every (point, composition) pair is a separate task, in
+    which all households of that composition are propagated together, so
+    workers move straight on to the next point instead of waiting for the
+    slowest composition of the current one. Tasks are handed out in small
+    chunks as workers become free, largest households first, so the long
+    solves start early and the short ones fill in the tail. Only the imports
+    change across the grid, so each worker keeps the model inputs of the
+    points it has seen and builds the population of each composition once.'''
+    def __init__(self, no_of_workers, chunksize=4, npz_file=None):
+        super().__init__(npz_file)
+        self.no_of_workers = no_of_workers
+        self.chunksize = chunksize
+        self.model_inputs = {}
+        self.populations = {}
+
+    def compute_task(self, task):
+        '''Returns the log-likelihoods of the households of one composition
+        at one grid point, with the time taken to compute them.'''
+        ir, ia, r, a, i = task
+        if (r, a) not in self.model_inputs:
+            self.set_parameters(r, a)
+            self.model_inputs[(r, a)] = self.model_input
+        self.model_input = self.model_inputs[(r, a)]
+        start = get_time()
+        if i not in self.populations:
+            self.populations[i] = HouseholdPopulation(
+                self.composition_list[[i]],
+                array([1.0]),
+                self.model_input,
+                print_progress=False)
+        probabilities = self._compute_group_probabilities(
+            self.populations[i],
+            0,
+            [self.households[h] for h in self.household_groups[i]])
+        return ir, ia, i, probabilities, get_time() - start
+
+    def grid(self, rs, alphas):
+        '''Returns an array of log-likelihoods over rs and alphas, and the
+        time taken by each (point, composition) task.'''
+        sizes = self.composition_list.sum(axis=1)
+        compositions = sorted(
+            range(len(self.composition_list)),
+            key=lambda i: sizes[i],
+            reverse=True)
+        tasks = [
+            (ir, ia, r, a, i)
+            for i in compositions
+            for ir, r in enumerate(rs)
+            for ia, a in enumerate(alphas)]
+
+        likelihoods = zeros((len(rs), len(alphas)))
+        task_times = zeros((len(rs), len(alphas), len(compositions)))
+        with Pool(
+                self.no_of_workers,
+                initializer=_initialise_worker,
+                initargs=(self,)) as pool:
+            for ir, ia, i, probabilities, task_time in tqdm(
+                    pool.imap_unordered(
+                        _compute_task, tasks, self.chunksize),
+                    desc='Calculating',
+                    total=len(tasks)):
+                likelihoods[ir, ia] += sum(
+                    prob for prob in probabilities if prob is not None)
+                task_times[ir, ia, i] = task_time
+
+        print('Total task time {0:.1f}s, longest task {1:.1f}s'.format(
+            task_times.sum(), task_times.max()))
+        for size in unique(sizes):
+            print('Households of size {0}: {1:.2f}s per task'.format(
+                size,
+                task_times[:, :, sizes == size].sum()
+                / (len(rs) * len(alphas) * (sizes == size).sum())))
+        return likelihoods, task_times
+
+
 if __name__ == '__main__':
-    calculator = MPLikelihoodCalculation(20)
+    calculator = GridLikelihoodScheduler(20)
     # These parameters worked much better for alpha alone
     # params = linspace(0.001, 0.015, 10)
     # For r
     rs = [log(2) / tau for tau in [2, 3, 7, 14, 21]]
     alphas = [1e-3, 1e-4, 1e-5]
-    likelihoods = zeros((len(rs), len(alphas)))
-
-    for ia, a in enumerate(alphas):
-        for ir, r in enumerate(rs):
-            likelihoods[ir, ia] = calculator(r, a)
+    likelihoods, task_times = calculator.grid(rs, alphas)
     with open('likelihoods.pkl', 'wb') as f:
         dump([rs, alphas, likelihoods], f)
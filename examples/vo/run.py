@@ -2,7 +2,8 @@
 each household as an independent example with exponential imports'''
 from numpy import log
 from tqdm import tqdm
-from examples.vo.common import LikelihoodCalculation
+from examples.vo.common import (
+    GroupedLikelihoodCalculation, LikelihoodCalculation)
 
 
 class SerialLikelihoodCalculation(LikelihoodCalculation):
@@ -16,7 +17,9 @@ class SerialLikelihoodCalculation(LikelihoodCalculation):
 
 
 if __name__ == '__main__':
-    calculator = SerialLikelihoodCalculation()
+    # Households sharing a composition are solved together, which gives the
+    # same likelihoods as SerialLikelihoodCalculation with far fewer builds
+    calculator = GroupedLikelihoodCalculation()
     # These parameters worked much better for alpha alone
     # params = linspace(0.001, 0.015, 10)
     likelihoods = [
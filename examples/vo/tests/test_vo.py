@@ -0,0 +1,159 @@
+'''Checks of the grouped Vo likelihood machinery against per-household
+solves'''
+from copy import deepcopy
+from numpy import array, full, log, nan, zeros
+from numpy.random import default_rng
+from numpy.testing import assert_allclose
+from scipy.integrate import solve_ivp
+from model.common import SEPIRRateEquations
+from model.imports import ExponentialImportModel, FixedImportModel
+from model.preprocessing import HouseholdPopulation, SEPIRInput, VoInput
+from model.specs import TWO_AGE_SEPIR_SPEC, TWO_AGE_UK_SPEC, VO_SPEC
+from examples.vo.parallel import GridLikelihoodScheduler
+from examples.vo.common import (
+    BatchedBlockPropagator, GradientLikelihoodFit,
+    GroupedLikelihoodCalculation, HouseholdTestData, observation_mask)
+# Imported under another name so that pytest does not try to collect it
+from examples.vo.common import TestObservationModel as ObservationModel
+
+SPEC = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+
+def make_population():
+    '''Returns a single composition SEPIR population with its model input'''
+    composition_list = array([[1, 2]])
+    composition_distribution = array([1.0])
+    model_input = SEPIRInput(SPEC, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list,
+        composition_distribution,
+        model_input,
+        print_progress=False)
+    return model_input, population
+
+def test_batched_propagator():
+    '''Check batched propagation matches solve_ivp household by household,
+    for constant and exponentially growing imports'''
+    model_input, population = make_population()
+    rng = default_rng(0)
+    H0 = rng.random((population.Q_int.shape[0], 3))
+    H0 = H0 / H0.sum(axis=0)
+    import_models = [
+        FixedImportModel(4, 2, array([1e-2, 2e-2])),
+        ExponentialImportModel(0.2, array([1e-3, 2e-3]), array([2e-3, 1e-3]))]
+    for import_model in import_models:
+        propagator = BatchedBlockPropagator(
+            population, 0, import_model, max_step=0.01)
+        rhs = SEPIRRateEquations(
+            model_input, population, import_model, epsilon=0.0)
+        H = propagator(H0, 1.0, 6.0)
+        for j in range(H0.shape[1]):
+            solution = solve_ivp(
+                rhs, (1.0, 6.0), H0[:, j], rtol=1e-10, atol=1e-12)
+            assert_allclose(H[:, j], solution.y[:, -1], atol=1e-6)
+
+def test_observation_masks():
+    '''Check cached observation masks match the directly computed ones on
+    every test day of a set of synthetic households'''
+    rng = default_rng(0)
+    observation_model = ObservationModel()
+    states_by_composition = {}
+    for _ in range(20):
+        ages = rng.choice([1, 3, 3, 6], size=rng.integers(1, 5))
+        symptoms = rng.choice(['yes', 'no'], size=len(ages))
+        tests = full((len(ages), 6), nan)
+        tests[:, ::2] = rng.integers(0, 2, size=(len(ages), 3))
+        household = HouseholdTestData(ages, symptoms, tests)
+        # Random states of each composition, with the symptomatic and
+        # asymptomatic counts in compartments 2 and 3 of each age class
+        composition = tuple(household.composition)
+        if composition not in states_by_composition:
+            states = zeros((50, 50))
+            for age, count in enumerate(composition):
+                symps = rng.integers(0, count + 1, size=50)
+                states[:, 5*age + 2] = symps
+                states[:, 5*age + 3] = rng.integers(0, count - symps + 1)
+            states_by_composition[composition] = states
+        states = states_by_composition[composition]
+        for test_index in [0, 2, 4]:
+            direct = household.get_test_mask(states, test_index)
+            cached = household.get_test_mask(
+                states, test_index, observation_model)
+            assert (cached == direct).all()
+            assert (direct == observation_mask(
+                states, household.get_observation(test_index))).all()
+
+def test_vo_likelihood(tmp_path):
+    '''Check a Vo household has the same likelihood alone and in a group'''
+    calculator = GroupedLikelihoodCalculation(
+        npz_file=str(tmp_path / 'vo_data.npz'))
+    assert (tmp_path / 'vo_data.npz').is_file()
+    spec = deepcopy(VO_SPEC)
+    spec['external_importation']['exponent'] = log(2) / 7
+    spec['external_importation']['alpha'] = 1e-4
+    calculator.model_input = VoInput(
+        spec, calculator.composition_list, calculator.composition_distribution)
+    model_input = calculator.model_input
+    assert model_input.k_home.shape == (10, 10)
+    assert_allclose(model_input.composition_distribution.sum(), 1.0)
+
+    sizes = calculator.composition_list.sum(axis=1)
+    i = list(sizes).index(2)
+    household = calculator.households[calculator.household_groups[i][0]]
+    population = HouseholdPopulation(
+        calculator.composition_list[[i]],
+        array([1.0]),
+        model_input,
+        print_progress=False)
+    grouped = calculator._compute_group_probabilities(
+        population, 0, [household])[0]
+    single = calculator.compute_probability(household)
+    assert single < 0.0
+    assert_allclose(grouped, single, rtol=1e-4)
+
+def restrict_to_small_households(calculator, size=1, no_comps=3):
+    '''Restricts a likelihood calculation to the no_comps compositions of
+    the given household size with the fewest households, to keep checks
+    quick'''
+    keep = sorted(
+        [
+            i for i, comp in enumerate(calculator.composition_list)
+            if comp.sum() == size],
+        key=lambda i: len(calculator.household_groups[i]))[:no_comps]
+    calculator.composition_list = calculator.composition_list[keep]
+    calculator.household_groups = [
+        calculator.household_groups[i] for i in keep]
+    group_sizes = array([len(group) for group in calculator.household_groups])
+    calculator.composition_distribution = group_sizes / group_sizes.sum()
+
+def test_grid_scheduler(tmp_path):
+    '''Check the pooled likelihood grid matches serial grouped likelihoods
+    at each grid point'''
+    npz_file = str(tmp_path / 'vo_data.npz')
+    scheduler = GridLikelihoodScheduler(2, npz_file=npz_file)
+    serial = GroupedLikelihoodCalculation(npz_file=npz_file)
+    restrict_to_small_households(scheduler)
+    restrict_to_small_households(serial)
+    rs = [log(2) / 7, log(2) / 3]
+    alphas = [1e-3, 1e-4]
+    likelihoods, task_times = scheduler.grid(rs, alphas)
+    assert task_times.shape == (2, 2, len(scheduler.composition_list))
+    for ir, r in enumerate(rs):
+        for ia, a in enumerate(alphas):
+            assert_allclose(likelihoods[ir, ia], serial(r, a), rtol=1e-10)
+
+def test_likelihood_gradient(tmp_path):
+    '''Check the sensitivity gradient of the log-likelihood against central
+    differences, and the log-likelihood against the grouped calculation'''
+    npz_file = str(tmp_path / 'vo_data.npz')
+    fit = GradientLikelihoodFit(npz_file=npz_file)
+    grouped = GroupedLikelihoodCalculation(npz_file=npz_file)
+    restrict_to_small_households(fit, size=2, no_comps=2)
+    restrict_to_small_households(grouped, size=2, no_comps=2)
+    r, a = log(2) / 5, 1e-3
+    log_likelihood, gradient = fit.log_likelihood_and_gradient(r, a)
+    assert_allclose(log_likelihood, grouped(r, a), rtol=1e-6)
+    for k, step in enumerate([1e-5 * r, 1e-5 * a]):
+        shift = array([step, 0.0]) if k == 0 else array([0.0, step])
+        upper = fit.log_likelihood_and_gradient(*(array([r, a]) + shift))[0]
+        lower = fit.log_likelihood_and_gradient(*(array([r, a]) - shift))[0]
+        assert_allclose(gradient[k], (upper - lower) / (2 * step), rtol=1e-5)
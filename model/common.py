@@ -1,7 +1,7 @@
 '''Module for additional computations required by the model'''
 from numpy import (
-    arange, array, atleast_2d, concatenate, copy, cumprod, diag, isnan, ix_,
-    ones, shape, sum, where, zeros)
+    arange, array, atleast_2d, bincount, concatenate, copy, cumprod, diag,
+    isin, isnan, ix_, ones, polyfit, prod, shape, sum, tensordot, where, zeros)
 from numpy import int64 as my_int
 import pdb
 from scipy.sparse import csc_matrix as sparse
@@ -944,6 +944,176 @@ class SEDURRateEquations(RateEquations):
         return self.household_population.states[:, 4::self.no_compartments]
 
 
+def _generator_from_rates(rows, cols, rates, total_size):
+    '''Returns the sparse generator with the given off-diagonal rates'''
+    Q = sparse((rates, (rows, cols)), shape=(total_size, total_size))
+    return Q - sparse((
+        Q.sum(axis=1).getA().squeeze(),
+        (arange(total_size), arange(total_size))),
+        shape=(total_size, total_size))
+
+
+class SensitivityEquations:
+    '''This class represents a functor for evaluating the rate equations
+    augmented with the sensitivities dH/dtheta of the household states to a
+    list of parameters. Each parameter theta multiplies a group of rates and
+    is differentiated at theta=1, so sensitivities are derivatives with
+    respect to the logarithm of the parameter. The parameters can be
+        'k_home': within-household transmission,
+        'k_ext': between-household transmission,
+        ('sus', i): susceptibility of risk group i,
+        ('rate', a, b): every transition moving one individual from
+            compartment a to compartment b, e.g. recovery or isolation.
+    Q_int is linear in each of these, so its derivatives are sparse matrices
+    picked out of Q_int once here, and one solve of the augmented system
+    gives local derivatives of any outcome along the whole trajectory.'''
+    # pylint: disable=invalid-name
+    def __init__(self, rhs, parameters):
+        if type(rhs).get_FOI_by_class is not RateEquations.get_FOI_by_class:
+            raise ValueError(
+                'Sensitivities need the standard force of infection, which '
+                '{0} overrides'.format(type(rhs).__name__))
+        self.rhs = rhs
+        self.parameters = list(parameters)
+        self.no_parameters = len(self.parameters)
+        household_population = rhs.household_population
+        self.total_size = len(household_population.which_composition)
+        self.no_classes = household_population.no_risk_groups
+        self.inf_event_row = household_population.inf_event_row
+        self.inf_event_col = household_population.inf_event_col
+        self.inf_event_class = household_population.inf_event_class
+        self.inf_event_sus = rhs.states_sus_only[
+            self.inf_event_row, self.inf_event_class]
+        self.Q_int_T = rhs.Q_int.T.tocsr()
+
+        Q = rhs.Q_int.tocoo()
+        off_diagonal = Q.row != Q.col
+        rows, cols, rates = \
+            Q.row[off_diagonal], Q.col[off_diagonal], Q.data[off_diagonal]
+        infection = isin(
+            rows * self.total_size + cols,
+            self.inf_event_row * self.total_size + self.inf_event_col)
+        # Every event moves one individual, so the compartments it moves
+        # them between are where the state changes by -1 and +1
+        change = household_population.states[cols] - \
+            household_population.states[rows]
+        from_compartment = change.argmin(axis=1) % rhs.no_compartments
+        to_compartment = change.argmax(axis=1) % rhs.no_compartments
+        infected_class = change.argmax(axis=1) // rhs.no_compartments
+
+        self.Q_derivatives_T = []
+        self.FOI_derivatives = zeros((self.no_parameters, self.no_classes))
+        for k, parameter in enumerate(self.parameters):
+            if parameter == 'k_home':
+                selected = infection
+            elif parameter == 'k_ext':
+                selected = zeros(len(rows), dtype=bool)
+                self.FOI_derivatives[k, :] = 1
+            elif parameter[0] == 'sus':
+                selected = infection & (infected_class == parameter[1])
+                self.FOI_derivatives[k, parameter[1]] = 1
+            elif parameter[0] == 'rate':
+                selected = (~infection) \
+                    & (from_compartment == parameter[1]) \
+                    & (to_compartment == parameter[2])
+            else:
+                raise ValueError(
+                    'Unknown sensitivity parameter {0}'.format(parameter))
+            self.Q_derivatives_T.append(_generator_from_rates(
+                rows[selected],
+                cols[selected],
+                rates[selected],
+                self.total_size).T.tocsr())
+
+    def initial_condition(self, H0):
+        '''Returns the augmented state for initial condition H0, which is
+        assumed not to depend on the parameters'''
+        return concatenate((H0, zeros(self.no_parameters * self.total_size)))
+
+    def split(self, y):
+        '''Splits an augmented state, or a solution with one column per
+        time, into H and the sensitivities indexed by parameter first'''
+        return y[:self.total_size], y[self.total_size:].reshape(
+            (self.no_parameters, self.total_size) + y.shape[1:])
+
+    def __call__(self, t, y):
+        H, S = self.split(y)
+        if isnan(y).any():
+            raise ValueError('State vector contains NaNs at t={0}'.format(t))
+        H = H.clip(min=0)
+        transmission, transmission_derivatives = \
+            self._transmission_by_class(H, S)
+        FOI = self.rhs.import_model.cases(t) + transmission
+        dH = self.Q_int_T.dot(H) + self._external_flow(H, FOI)
+        dS = self.Q_int_T.dot(S.T).T
+        for k in range(self.no_parameters):
+            dS[k] += self._external_flow(S[k], FOI) \
+                + self._external_flow(
+                    H,
+                    transmission_derivatives[k]
+                    + self.FOI_derivatives[k] * transmission) \
+                + self.Q_derivatives_T[k].dot(H)
+        return concatenate((dH, dS.ravel()))
+
+    def _transmission_by_class(self, H, S):
+        '''Returns the between-household force of infection on each class
+        and its derivatives along each of the sensitivities S'''
+        rhs = self.rhs
+        denom = H.dot(rhs.composition_by_state)
+        denom_derivatives = S.dot(rhs.composition_by_state)
+        present = denom > 0
+        transmission = zeros(self.no_classes)
+        derivatives = zeros((self.no_parameters, self.no_classes))
+        for ic in range(rhs.no_inf_compartments):
+            inf_by_class = zeros(self.no_classes)
+            inf_by_class[present] = \
+                H.dot(rhs.inf_by_state_list[ic])[present] / denom[present]
+            inf_derivatives = zeros((self.no_parameters, self.no_classes))
+            inf_derivatives[:, present] = (
+                S.dot(rhs.inf_by_state_list[ic])[:, present]
+                - inf_by_class[present] * denom_derivatives[:, present]) \
+                / denom[present]
+            transmission += rhs.epsilon * \
+                rhs.ext_matrix_list[ic].dot(inf_by_class)
+            derivatives += rhs.epsilon * \
+                inf_derivatives.dot(rhs.ext_matrix_list[ic].T)
+        return transmission, derivatives
+
+    def _external_flow(self, H, FOI):
+        '''Returns H.Q_ext for a force of infection FOI on each class'''
+        flow = H[self.inf_event_row] * self.inf_event_sus \
+            * FOI[self.inf_event_class]
+        return bincount(self.inf_event_col, flow, self.total_size) \
+            - bincount(self.inf_event_row, flow, self.total_size)
+
+    def outcome_sensitivities(self, y, outcome):
+        '''Returns an outcome, given as its value in each household state,
+        along a solution and its derivatives with respect to each
+        parameter'''
+        H, S = self.split(y)
+        return outcome.dot(H), tensordot(outcome, S, axes=(0, 1))
+
+    def peak_sensitivities(self, t, y, outcome):
+        '''Returns the peak of an outcome along a solution at times t and
+        its derivatives. The peak time is refined by fitting a parabola
+        through the largest value and its neighbours. At the peak the outcome
+        is stationary in time, so moving the peak time does not change it to
+        first order and its derivatives are those at the peak time.'''
+        values, derivatives = self.outcome_sensitivities(y, outcome)
+        peak = values.argmax()
+        if (peak == 0) or (peak == len(t) - 1):
+            return values[peak], derivatives[:, peak]
+        nodes = t[peak-1:peak+2]
+        a, b, _ = polyfit(nodes, values[peak-1:peak+2], 2)
+        peak_time = - b / (2 * a)
+        weights = array([
+            prod([
+                (peak_time - nodes[j]) / (nodes[i] - nodes[j])
+                for j in range(3) if j != i])
+            for i in range(3)])
+        return values[peak-1:peak+2].dot(weights), \
+            derivatives[:, peak-1:peak+2].dot(weights)
+
 class OldFormatSEPIRQRateEquations:
     '''This class represents a functor for evaluating the rate equations for
     the model with no imports of infection from outside the population. The
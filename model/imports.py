@@ -1,7 +1,6 @@
 '''Class structure describing external importations'''
 from abc import ABC
-from numpy import exp, ones, zeros
-from scipy.interpolate import interp1d
+from numpy import asarray, exp, inf, ndim, ones, searchsorted, stack, zeros
 
 def import_model_from_spec(spec, det):
     text_to_type = {
@@ -16,6 +15,10 @@ def import_model_from_spec(spec, det):
 
 class ImportModel(ABC):
     '''Abstract class for importation models'''
+    # Import models whose cases do not change over time set this, so that
+    # solvers can treat the external infection rates as constant
+    time_invariant = False
+
     def __init__(self,
                 no_inf_compartments,
                 no_age_classes):
@@ -27,6 +30,8 @@ class ImportModel(ABC):
 
 
 class NoImportModel(ImportModel):
+    time_invariant = True
+
     def cases(self, t):
         return zeros(self.no_age_classes,)
 
@@ -36,6 +41,8 @@ class NoImportModel(ImportModel):
 
 
 class FixedImportModel(ImportModel):
+    time_invariant = True
+
     def __init__(
             self,
             no_inf_compartments,
@@ -51,25 +58,54 @@ class FixedImportModel(ImportModel):
     def cases(self, t):
         return self.import_array
 
+class TimeGridInterpolant:
+    '''Nearest neighbour interpolation in time of an array whose last axis
+    runs over a sorted grid of times, extrapolating with the end values. This
+    gives the same values as interp1d with kind='nearest', but looks up every
+    entry with a single searchsorted call, accepts arrays of times, and
+    remembers the interval of the last scalar evaluation since consecutive
+    solver steps usually land in the same one.'''
+    def __init__(self, time, values):
+        self.time = asarray(time, dtype=float)
+        self.values = asarray(values)
+        if self.values.shape[-1] != len(self.time):
+            raise ValueError(
+                'Last axis of values has length {0} but there are {1} '
+                'times'.format(self.values.shape[-1], len(self.time)))
+        # Values switch at the midpoints between consecutive grid times
+        self.switch_times = 0.5 * (self.time[1:] + self.time[:-1])
+        self.last_interval = (inf, -inf, 0)
+
+    def index(self, t):
+        return searchsorted(self.switch_times, t, side='left')
+
+    def __call__(self, t):
+        if ndim(t) > 0:
+            return self.values[..., self.index(t)]
+        lower, upper, i = self.last_interval
+        if not lower < t <= upper:
+            i = self.index(t)
+            lower = self.switch_times[i-1] if i > 0 else -inf
+            upper = self.switch_times[i] if i < len(self.switch_times) else inf
+            self.last_interval = (lower, upper, i)
+        return self.values[..., i]
+
+
 class StepImportModel(ImportModel):
     def __init__(
             self,
+            no_inf_compartments,
+            no_age_classes,
             time,
-            external_prevalance):       # External prevalence is now a age classes by inf compartments array
-        self.prevalence_interpolant = []
-        for i in range(self.no_entries):
-            self.prevalence_interpolant.append(interp1d(
-                time, external_prevalance[i,:],
-                kind='nearest',
-                bounds_error=False,
-                fill_value='extrapolate',
-                assume_sorted=True))
+            import_rates):
+        '''import_rates is a no_age_classes by len(time) array whose jth row
+        is the rate at which individuals in age class j are infected by
+        external cases at each of the times in the sorted array time.'''
+        super().__init__(no_inf_compartments, no_age_classes)
+        self.import_interpolant = TimeGridInterpolant(time, import_rates)
 
     def cases(self, t):
-        imports = zeros(no_entries,)
-        for i in range(self.no_entries):
-            imports[i] = self.prevalence_interpolant[i](t)
-        return imports
+        return self.import_interpolant(t)
 
 
 class ExponentialImportModel(ImportModel):
@@ -83,7 +119,7 @@ class ExponentialImportModel(ImportModel):
         r = float(spec['exponent'])
         alpha = float(spec['alpha'])
         det_profile = alpha * det
-        undet_profile = alpha * (ones((10,)) - det)
+        undet_profile = alpha * (1 - det)
         return cls(r, det_profile, undet_profile)
 
     def detected(self, t):
@@ -92,27 +128,22 @@ class ExponentialImportModel(ImportModel):
     def undetected(self, t):
         return exp(self.r * t) * self.undet_profile
 
+    def cases(self, t):
+        return self.detected(t) + self.undetected(t)
+
 class CareHomeImportModel(ImportModel):
     def __init__(
             self,
             time,
             prodromal_prev,
             infected_prev):
-        self.prodromal_interpolant = interp1d(
-            time, prodromal_prev,
-            kind='nearest',
-            bounds_error=False,
-            fill_value='extrapolate',
-            assume_sorted=True)
-        self.infected_interpolant = interp1d(
-            time, infected_prev,
-            kind='nearest',
-            bounds_error=False,
-            fill_value='extrapolate',
-            assume_sorted=True)
+        # Both prevalences share one interpolant so that the second lookup at
+        # a given time hits the cached interval
+        self.prevalence_interpolant = TimeGridInterpolant(
+            time, stack((prodromal_prev, infected_prev)))
 
     def prodromal(self, t):
-        return self.prodromal_interpolant(t)
+        return self.prevalence_interpolant(t)[0]
 
     def infected(self, t):
-        return self.infected_interpolant(t)
+        return self.prevalence_interpolant(t)[1]
@@ -1,20 +1,26 @@
 '''Various functions and classes that help build the model'''
 from abc import ABC
 from copy import copy, deepcopy
+from os.path import getmtime, isfile, splitext
 from numpy import (
         append, arange, around, array, cumsum, log, ndarray, ones, ones_like,
         where, zeros, concatenate, vstack, identity, tile, hstack, prod, ix_,
-        shape, atleast_2d, diag)
-from numpy.linalg import eig, inv
-from scipy.sparse import block_diag
-from scipy.special import binom as binom_coeff
+        shape, atleast_2d, diag, asarray, setdiff1d, allclose, bincount, exp,
+        unique)
+from numpy import load as load_npz, savez_compressed
+from numpy.linalg import eig, eigvals, inv
+from scipy.sparse import block_diag, vstack as sparse_vstack
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+from scipy.sparse.linalg import splu
+from scipy.special import binom as binom_coeff, gammaln
 from scipy.stats import binom
 from pandas import read_excel, read_csv
 from tqdm import tqdm
 from model.common import (
         within_household_spread, sparse, my_int, build_state_matrix)
 from model.imports import import_model_from_spec, NoImportModel
-from model.subsystems import subsystem_key
+from model.subsystems import (
+        single_class_subsystem, single_class_key, subsystem_key)
 
 
 def initialise_carehome(
@@ -35,6 +41,93 @@ def initialise_carehome(
     return H0
 
 
+def stationary_block_distribution(Q_block, start=None):
+    '''Returns the stationary distribution of the Markov chain with
+    generator Q_block, normalised to sum to one. We solve Q_block.T h = 0 by
+    sparse LU decomposition, with the last balance equation replaced by the
+    normalisation condition sum(h) = 1.
+
+    If the chain is reducible, e.g. a care home with no exits has an
+    absorbing state for every way its residents can end up, the stationary
+    distribution is only unique given where the chain starts. We then return
+    the stationary distribution on the closed class reached from the state
+    start, which must be given and must reach exactly one closed class.'''
+    block_size = Q_block.shape[0]
+    if block_size == 1:
+        return ones(1)
+    Q_block = sparse(Q_block).tocoo()
+    off_diagonal = (Q_block.row != Q_block.col) & (Q_block.data != 0)
+    transitions = sparse((
+        ones(off_diagonal.sum()),
+        (Q_block.row[off_diagonal], Q_block.col[off_diagonal])),
+        shape=(block_size, block_size))
+    no_classes, labels = connected_components(
+        transitions, directed=True, connection='strong')
+    if no_classes == 1:
+        recurrent = arange(block_size)
+    else:
+        if start is None:
+            raise ValueError(
+                'Generator is reducible, so its stationary distribution '
+                'depends on the initial state - pass start to pick one')
+        leaving = labels[Q_block.row[off_diagonal]] \
+            != labels[Q_block.col[off_diagonal]]
+        open_classes = labels[Q_block.row[off_diagonal][leaving]]
+        reachable = breadth_first_order(
+            transitions, start, directed=True, return_predecessors=False)
+        closed = setdiff1d(labels[reachable], open_classes)
+        if len(closed) != 1:
+            raise ValueError(
+                'State {0} reaches {1} closed classes, so the stationary '
+                'distribution is not unique'.format(start, len(closed)))
+        recurrent = where(labels == closed[0])[0]
+    h = zeros(block_size)
+    if len(recurrent) == 1:
+        h[recurrent] = 1
+        return h
+    Q_recurrent = Q_block.tocsr()[recurrent, :][:, recurrent]
+    A = sparse_vstack((
+        Q_recurrent.T[:-1, :],
+        sparse(ones((1, len(recurrent)))))).tocsc()
+    b = zeros(len(recurrent))
+    b[-1] = 1
+    h[recurrent] = splu(A).solve(b)
+    # Clean up round-off error
+    h[h < 0] = 0
+    return h / h.sum()
+
+
+def get_equilibrium_distribution(household_population, Q=None):
+    '''Returns the equilibrium distribution of household states under the
+    within-household dynamics, i.e. the solution of H.Q = 0 with the total
+    probability in each composition block given by composition_distribution.
+    By default Q is the internal transition matrix Q_int of the population.
+    This replaces integrating the rate equations over a long time horizon
+    when setting up, for instance, the empty bed equilibrium in care
+    homes. Where a block has more than one closed class, we take the one
+    its fully susceptible households end up in.'''
+    if Q is None:
+        Q = household_population.Q_int
+    Q = sparse(Q)
+    offsets = household_population.offsets
+    states = getattr(household_population, 'states', None)
+    H = zeros(offsets[-1])
+    for i in range(len(offsets) - 1):
+        block = slice(offsets[i], offsets[i+1])
+        if states is None:
+            start = None
+        else:
+            no_compartments = \
+                household_population.num_of_epidemiological_compartments
+            block_states = states[block]
+            start = where(
+                block_states[:, ::no_compartments].sum(axis=1)
+                == block_states.sum(axis=1))[0][0]
+        H[block] = household_population.composition_distribution[i] * \
+            stationary_block_distribution(Q[block, block], start)
+    return H
+
+
 def make_initial_condition(
         household_population,
         rhs,
@@ -245,6 +338,133 @@ def aggregate_vector_quantities(v_fine, fine_bds, coarse_bds, pyramid):
     return pop_weight_matrix * v_fine
 
 
+# Process-wide caches of parsed input files. The contact matrix spreadsheets
+# are slow to parse, and sweeps construct a new model input for every
+# parameter point, so we only ever read each sheet once per process.
+_RAW_CONTACT_MATRIX_CACHE = {}
+_AGGREGATED_CONTACT_MATRIX_CACHE = {}
+_POP_PYRAMID_CACHE = {}
+
+
+def _header_code(header):
+    '''Encodes the header argument of read_excel as an integer so that it can
+    be stored alongside the matrices in an npz file'''
+    return -1 if header is None else header
+
+
+def contact_matrix_store_name(file_name, header=None):
+    '''Returns the location of the compact npz store corresponding to a
+    contact matrix spreadsheet read with the given header. Each header gets
+    its own store, so callers reading the same spreadsheet with different
+    headers do not keep rebuilding each other's store.'''
+    if header is None:
+        return splitext(file_name)[0] + '.npz'
+    return splitext(file_name)[0] + '_header{0}.npz'.format(header)
+
+
+def convert_contact_matrices_to_npz(file_name, header=None):
+    '''Reads every sheet of a contact matrix spreadsheet and saves them into
+    a compressed npz store next to it, keyed by sheet name. Once the store
+    exists, read_contact_matrix uses it instead of parsing the spreadsheet.'''
+    sheets = read_excel(file_name, sheet_name=None, header=header)
+    matrices = {
+        sheet_name: df.to_numpy(dtype=float)
+        for sheet_name, df in sheets.items()}
+    store_name = contact_matrix_store_name(file_name, header)
+    savez_compressed(
+        store_name,
+        __header__=array(_header_code(header)),
+        **matrices)
+    return store_name
+
+
+def read_contact_matrix(file_name, sheet_name, header=None):
+    '''Returns a single contact matrix from the Prem et al. spreadsheets.
+    Results are cached for the lifetime of the process, and we read from an
+    npz store built by convert_contact_matrices_to_npz whenever one is
+    available, so that the spreadsheet (and the Excel reader) is only touched
+    when no other source exists. A store older than its spreadsheet is
+    rebuilt first.'''
+    key = (file_name, sheet_name, header)
+    if key not in _RAW_CONTACT_MATRIX_CACHE:
+        matrix = None
+        store_name = contact_matrix_store_name(file_name, header)
+        if isfile(store_name) and isfile(file_name) and \
+                (getmtime(file_name) > getmtime(store_name)):
+            # The spreadsheet has changed since the store was built
+            convert_contact_matrices_to_npz(file_name, header)
+        if isfile(store_name):
+            with load_npz(store_name) as store:
+                if (store['__header__'] == _header_code(header)) and \
+                        (sheet_name in store.files):
+                    matrix = store[sheet_name]
+        if matrix is None:
+            matrix = read_excel(
+                file_name,
+                sheet_name=sheet_name,
+                header=header).to_numpy()
+        _RAW_CONTACT_MATRIX_CACHE[key] = matrix
+    return _RAW_CONTACT_MATRIX_CACHE[key].copy()
+
+
+def read_pop_pyramid(file_name):
+    '''Returns the total (female plus male) population pyramid stored in
+    file_name, cached for the lifetime of the process'''
+    if file_name not in _POP_PYRAMID_CACHE:
+        pop_pyramid = read_csv(file_name, index_col=0)
+        _POP_PYRAMID_CACHE[file_name] = \
+            (pop_pyramid['F'] + pop_pyramid['M']).to_numpy()
+    # Aggregation functions modify the pyramid in place, so hand out a copy
+    return _POP_PYRAMID_CACHE[file_name].copy()
+
+
+def load_aggregated_contact_matrix(
+        matrix_spec,
+        fine_bds,
+        coarse_bds,
+        pop_pyramid_file_name,
+        header=None):
+    '''Returns the contact matrix described by matrix_spec (a dictionary
+    with file_name and sheet_name entries) aggregated from fine_bds to
+    coarse_bds using the population pyramid in pop_pyramid_file_name.
+    Aggregated matrices are cached so repeated model input construction only
+    pays for a dictionary lookup.'''
+    key = (
+        matrix_spec['file_name'],
+        matrix_spec['sheet_name'],
+        header,
+        tuple(fine_bds),
+        tuple(coarse_bds),
+        pop_pyramid_file_name)
+    if key not in _AGGREGATED_CONTACT_MATRIX_CACHE:
+        _AGGREGATED_CONTACT_MATRIX_CACHE[key] = aggregate_contact_matrix(
+            read_contact_matrix(
+                matrix_spec['file_name'],
+                matrix_spec['sheet_name'],
+                header),
+            fine_bds,
+            coarse_bds,
+            read_pop_pyramid(pop_pyramid_file_name))
+    return _AGGREGATED_CONTACT_MATRIX_CACHE[key].copy()
+
+
+_SPECTRAL_RADIUS_CACHE = {}
+
+
+def spectral_radius(matrix):
+    '''Returns the spectral radius of a small dense matrix. For the
+    non-negative next generation matrices used to calibrate the contact
+    matrices this is the dominant eigenvalue, which is real, so we avoid
+    taking the max over complex eigenvalues. Results are memoised on the
+    matrix entries so inputs built from the same matrices and parameters only
+    do the eigendecomposition once.'''
+    matrix = asarray(matrix, dtype=float)
+    key = (matrix.shape, matrix.tobytes())
+    if key not in _SPECTRAL_RADIUS_CACHE:
+        _SPECTRAL_RADIUS_CACHE[key] = float(abs(eigvals(matrix)).max())
+    return _SPECTRAL_RADIUS_CACHE[key]
+
+
 def add_vulnerable_hh_members(
         composition_list, composition_distribution, vuln_prop):
     '''Create a version of the adult-child composition list and distribution
@@ -335,9 +555,23 @@ class HouseholdPopulation(ABC):
                 desc='Building within-household transmission matrix')
         else:
             progress_bar = household_subsystem_specs
-        model_parts = [
-            self.subsystem_function(self,s)
-            for s in progress_bar]
+        if (self.no_risk_groups == 1) and \
+                (self.compartmental_structure in single_class_key):
+            # Single class households only differ by size, so each size is
+            # built once. Assembly shifts the index vectors, so every
+            # household gets its own copy.
+            parts_by_size = {}
+            model_parts = []
+            for s in progress_bar:
+                class_size = s.composition[0]
+                if class_size not in parts_by_size:
+                    parts_by_size[class_size] = single_class_subsystem(self, s)
+                part = parts_by_size[class_size]
+                model_parts.append(part[:6] + (part[6].copy(),))
+        else:
+            model_parts = [
+                self.subsystem_function(self,s)
+                for s in progress_bar]
 
         self._assemble_system(household_subsystem_specs, model_parts)
 
@@ -388,6 +622,345 @@ class HouseholdPopulation(ABC):
     def composition_by_state(self):
         return self.composition_list[self.which_composition, :]
 
+    def with_distribution(self, composition_distribution):
+        '''Returns a view of this population with a new distribution over the
+        same compositions. Within-household dynamics do not depend on how
+        common each composition is, so Q_int, the states and the event arrays
+        are shared rather than rebuilt, and the view keeps this population's
+        model input.'''
+        composition_distribution = asarray(composition_distribution)
+        if len(composition_distribution) != self.no_compositions:
+            raise ValueError(
+                'Expected a distribution over {0} compositions, got {1}'.format(
+                    self.no_compositions, len(composition_distribution)))
+        view = copy(self)
+        view.composition_distribution = composition_distribution
+        view.ave_hh_size = composition_distribution.T.dot(
+            self.composition_list.sum(axis=1))
+        return view
+
+
+class CombinedHouseholdPopulation:
+    '''A population made of several household populations, e.g. vaccinated
+    and unvaccinated copies of the same care homes, with a weighting for
+    each. The member populations are only referenced, never modified, and
+    the combined Q_int, states and event arrays are assembled in one pass
+    the first time they are used. Variants with new weightings share
+    everything but the composition distribution.'''
+    def __init__(self, populations, weightings):
+        if len(populations) != len(weightings):
+            raise ValueError(
+                'Expected one weighting for each of {0} populations, '
+                'got {1}'.format(len(populations), len(weightings)))
+        first = populations[0]
+        for population in populations[1:]:
+            if (population.compartmental_structure
+                    != first.compartmental_structure) or \
+                    (population.no_risk_groups != first.no_risk_groups):
+                raise ValueError(
+                    'Combined populations must share their compartmental '
+                    'structure and risk groups')
+        self.populations = list(populations)
+        self.weightings = asarray(weightings)
+        self.model_input = first.model_input
+        self.compartmental_structure = first.compartmental_structure
+        self.num_of_epidemiological_compartments = \
+            first.num_of_epidemiological_compartments
+        self.no_risk_groups = first.no_risk_groups
+        self.state_offsets = cumsum([0] + [
+            len(population.which_composition) for population in populations])
+        self.composition_offsets = cumsum([0] + [
+            population.no_compositions for population in populations])
+        self.no_compositions = self.composition_offsets[-1]
+        self._assembled = {}
+
+    def _assemble(self, name, build):
+        '''Returns the combined array called name, building it on first use.
+        The store is shared with variants made by with_weightings.'''
+        if name not in self._assembled:
+            self._assembled[name] = build()
+        return self._assembled[name]
+
+    def _concatenated(self, attribute, shifts):
+        return concatenate([
+            getattr(population, attribute) + shift
+            for population, shift in zip(self.populations, shifts)])
+
+    @property
+    def Q_int(self):
+        return self._assemble('Q_int', lambda: block_diag(
+            [population.Q_int for population in self.populations],
+            format='csc'))
+
+    @property
+    def states(self):
+        return self._assemble('states', lambda: vstack([
+            population.states for population in self.populations]))
+
+    @property
+    def composition_list(self):
+        return self._assemble('composition_list', lambda: vstack([
+            population.composition_list for population in self.populations]))
+
+    @property
+    def which_composition(self):
+        return self._assemble('which_composition', lambda: self._concatenated(
+            'which_composition', self.composition_offsets))
+
+    @property
+    def inf_event_row(self):
+        return self._assemble('inf_event_row', lambda: self._concatenated(
+            'inf_event_row', self.state_offsets))
+
+    @property
+    def inf_event_col(self):
+        return self._assemble('inf_event_col', lambda: self._concatenated(
+            'inf_event_col', self.state_offsets))
+
+    @property
+    def inf_event_class(self):
+        return self._assemble('inf_event_class', lambda: self._concatenated(
+            'inf_event_class', zeros(len(self.populations), dtype=my_int)))
+
+    @property
+    def system_sizes(self):
+        return self._assemble('system_sizes', lambda: self._concatenated(
+            'system_sizes', zeros(len(self.populations), dtype=my_int)))
+
+    @property
+    def offsets(self):
+        return self._assemble('offsets', lambda: append(
+            concatenate([
+                population.offsets[:-1] + shift
+                for population, shift in zip(
+                    self.populations, self.state_offsets)]),
+            self.state_offsets[-1]))
+
+    @property
+    def cum_sizes(self):
+        return self.offsets[1:]
+
+    @property
+    def reverse_prod(self):
+        return [
+            reverse_prod
+            for population in self.populations
+            for reverse_prod in population.reverse_prod]
+
+    @property
+    def composition_distribution(self):
+        return concatenate([
+            weighting * population.composition_distribution
+            for population, weighting in zip(
+                self.populations, self.weightings)])
+
+    @property
+    def ave_hh_size(self):
+        return self.composition_distribution.dot(
+            self.composition_list.sum(axis=1))
+
+    @property
+    def composition_by_state(self):
+        return self.composition_list[self.which_composition, :]
+
+    def population_slice(self, i):
+        '''Returns the slice of the combined states belonging to the i-th
+        member population'''
+        return slice(self.state_offsets[i], self.state_offsets[i+1])
+
+    def with_weightings(self, weightings):
+        '''Returns the same combination of populations with new weightings,
+        sharing the assembled system with this one'''
+        weightings = asarray(weightings)
+        if len(weightings) != len(self.populations):
+            raise ValueError(
+                'Expected one weighting for each of {0} populations, '
+                'got {1}'.format(len(self.populations), len(weightings)))
+        variant = copy(self)
+        variant.weightings = weightings
+        return variant
+
+
+def _lumped_blocks(household_population, groups):
+    '''Returns the lumped state of each state, i.e. its composition with the
+    number of members of each group of classes in each compartment, as the
+    index of a block of states, the first state in each block, and the
+    group counts in each block'''
+    no_compartments = household_population.num_of_epidemiological_compartments
+    states = household_population.states.reshape(
+        -1, household_population.no_risk_groups, no_compartments)
+    keys = concatenate(
+        [household_population.which_composition.reshape(-1, 1)] + [
+            states[:, group, :].sum(axis=1) for group in groups],
+        axis=1).astype(my_int)
+    lumped, first, block = unique(
+        keys, axis=0, return_index=True, return_inverse=True)
+    return block.ravel(), first, lumped[:, 1:]
+
+
+def _lumped_generator(Q_int, block, first, tol):
+    '''Returns the generator of the lumped chain, or None if Q_int is not
+    lumpable, i.e. if states in the same block have different total rates
+    into some other block'''
+    total_size = len(block)
+    membership = sparse(
+        (ones(total_size), (arange(total_size), block)),
+        shape=(total_size, len(first)))
+    to_blocks = Q_int.dot(membership).tocsr()
+    lumped_Q = to_blocks[first, :]
+    discrepancy = to_blocks - membership.dot(lumped_Q)
+    if discrepancy.nnz and \
+            abs(discrepancy).max() > tol * abs(Q_int).max():
+        return None
+    return lumped_Q.tocsc()
+
+
+def _external_rows_match(model_input, groups):
+    '''Checks that every member of each group has the same susceptibility
+    to infection from other households'''
+    external = diag(model_input.sus).dot(model_input.k_ext)
+    return all(
+        allclose(external[group[0]], external[c])
+        for group in groups for c in group[1:])
+
+
+def exchangeable_classes(household_population, tol=1e-10):
+    '''Returns a partition of the classes of household_population into groups
+    of exchangeable classes, i.e. classes whose members can be relabelled as
+    one another without changing the distribution of any household. Classes
+    are added to the first group they are exchangeable with, which is
+    checked on Q_int itself, so that differences in any parameter, including
+    contact densities through density_expo, are taken into account.'''
+    model_input = household_population.model_input
+    no_classes = household_population.no_risk_groups
+    groups = []
+    for c in range(no_classes):
+        for group in groups:
+            candidate = [
+                g + [c] if g is group else g for g in groups] + [
+                [d] for d in range(c + 1, no_classes)]
+            if not _external_rows_match(model_input, candidate):
+                continue
+            block, first, _ = _lumped_blocks(household_population, candidate)
+            if _lumped_generator(
+                    household_population.Q_int, block, first, tol) is not None:
+                group.append(c)
+                break
+        else:
+            groups.append([c])
+    return groups
+
+
+class LumpedHouseholdPopulation:
+    '''A household population in which the classes of each group, e.g. two
+    classes with identical parameters, are merged, so that a state only
+    records the number of members of each group in each compartment. By
+    default the groups are found with exchangeable_classes.
+
+    The states of the lumped population hold the expected number of members
+    of each class in each compartment, so the rate equations of the original
+    population can be solved on it unchanged, provided imports are the same
+    for every class in a group. Within each lumped state the members of a
+    group are then spread over its classes uniformly at random, so lift
+    recovers the distribution over the original states exactly whenever the
+    initial condition is of this form, e.g. fully susceptible households.'''
+    def __init__(self, household_population, groups=None, tol=1e-10):
+        no_classes = household_population.no_risk_groups
+        if groups is None:
+            groups = exchangeable_classes(household_population, tol)
+        groups = [list(group) for group in groups]
+        if sorted(c for group in groups for c in group) != \
+                list(range(no_classes)):
+            raise ValueError(
+                'Groups must partition the {0} classes, got {1}'.format(
+                    no_classes, groups))
+        model_input = household_population.model_input
+        block, first, lumped_states = _lumped_blocks(
+            household_population, groups)
+        Q_int = _lumped_generator(
+            household_population.Q_int, block, first, tol)
+        if (Q_int is None) or not _external_rows_match(model_input, groups):
+            raise ValueError(
+                'Classes in groups {0} are not exchangeable'.format(groups))
+
+        self.household_population = household_population
+        self.groups = groups
+        self.model_input = model_input
+        self.compartmental_structure = \
+            household_population.compartmental_structure
+        no_compartments = household_population.num_of_epidemiological_compartments
+        self.num_of_epidemiological_compartments = no_compartments
+        self.no_risk_groups = no_classes
+        self.composition_list = household_population.composition_list
+        self.composition_distribution = \
+            household_population.composition_distribution
+        self.ave_hh_size = household_population.ave_hh_size
+        self.no_compositions = household_population.no_compositions
+        self.Q_int = Q_int
+        self.block = block
+        self.lumped_states = lumped_states
+        self.which_composition = household_population.which_composition[first]
+        self.system_sizes = bincount(
+            self.which_composition, minlength=self.no_compositions)
+        self.cum_sizes = cumsum(self.system_sizes)
+        self.offsets = concatenate(([0], self.cum_sizes))
+
+        # Each member of a group is equally likely to be any of its members
+        composition = self.composition_by_state
+        self.states = zeros((len(first), no_compartments * no_classes))
+        for g, group in enumerate(groups):
+            group_size = composition[:, group].sum(axis=1)
+            share = zeros(composition[:, group].shape)
+            present = group_size > 0
+            share[present] = composition[present][:, group] \
+                / group_size[present].reshape(-1, 1)
+            for j, c in enumerate(group):
+                self.states[:, no_compartments*c:no_compartments*(c+1)] = \
+                    share[:, [j]] * lumped_states[
+                        :, no_compartments*g:no_compartments*(g+1)]
+
+        events = unique(
+            array([
+                block[household_population.inf_event_row],
+                block[household_population.inf_event_col],
+                household_population.inf_event_class]),
+            axis=1)
+        self.inf_event_row, self.inf_event_col, self.inf_event_class = events
+
+        # The probability of each original state given its lumped state is
+        # multivariate hypergeometric in each group
+        states = household_population.states.reshape(
+            -1, no_classes, no_compartments)
+        original_composition = household_population.composition_by_state
+        group_states = lumped_states[block].reshape(
+            len(block), len(groups), no_compartments)
+        log_weights = gammaln(original_composition + 1).sum(axis=1) \
+            - gammaln(states + 1).sum(axis=(1, 2)) \
+            + gammaln(group_states + 1).sum(axis=(1, 2)) \
+            - sum(
+                gammaln(original_composition[:, group].sum(axis=1) + 1)
+                for group in groups)
+        self.membership = sparse(
+            (ones(len(block)), (arange(len(block)), block)),
+            shape=(len(block), len(first)))
+        self.lifting = sparse(
+            (exp(log_weights), (arange(len(block)), block)),
+            shape=(len(block), len(first)))
+
+    @property
+    def composition_by_state(self):
+        return self.composition_list[self.which_composition, :]
+
+    def lump(self, H):
+        '''Returns the lumped version of a distribution, or of an array of
+        distributions, over the original states'''
+        return self.membership.T.dot(H)
+
+    def lift(self, H):
+        '''Returns the distribution, or array of distributions, over the
+        original states corresponding to one over the lumped states'''
+        return self.lifting.dot(H)
+
 
 class ConstantDetModel:
     '''This class acts a constant function representing profile of detected
@@ -432,32 +1005,55 @@ class ModelInput(ABC):
         self.coarse_bds = spec['coarse_bds']
         self.no_age_classes = len(self.coarse_bds)
 
-        self.pop_pyramid = read_csv(
-            spec['pop_pyramid_file_name'], index_col=0)
-        self.pop_pyramid = (self.pop_pyramid['F'] + self.pop_pyramid['M']).to_numpy()
+        self.pop_pyramid = read_pop_pyramid(spec['pop_pyramid_file_name'])
 
         if self.no_age_classes==1:
             self.k_home = array([[1]]) # If we have no age structure, we use a 1x1 array as the contact "matrix"
             self.k_ext = array([[1]])
         else:
-            self.k_home = read_excel(
-                spec['k_home']['file_name'],
-                sheet_name=spec['k_home']['sheet_name'],
-                header=header).to_numpy()
-            self.k_all = read_excel(
-                spec['k_all']['file_name'],
-                sheet_name=spec['k_all']['sheet_name'],
-                header=header).to_numpy()
-
-            self.k_home = aggregate_contact_matrix(
-                self.k_home, self.fine_bds, self.coarse_bds, self.pop_pyramid)
-            self.k_all = aggregate_contact_matrix(
-                self.k_all, self.fine_bds, self.coarse_bds, self.pop_pyramid)
+            self.k_home = load_aggregated_contact_matrix(
+                spec['k_home'],
+                self.fine_bds,
+                self.coarse_bds,
+                spec['pop_pyramid_file_name'],
+                header)
+            self.k_all = load_aggregated_contact_matrix(
+                spec['k_all'],
+                self.fine_bds,
+                self.coarse_bds,
+                spec['pop_pyramid_file_name'],
+                header)
             self.k_ext = self.k_all - self.k_home
+        # Contact matrices before any rescaling, kept so that variants created
+        # by with_updates can be renormalised without reloading them
+        self.unscaled_k_home = self.k_home
+        self.unscaled_k_ext = self.k_ext
 
         self.density_expo = spec['density_expo']
         self.composition_list = composition_list
         self.composition_distribution = composition_distribution
+        self._set_household_statistics()
+
+    # Attributes and spec entries which the household statistics and the
+    # rescaled contact matrices are computed from. Subclasses extend
+    # rescaling_parameters with the epidemiological parameters they use.
+    household_parameters = (
+        'composition_list', 'composition_distribution', 'density_expo')
+    rescaling_parameters = household_parameters + (
+        'unscaled_k_home', 'unscaled_k_ext')
+    # Spec entries which _set_derived_attributes computes attributes of other
+    # names from, and the attributes it sets.
+    derived_parameters = ()
+    derived_attributes = ()
+
+    def _set_derived_attributes(self):
+        '''Sets the attributes which are computed from spec entries of other
+        names. Models with such attributes override this.'''
+        pass
+
+    def _set_household_statistics(self):
+        composition_list = self.composition_list
+        composition_distribution = self.composition_distribution
         self.ave_hh_size = \
             composition_distribution.T.dot(
             composition_list.sum(axis=1))                                # Average household size
@@ -466,6 +1062,72 @@ class ModelInput(ABC):
             composition_list.sum(axis=1))**self.density_expo)                                # Average household size adjusted for density, needed to get internal transmission rate from secondary attack prob
         self.ave_hh_by_class = composition_distribution.T.dot(composition_list)
 
+    def _rescale_contact_matrices(self):
+        '''Sets k_home and k_ext from the unscaled contact matrices. Models
+        which calibrate their contact matrices override this.'''
+        self.k_home = self.unscaled_k_home
+        self.k_ext = self.unscaled_k_ext
+
+    def with_updates(self, rescale=True, **overrides):
+        '''Returns a variant of this input with the attributes named in
+        overrides replaced. Spec entries of the same name are updated too, and
+        spec-only entries such as AR can be overridden directly. Everything
+        which is not overridden is shared with this input through read-only
+        views, so variants are cheap to make and cannot write back into the
+        input they came from.
+
+        Household statistics and the rescaled k_home and k_ext are recomputed
+        when a parameter they depend on is overridden. Pass rescale=False to
+        keep the current calibration of the contact matrices, e.g. when the
+        overrides describe an intervention applied to a calibrated model.
+        Overrides of k_home or k_ext are only kept if no rescaling happens.
+        Attributes such as inf_scales are likewise recomputed when a spec
+        entry they are derived from is overridden.'''
+        overridden = set(overrides)
+        if not overridden.isdisjoint(self.derived_parameters):
+            if not overridden.isdisjoint(self.derived_attributes):
+                raise ValueError(
+                    'Cannot override {0} together with the parameters they '
+                    'are derived from'.format(
+                        sorted(overridden.intersection(
+                            self.derived_attributes))))
+            if hasattr(self, 'vuln_prop'):
+                raise ValueError(
+                    'Parameters of an input expanded by add_vuln_class must '
+                    'be overridden before it is expanded')
+
+        variant = copy(self)
+        for name, value in vars(self).items():
+            setattr(variant, name, _read_only_view(value))
+        variant.spec = {
+            key: _read_only_view(value) for key, value in self.spec.items()}
+        for name, value in overrides.items():
+            if name in self.spec:
+                variant.spec[name] = value
+            if (name in vars(self)) or (name not in self.spec):
+                setattr(variant, name, value)
+
+        if not overridden.isdisjoint(self.derived_parameters):
+            variant._set_derived_attributes()
+            overridden.update(self.derived_attributes)
+        if not overridden.isdisjoint(self.household_parameters):
+            variant._set_household_statistics()
+        if rescale and not overridden.isdisjoint(self.rescaling_parameters):
+            variant._rescale_contact_matrices()
+        return variant
+
+
+def _read_only_view(value):
+    '''Returns a view of an array, or of each array in a list, which cannot
+    be written to.'''
+    if isinstance(value, ndarray):
+        view = value.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(value, list):
+        return [_read_only_view(entry) for entry in value]
+    return value
+
 class SIRInput(ModelInput):
     def __init__(self, spec, composition_list, composition_distribution):
         super().__init__(spec, composition_list, composition_distribution)
@@ -475,20 +1137,27 @@ class SIRInput(ModelInput):
         self.sus = spec['sus']
         self.inf_scales = [ones((self.no_age_classes,))] # In the SIR model there is only one infectious compartment
 
-        home_eig = max(eig(
+        self._rescale_contact_matrices()
+
+    rescaling_parameters = ModelInput.rescaling_parameters + (
+        'sus', 'recovery_rate', 'AR', 'R*')
+
+    def _rescale_contact_matrices(self):
+        spec = self.spec
+        home_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_home))
-            )[0])
-        ext_eig = max(eig(
+             (self.unscaled_k_home))
+            )
+        ext_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_ext))
-            )[0])
+             (self.unscaled_k_ext))
+            )
 
         R_int = - log(1 - spec['AR']) * self.dens_adj_ave_hh_size
 
-        self.k_home = R_int * self.k_home / home_eig
+        self.k_home = R_int * self.unscaled_k_home / home_eig
         external_scale = spec['R*']/(self.ave_hh_size*spec['AR'])
-        self.k_ext = external_scale * self.k_ext / ext_eig
+        self.k_ext = external_scale * self.unscaled_k_ext / ext_eig
 
     @property
     def gamma(self):
@@ -503,20 +1172,27 @@ class SEIRInput(ModelInput):
         self.sus = spec['sus']
         self.inf_scales = [ones((self.no_age_classes,))]
 
-        home_eig = max(eig(
+        self._rescale_contact_matrices()
+
+    rescaling_parameters = ModelInput.rescaling_parameters + (
+        'sus', 'recovery_rate', 'AR', 'R*')
+
+    def _rescale_contact_matrices(self):
+        spec = self.spec
+        home_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_home))
-            )[0])
-        ext_eig = max(eig(
+             (self.unscaled_k_home))
+            )
+        ext_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_ext))
-            )[0])
+             (self.unscaled_k_ext))
+            )
 
         R_int = - log(1 - spec['AR']) * self.dens_adj_ave_hh_size
 
-        self.k_home = R_int * self.k_home / home_eig
+        self.k_home = R_int * self.unscaled_k_home / home_eig
         external_scale = spec['R*']/(self.ave_hh_size*spec['AR'])
-        self.k_ext = external_scale * self.k_ext / ext_eig
+        self.k_ext = external_scale * self.unscaled_k_ext / ext_eig
 
     @property
     def alpha(self):
@@ -534,31 +1210,44 @@ class SEPIRInput(ModelInput):
                          'inf_scales']
 
         self.sus = spec['sus']
-        self.inf_scales = [spec['prodromal_trans_scaling'],
-                ones(shape(spec['prodromal_trans_scaling']))]
+        self._set_derived_attributes()
+
+        self._rescale_contact_matrices()
+
+    rescaling_parameters = ModelInput.rescaling_parameters + (
+        'sus', 'inf_scales', 'recovery_rate', 'symp_onset_rate',
+        'prodromal_trans_scaling', 'AR', 'R*', 'fit_method')
+    derived_parameters = ('prodromal_trans_scaling',)
+    derived_attributes = ('inf_scales',)
+
+    def _set_derived_attributes(self):
+        self.inf_scales = [self.spec['prodromal_trans_scaling'],
+                ones(shape(self.spec['prodromal_trans_scaling']))]
 
-        home_eig = max(eig(
+    def _rescale_contact_matrices(self):
+        spec = self.spec
+        home_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_home) + \
+             (self.unscaled_k_home) + \
             (1/spec['symp_onset_rate']) *
-            (self.k_home ) * spec['prodromal_trans_scaling'])
-            )[0])
-        ext_eig = max(eig(
+            (self.unscaled_k_home ) * self.inf_scales[0])
+            )
+        ext_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_ext) + \
+             (self.unscaled_k_ext) + \
             (1/spec['symp_onset_rate']) *
-            (self.k_ext ) * spec['prodromal_trans_scaling'])
-            )[0])
+            (self.unscaled_k_ext ) * self.inf_scales[0])
+            )
 
         R_int = - log(1 - spec['AR']) * self.dens_adj_ave_hh_size
 
-        self.k_home = R_int * self.k_home / home_eig
+        self.k_home = R_int * self.unscaled_k_home / home_eig
 
         if spec['fit_method'] == 'R*':
             external_scale = spec['R*'] / (self.ave_hh_size*spec['AR'])
         else:
             external_scale = 1 / (self.ave_hh_size*spec['AR'])
-        self.k_ext = external_scale * self.k_ext / ext_eig
+        self.k_ext = external_scale * self.unscaled_k_ext / ext_eig
 
 
 
@@ -583,47 +1272,63 @@ class SEPIRQInput(ModelInput):
                          'iso_rates']
 
         self.sus = spec['sus']
+        self._set_derived_attributes()
+
+        self._rescale_contact_matrices()
+
+        self.adult_bd = spec['adult_bd']
+        self.class_is_isolating = spec['class_is_isolating']
+        self.iso_method = spec['iso_method']
+        self.ad_prob = spec['ad_prob']
+        self.discharge_rate = spec['discharge_rate']
+
+    rescaling_parameters = ModelInput.rescaling_parameters + (
+        'sus', 'inf_scales', 'recovery_rate', 'symp_onset_rate',
+        'prodromal_trans_scaling', 'AR', 'R*', 'fit_method')
+    derived_parameters = (
+        'prodromal_trans_scaling', 'iso_trans_scaling', 'exp_iso_rate',
+        'pro_iso_rate', 'inf_iso_rate')
+    derived_attributes = ('inf_scales', 'iso_rates')
+
+    def _set_derived_attributes(self):
+        spec = self.spec
         self.inf_scales = [spec['prodromal_trans_scaling'],
                 ones(shape(spec['prodromal_trans_scaling'])),
                 spec['iso_trans_scaling']]
+        # To define the iso_rates property, we add some zeros which act as dummy
+        # entries so that the index of the isolation rates match the
+        # corresponding compartmental indices.
+        self.iso_rates = [ zeros((self.no_age_classes,)),
+                           spec['exp_iso_rate'],
+                           spec['pro_iso_rate'],
+                           spec['inf_iso_rate'],
+                           zeros((self.no_age_classes,)),
+                           zeros((self.no_age_classes,)) ]
 
-        home_eig = max(eig(
+    def _rescale_contact_matrices(self):
+        spec = self.spec
+        home_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_home) + \
+             (self.unscaled_k_home) + \
             (1/spec['symp_onset_rate']) *
-            (self.k_home ) * spec['prodromal_trans_scaling'])
-            )[0])
-        ext_eig = max(eig(
+            (self.unscaled_k_home ) * self.inf_scales[0])
+            )
+        ext_eig = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) *
-             (self.k_ext) + \
+             (self.unscaled_k_ext) + \
             (1/spec['symp_onset_rate']) *
-            (self.k_ext ) * spec['prodromal_trans_scaling'])
-            )[0])
+            (self.unscaled_k_ext ) * self.inf_scales[0])
+            )
 
         R_int = - log(1 - spec['AR']) * self.dens_adj_ave_hh_size
 
-        self.k_home = R_int * self.k_home / home_eig
+        self.k_home = R_int * self.unscaled_k_home / home_eig
 
         if spec['fit_method'] == 'R*':
             external_scale = spec['R*'] / (self.ave_hh_size*spec['AR'])
         else:
             external_scale = 1 / (self.ave_hh_size*spec['AR'])
-        self.k_ext = external_scale * self.k_ext / ext_eig
-
-        # To define the iso_rates property, we add some zeros which act as dummy
-        # entries so that the index of the isolation rates match the
-        # corresponding compartmental indices.
-        self.iso_rates = [ zeros((self.no_age_classes,)),
-                           spec['exp_iso_rate'],
-                           spec['pro_iso_rate'],
-                           spec['inf_iso_rate'],
-                           zeros((self.no_age_classes,)),
-                           zeros((self.no_age_classes,)) ]
-        self.adult_bd = spec['adult_bd']
-        self.class_is_isolating = spec['class_is_isolating']
-        self.iso_method = spec['iso_method']
-        self.ad_prob = spec['ad_prob']
-        self.discharge_rate = spec['discharge_rate']
+        self.k_ext = external_scale * self.unscaled_k_ext / ext_eig
 
 
     @property
@@ -647,9 +1352,7 @@ class StandardModelInput(ModelInput):
         fine_bds = arange(0, 81, 5)
         self.coarse_bds = concatenate((fine_bds[:6], fine_bds[12:]))
 
-        pop_pyramid = read_csv(
-            spec['pop_pyramid_file_name'], index_col=0)
-        pop_pyramid = (pop_pyramid['F'] + pop_pyramid['M']).to_numpy()
+        pop_pyramid = read_pop_pyramid(spec['pop_pyramid_file_name'])
 
         self.k_home = aggregate_contact_matrix(
             self.k_home, fine_bds, self.coarse_bds, pop_pyramid)
@@ -688,15 +1391,26 @@ class StandardModelInput(ModelInput):
 
 
 class VoInput(ModelInput):
-    '''TODO: add docstring'''
-    def __init__(self, spec):
-        super().__init__(spec, header=0)
+    '''Model input for the Vo testing data, which is stratified into ten year
+    age classes up to 90+. The contact matrices stop at 75+, so their last
+    class is split using the population pyramid before they are
+    aggregated.'''
+    def __init__(self, spec, composition_list, composition_distribution):
+        # We do not call super constructor as the contact matrices have to be
+        # extended before they are aggregated.
+        self.spec = deepcopy(spec)
+
+        self.compartmental_structure = spec['compartmental_structure']
+        self.inf_compartment_list = subsystem_key[self.compartmental_structure][2]
+        self.no_inf_compartments = len(self.inf_compartment_list)
+
         fine_bds = arange(0, 96, 5)
+        self.fine_bds = fine_bds
         self.coarse_bds = arange(0, 96, 10)
+        self.no_age_classes = len(self.coarse_bds)
 
-        pop_pyramid = read_csv(
-            spec['pop_pyramid_file_name'], index_col=0)
-        pop_pyramid = (pop_pyramid['F'] + pop_pyramid['M']).to_numpy()
+        pop_pyramid = read_pop_pyramid(spec['pop_pyramid_file_name'])
+        self.pop_pyramid = pop_pyramid
 
         '''We need to add an extra row to contact matrix to split 75+ class
         into 75-90 and 90+'''
@@ -713,16 +1427,27 @@ class VoInput(ModelInput):
             zeros((16, 3))))
         postmultiplier[15, 15:] = proportions_75_plus
 
-        k_home = (premultiplier.dot(self.k_home)).dot(postmultiplier)
-        k_all = (premultiplier.dot(self.k_all)).dot(postmultiplier)
+        k_home = read_contact_matrix(
+            spec['k_home']['file_name'], spec['k_home']['sheet_name'], 0)
+        k_all = read_contact_matrix(
+            spec['k_all']['file_name'], spec['k_all']['sheet_name'], 0)
+        k_home = (premultiplier.dot(k_home)).dot(postmultiplier)
+        k_all = (premultiplier.dot(k_all)).dot(postmultiplier)
 
         self.k_home = aggregate_contact_matrix(
-            k_home, fine_bds, self.coarse_bds, pop_pyramid)
+            k_home, fine_bds, self.coarse_bds, pop_pyramid.copy())
         self.k_all = aggregate_contact_matrix(
-            k_all, fine_bds, self.coarse_bds, pop_pyramid)
+            k_all, fine_bds, self.coarse_bds, pop_pyramid.copy())
         self.k_ext = self.k_all - self.k_home
+        self.unscaled_k_home = self.k_home
+        self.unscaled_k_ext = self.k_ext
 
-        no_age_classes = self.k_home.shape[0]
+        self.density_expo = spec['density_expo']
+        self.composition_list = composition_list
+        self.composition_distribution = composition_distribution
+        self._set_household_statistics()
+
+        no_age_classes = self.no_age_classes
 
         # Now construct a matrix to map the age-stratified quantities from the
         # specs to the age boundaries used in the model.
@@ -744,6 +1469,7 @@ class VoInput(ModelInput):
         self.det = array(spec['symptom_prob']).dot(age_quant_map)
         self.tau = array(spec['asymp_trans_scaling']).dot(age_quant_map)
         self.sus = array(spec['sus']).dot(age_quant_map)
+        self.inf_scales = [ones((no_age_classes,)), self.tau]
 
         self.import_model = import_model_from_spec(spec, self.det)
 
@@ -775,28 +1501,19 @@ class TwoAgeWithVulnerableInput:
         ])
         # Add copy of right row, scaled by vulnerables, and scale adult column
         # by non-vuln proportion
-        k_home = read_excel(
-            spec['k_home']['file_name'],
-            sheet_name=spec['k_home']['sheet_name'],
-            header=None).to_numpy()
-        k_all = read_excel(
-            spec['k_all']['file_name'],
-            sheet_name=spec['k_all']['sheet_name'],
-            header=None).to_numpy()
-
         fine_bds = arange(0, 81, 5)
         self.coarse_bds = array([0, 20])
 
-        # pop_pyramid = read_csv(
-        #     'inputs/United Kingdom-2019.csv', index_col=0)
-        pop_pyramid = read_csv(
-            spec['pop_pyramid_file_name'], index_col=0)
-        pop_pyramid = (pop_pyramid['F'] + pop_pyramid['M']).to_numpy()
-
-        self.k_home = aggregate_contact_matrix(
-            k_home, fine_bds, self.coarse_bds, pop_pyramid)
-        self.k_all = aggregate_contact_matrix(
-            k_all, fine_bds, self.coarse_bds, pop_pyramid)
+        self.k_home = load_aggregated_contact_matrix(
+            spec['k_home'],
+            fine_bds,
+            self.coarse_bds,
+            spec['pop_pyramid_file_name'])
+        self.k_all = load_aggregated_contact_matrix(
+            spec['k_all'],
+            fine_bds,
+            self.coarse_bds,
+            spec['pop_pyramid_file_name'])
         self.k_ext = self.k_all - self.k_home
 
         self.k_home = left_expander.dot(self.k_home.dot(right_expander))
@@ -806,7 +1523,7 @@ class TwoAgeWithVulnerableInput:
         self.sus = spec['sus']
         self.tau = spec['prodromal_trans_scaling']
 
-        eigenvalue = max(eig(
+        eigenvalue = spectral_radius(
 
             self.sus * (
                 (1.0/spec['recovery_rate'])
@@ -814,7 +1531,7 @@ class TwoAgeWithVulnerableInput:
                 + (1.0/spec['symp_onset_rate']) *
                 (self.k_home + self.epsilon * self.k_ext) * self.tau)
 
-            )[0])
+            )
 
         self.k_home = (spec['R0']/eigenvalue)*self.k_home
         self.k_all = (spec['R0']/eigenvalue)*self.k_all
@@ -860,10 +1577,10 @@ class CareHomeInput(ModelInput):
         self.sus = spec['sus']
         self.tau = spec['prodromal_trans_scaling']
 
-        eigenvalue = max(eig(
+        eigenvalue = spectral_radius(
             self.sus * ((1/spec['recovery_rate']) * (self.k_home) + \
             (1/spec['symp_onset_rate']) * (self.k_home) * self.tau)
-            )[0])
+            )
 
         # Scaling below means R0 is the one defined in specs
         self.k_home = (spec['R_carehome']/eigenvalue) * self.k_home
@@ -986,7 +1703,7 @@ def add_vuln_class(model_input,
     mixing. vector_quants lists (as strings) the names of any class-stratified
     vector quantities which need to be expanded to account for the new class.'''
 
-    expanded_input = deepcopy(model_input)
+    expanded_input = model_input.with_updates()
 
     vuln_class = expanded_input.no_age_classes + 1
 
@@ -1015,6 +1732,10 @@ def add_vuln_class(model_input,
                                     expanded_input.k_home.dot(right_expander))
     expanded_input.k_ext = left_ext_expander.dot(
                                     expanded_input.k_ext.dot(right_expander))
+    expanded_input.unscaled_k_home = left_int_expander.dot(
+                            expanded_input.unscaled_k_home.dot(right_expander))
+    expanded_input.unscaled_k_ext = left_ext_expander.dot(
+                            expanded_input.unscaled_k_ext.dot(right_expander))
 
     for par_name in model_input.expandables:
 
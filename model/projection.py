@@ -0,0 +1,196 @@
+'''Finite state projection for the rate equations. Most household states
+carry negligible probability for most of a run, so here we solve the rate
+equations on an active set of states, account for the probability which
+flows out of it, and grow the set whenever too much does.'''
+from numpy import (
+    arange, argsort, array_equal, bincount, concatenate, cumsum, repeat,
+    searchsorted, setdiff1d, union1d, unique, where, zeros)
+from scipy.integrate import solve_ivp
+from scipy.sparse import bmat
+from model.common import RateEquations
+
+
+class ProjectionSolution:
+    '''Solution of the rate equations on an adaptive active set. y holds the
+    full household state distribution at each time in t, which is zero
+    outside the active set, and error_bound the probability lost from it by
+    then. error_bound only bounds the L1 error while the force of infection
+    is frozen across each step, as it is with imports only or epsilon=0;
+    otherwise it is an estimate. active_size is the size of the active set
+    at each time.'''
+    def __init__(self, t, y, error_bound, active_size):
+        self.t = t
+        self.y = y
+        self.error_bound = error_bound
+        self.active_size = active_size
+
+
+class AdaptiveProjectionSolver:
+    '''Solves the rate equations rhs on a set of active states, starting
+    from the states where H0 is positive. Probability which flows out of the
+    active set, through Q_int or external infection, is dropped and counted.
+    When a step loses more than its share of tol, the step is repeated with
+    every state reachable in one transition from the active set added.
+    States whose probability falls below drop_tol are removed after each
+    step, and their probability is added to the error.
+
+    The sum of the lost and removed probability bounds the total variation
+    distance to the full solution only while the force of infection is
+    frozen across each step, i.e. with imports only or epsilon=0.
+    Between-household transmission depends on the solution itself, so in
+    general the bound is an estimate.
+
+    The restricted equations are kept for the last active set. When states
+    are only added to it they are extended rather than rebuilt, and the
+    infection events leaving each state are found through pointers sorted
+    by state, so no step scans every event.'''
+    def __init__(self, rhs, tol=1e-6, drop_tol=0.0, max_step=1.0):
+        if type(rhs).get_FOI_by_class is not RateEquations.get_FOI_by_class:
+            raise ValueError(
+                'Projection needs the standard force of infection, which '
+                '{0} overrides'.format(type(rhs).__name__))
+        self.rhs = rhs
+        self.tol = tol
+        self.drop_tol = drop_tol
+        self.max_step = max_step
+        household_population = rhs.household_population
+        self.total_size = len(household_population.which_composition)
+        self.no_classes = household_population.no_risk_groups
+        self.Q_int = rhs.Q_int.tocsr()
+        self.inf_event_row = household_population.inf_event_row
+        self.inf_event_col = household_population.inf_event_col
+        self.inf_event_class = household_population.inf_event_class
+        self.inf_event_sus = rhs.states_sus_only[
+            self.inf_event_row, self.inf_event_class]
+        # Infection events sorted by the state they leave, with the first
+        # event of each state
+        self.event_order = argsort(self.inf_event_row, kind='stable')
+        self.event_ptr = searchsorted(
+            self.inf_event_row[self.event_order],
+            arange(self.total_size + 1))
+        # Restriction to the last active set, with the position of each state
+        # in it or -1 for inactive states
+        self.position = zeros(self.total_size, dtype=int) - 1
+        self.active = zeros(0, dtype=int)
+        self.Q_active = self.Q_int[self.active, :][:, self.active]
+        self.events = zeros(0, dtype=int)
+
+    def _events_from(self, states):
+        '''Returns the indices of the infection events leaving states'''
+        starts = self.event_ptr[states]
+        counts = self.event_ptr[states + 1] - starts
+        offsets = cumsum(counts) - counts
+        return self.event_order[
+            repeat(starts - offsets, counts) + arange(counts.sum())]
+
+    def successors(self, active):
+        '''Returns the states reachable in one transition from active'''
+        internal = self.Q_int[active, :].indices
+        external = self.inf_event_col[self._events_from(active)]
+        return setdiff1d(unique(concatenate((internal, external))), active)
+
+    def _update_active(self, active):
+        '''Moves the stored restriction to active. If active only appends
+        states to the last active set, the restricted Q_int and event list
+        are extended with the blocks and events of the new states.'''
+        no_old = len(self.active)
+        if (len(active) == no_old) and array_equal(active, self.active):
+            return
+        if (0 < no_old < len(active)) and array_equal(
+                active[:no_old], self.active):
+            new = active[no_old:]
+            self.Q_active = bmat([
+                [self.Q_active, self.Q_int[self.active, :][:, new]],
+                [self.Q_int[new, :][:, self.active],
+                    self.Q_int[new, :][:, new]]]).tocsr()
+            self.events = concatenate((self.events, self._events_from(new)))
+        else:
+            self.position[self.active] = -1
+            self.Q_active = self.Q_int[active, :][:, active]
+            self.events = self._events_from(active)
+        self.active = active
+        self.position[active] = arange(len(active))
+
+    def _restrict(self, active):
+        '''Returns the rate equations on the active states, with the rate at
+        which probability leaves them as a last variable'''
+        rhs = self.rhs
+        self._update_active(active)
+        Q_T = self.Q_active.T.tocsr()
+        internal_leak = -self.Q_active.sum(axis=1).getA().squeeze(axis=1)
+        event_row = self.position[self.inf_event_row[self.events]]
+        event_col = self.position[self.inf_event_col[self.events]]
+        event_class = self.inf_event_class[self.events]
+        event_sus = self.inf_event_sus[self.events]
+        leaving = event_col < 0
+        event_col[leaving] = len(active)
+        composition_by_state = rhs.composition_by_state[active]
+        inf_by_state_list = [
+            states_inf_only[active] for states_inf_only in rhs.inf_by_state_list]
+
+        def restricted_rhs(t, z):
+            H = z[:-1].clip(min=0)
+            denom = H.dot(composition_by_state)
+            present = denom > 0
+            FOI = rhs.import_model.cases(t) + zeros(self.no_classes)
+            for ic in range(rhs.no_inf_compartments):
+                inf_by_class = zeros(self.no_classes)
+                inf_by_class[present] = \
+                    H.dot(inf_by_state_list[ic])[present] / denom[present]
+                FOI = FOI + rhs.epsilon * \
+                    rhs.ext_matrix_list[ic].dot(inf_by_class)
+            flow = H[event_row] * event_sus * FOI[event_class]
+            # Flows into states outside the active set end up in the last
+            # entry, which accumulates the lost probability
+            dz = bincount(event_col, flow, len(active) + 1)
+            dz[:-1] += Q_T.dot(H) - bincount(event_row, flow, len(active))
+            dz[-1] += internal_leak.dot(H)
+            return dz
+
+        return restricted_rhs
+
+    def solve(self, t_span, H0, t_eval, **solver_options):
+        '''Solves the rate equations from H0 over t_span, reporting the
+        solution at each time in t_eval. Extra keyword arguments go to
+        solve_ivp for each step.'''
+        t_start, t_end = t_span
+        active = where(H0 > 0)[0]
+        H = H0[active]
+        error = 0.0
+        steps = union1d(t_eval, t_span)
+        y = zeros((self.total_size, len(t_eval)))
+        error_bound = zeros(len(t_eval))
+        active_size = zeros(len(t_eval), dtype=int)
+
+        def record(t):
+            for k in where(t_eval == t)[0]:
+                y[active, k] = H
+                error_bound[k] = error
+                active_size[k] = len(active)
+
+        record(t_start)
+        for t, t_next in zip(steps[:-1], steps[1:]):
+            while t < t_next:
+                t_step = min(t_next, t + self.max_step)
+                budget = self.tol * (t_step - t) / (t_end - t_start)
+                while True:
+                    z = solve_ivp(
+                        self._restrict(active),
+                        (t, t_step),
+                        concatenate((H, [0.0])),
+                        **solver_options).y[:, -1]
+                    new_states = self.successors(active)
+                    if (z[-1] <= budget) or (len(new_states) == 0):
+                        break
+                    # New states go at the end, so the restriction can be
+                    # extended rather than rebuilt
+                    H = concatenate((H, zeros(len(new_states))))
+                    active = concatenate((active, new_states))
+                error += z[-1]
+                H = z[:-1].clip(min=0)
+                kept = H >= self.drop_tol
+                error += H[~kept].sum()
+                active, H = active[kept], H[kept]
+                t = t_step
+            record(t_next)
+        return ProjectionSolution(t_eval, y, error_bound, active_size)
@@ -183,6 +183,7 @@ TWO_AGE_UK_SPEC = {
 }
 
 VO_SPEC = {
+    'compartmental_structure': 'SEDUR', # This is which subsystem key to use
     # Interpretable parameters:
     'R0': 2.4,
     'incubation_rate': 1/1,
@@ -208,6 +209,7 @@ VO_SPEC = {
         'sheet_name': 'Italy'
     },
     'pop_pyramid_file_name': 'inputs/Italy-2019.csv',
+    'density_expo': 1,
     # TODO: Parameter below (rho) may be redundant
     'rho_file_name': 'inputs/rho_estimate_cdc.csv',
     'external_importation': {
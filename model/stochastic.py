@@ -0,0 +1,128 @@
+'''Stochastic simulation of households over the household state space. The
+rate equations describe the probability of each household state; here we
+instead draw realisations of individual households, e.g. single care homes or
+the households of a small study, which are independent of each other given
+the import of infection from outside.'''
+from numpy import (
+    arange, argsort, asarray, bincount, ceil, concatenate, cumsum, full, inf,
+    linspace, maximum, minimum, searchsorted, zeros)
+from numpy.random import default_rng
+
+
+class HouseholdSimulator:
+    '''Simulates independent households with the transition rates of a
+    household population: the within-household rates in Q_int plus external
+    infection, at the rate import_model.cases(t) per susceptible, along the
+    infection events. All replicates are advanced together with the direct
+    method, so each pass over the replicates costs a few array operations
+    however many there are.
+
+    Import rates are held fixed over steps of at most max_step, at their value
+    in the middle of the step, unless the import model is time invariant, in
+    which case the simulation is exact.'''
+    def __init__(self, household_population, import_model, max_step=0.1):
+        self.household_population = household_population
+        self.import_model = import_model
+        self.max_step = max_step
+        total_size = len(household_population.which_composition)
+        self.total_size = total_size
+        no_compartments = \
+            household_population.num_of_epidemiological_compartments
+        states_sus_only = household_population.states[:, ::no_compartments]
+
+        # Every transition out of each state, internal then external, with
+        # its fixed rate and the number of susceptibles scaling its imports
+        Q = household_population.Q_int.tocoo()
+        off_diagonal = Q.row != Q.col
+        row = household_population.inf_event_row
+        no_internal = off_diagonal.sum()
+        from_state = concatenate((Q.row[off_diagonal], row))
+        order = argsort(from_state, kind='stable')
+        self.to_state = concatenate((
+            Q.col[off_diagonal], household_population.inf_event_col))[order]
+        self.internal_rates = concatenate((
+            Q.data[off_diagonal], zeros(len(row))))[order]
+        self.import_weights = concatenate((
+            zeros(no_internal),
+            states_sus_only[row, household_population.inf_event_class]))[order]
+        self.import_class = concatenate((
+            zeros(no_internal, dtype=row.dtype),
+            household_population.inf_event_class))[order]
+        self.indptr = concatenate((
+            [0], cumsum(bincount(from_state, minlength=total_size))))
+
+    def _cumulative_rates(self, t):
+        '''Returns the running total of the rates of every transition, in
+        order of the state they leave, with a leading zero'''
+        rates = self.internal_rates + self.import_weights * \
+            asarray(self.import_model.cases(t))[self.import_class]
+        return concatenate(([0.0], cumsum(rates)))
+
+    def _advance(self, x, t_start, t_end, rng):
+        '''Moves the replicates in states x from t_start to t_end in place,
+        with rates fixed at their value in the middle of the interval'''
+        cumulative = self._cumulative_rates(0.5 * (t_start + t_end))
+        first = self.indptr[:-1]
+        last = self.indptr[1:]
+        exit_rates = cumulative[last] - cumulative[first]
+        active = arange(len(x))
+        t = full(len(x), t_start)
+        while len(active) > 0:
+            state = x[active]
+            rate = exit_rates[state]
+            with_events = rate > 0
+            t_next = full(len(active), inf)
+            t_next[with_events] = t[active][with_events] + rng.exponential(
+                size=with_events.sum()) / rate[with_events]
+            jumping = t_next < t_end
+            active = active[jumping]
+            state = state[jumping]
+            t[active] = t_next[jumping]
+            # Pick each transition with probability proportional to its rate
+            target = cumulative[first[state]] \
+                + rng.random(len(active)) * rate[jumping]
+            transition = searchsorted(cumulative, target, side='right') - 1
+            transition = minimum(
+                maximum(transition, first[state]), last[state] - 1)
+            x[active] = self.to_state[transition]
+
+    def run(self, H0, t_out, no_replicates, statistic=None, rng=None):
+        '''Generator which starts no_replicates households in states drawn
+        from the distribution H0 and yields, at each of the times t_out, the
+        result of statistic applied to the array of their current states. By
+        default this is the array itself.'''
+        rng = default_rng(rng)
+        if statistic is None:
+            statistic = lambda x: x.copy()
+        H0 = asarray(H0)
+        x = rng.choice(self.total_size, size=no_replicates, p=H0/H0.sum())
+        t_out = asarray(t_out)
+        t = t_out[0]
+        yield statistic(x)
+        for t_next in t_out[1:]:
+            if self.import_model.time_invariant:
+                no_steps = 1
+            else:
+                no_steps = max(1, int(ceil((t_next - t) / self.max_step)))
+            times = linspace(t, t_next, no_steps + 1)
+            for step in range(no_steps):
+                self._advance(x, times[step], times[step+1], rng)
+            t = t_next
+            yield statistic(x)
+
+    def summary_statistics(self, H0, t_out, no_replicates, rng=None):
+        '''Returns the empirical distribution over household states and the
+        mean and variance of the number of individuals in each compartment of
+        each class at each of the times t_out'''
+        states = self.household_population.states
+        distribution, mean, variance = [], [], []
+        for x in self.run(H0, t_out, no_replicates, rng=rng):
+            distribution.append(
+                bincount(x, minlength=self.total_size) / no_replicates)
+            mean.append(distribution[-1].dot(states))
+            variance.append(distribution[-1].dot(states**2) - mean[-1]**2)
+        return {
+            'time': asarray(t_out),
+            'distribution': asarray(distribution),
+            'mean': asarray(mean),
+            'variance': asarray(variance)}
@@ -6,100 +6,63 @@ these are used to create some functions for implementing common comprtmental
 
 from copy import copy, deepcopy
 from numpy import (
-        append, arange, around, array, cumprod, cumsum, ones, ones_like, sum, where,
-        zeros, concatenate, vstack, identity, tile, hstack, prod, ix_,
-        atleast_2d, diag)
+        append, arange, around, array, bincount, cumprod, cumsum, ones, ones_like, repeat,
+        searchsorted, sum, where, zeros, concatenate, vstack, identity, tile, hstack, prod,
+        ix_, atleast_2d, diag)
 from numpy import int64 as my_int
 from scipy.sparse import csc_matrix as sparse
 
-def state_recursor(
-        states,
-        no_compartments,
-        age_class,
-        b_size,
-        n_blocks,
-        con_reps,
-        c,
-        x,
-        depth,
-        k):
-    if depth < no_compartments-1:
-        for x_i in arange(c + 1 - x.sum()):
-            x[0, depth] = x_i
-            x[0, depth+1:] = zeros(
-                (1, no_compartments-depth-1),
-                dtype=my_int)
-            states, k = state_recursor(
-                states,
-                no_compartments,
-                age_class,
-                b_size,
-                n_blocks,
-                con_reps,
-                c,
-                x,
-                depth+1,
-                k)
-    else:
-        x[0, -1] = c - sum(x[0, :depth])
-        for block in arange(n_blocks):
-            repeat_range = arange(
-                block * b_size
-                + k * con_reps,
-                block * b_size +
-                (k + 1) * con_reps)
-            states[repeat_range, no_compartments*age_class:no_compartments*(age_class+1)] = \
-                ones(
-                    (con_reps, 1),
-                    dtype=my_int) \
-                * array(
-                    x,
-                    ndmin=2, dtype=my_int)
-        k += 1
-        return states, k
-    return states, k
-
-
-def build_states_recursively(
+def class_configurations(class_size, no_compartments):
+    '''Returns every way of splitting class_size individuals between
+    no_compartments compartments, one per row. Rows are ordered
+    lexicographically in all but the last compartment, which takes whoever
+    is left over.'''
+    configurations = zeros((1, 0), dtype=my_int)
+    for depth in range(no_compartments - 1):
+        # Each partial configuration is followed by every number of
+        # individuals which can still be placed in the next compartment
+        no_options = class_size + 1 - configurations.sum(axis=1)
+        starts = cumsum(no_options) - no_options
+        next_values = arange(no_options.sum()) - repeat(starts, no_options)
+        configurations = hstack((
+            repeat(configurations, no_options, axis=0),
+            next_values.reshape(-1, 1)))
+    return hstack((
+        configurations,
+        class_size - configurations.sum(axis=1, keepdims=True)))
+
+
+def build_states(
         total_size,
         no_compartments,
         classes_present,
-        block_size,
-        num_blocks,
         consecutive_repeats,
         composition):
+    '''Returns the array of household states. The configurations of each
+    class are repeated consecutive_repeats times in a row, and this pattern
+    is tiled down the array, so the first class present varies fastest.'''
     states = zeros(
         (total_size, no_compartments*len(classes_present)),
         dtype=my_int)
     for age_class in range(len(classes_present)):
-        k = 0
-        states, k = state_recursor(
-            states,
-            no_compartments,
-            age_class,
-            block_size[age_class],
-            num_blocks[age_class],
-            consecutive_repeats[age_class],
-            composition[classes_present[age_class]],
-            zeros([1, no_compartments], dtype=my_int),
-            0,
-            k)
-    return states, k
+        configurations = class_configurations(
+            composition[classes_present[age_class]], no_compartments)
+        block = repeat(
+            configurations, consecutive_repeats[age_class], axis=0)
+        states[:, no_compartments*age_class:no_compartments*(age_class+1)] = \
+            tile(block, (total_size // len(block), 1))
+    return states
 
 
 def build_state_matrix(household_spec):
     # Number of times you repeat states for each configuration
     consecutive_repeats = concatenate((
         ones(1, dtype=my_int), cumprod(household_spec.system_sizes[:-1])))
-    block_size = consecutive_repeats * household_spec.system_sizes
-    num_blocks = household_spec.total_size // block_size
 
-    states, k = build_states_recursively(
+    states = build_states(
         household_spec.total_size,
         household_spec.no_compartments,
         household_spec.class_indexes,
-        block_size,
-        num_blocks,
         consecutive_repeats,
         household_spec.composition)
     # Now construct a sparse vector which tells you which row a state appears
@@ -122,11 +85,9 @@ def build_state_matrix(household_spec):
     # from the set of states to the integers. Because lots of combinations
     # don't actually appear in the states array, we use a sparse array which
     # will be much bigger than we actually require
-    rows = [
-        states[k, :].dot(reverse_prod) + states[k, -1]
-        for k in range(household_spec.total_size)]
+    rows = states.dot(reverse_prod) + states[:, -1]
 
-    if min(rows) < 0:
+    if rows.min() < 0:
         print(
             'Negative row indices found, proportional total',
             sum(array(rows) < 0),
@@ -140,6 +101,30 @@ def build_state_matrix(household_spec):
 
     return states, reverse_prod, index_vector, rows
 
+
+def state_index(new_states, index_vector, reverse_prod):
+    '''Returns the rows of the state array holding each of new_states. The
+    codes index_vector is keyed by are far too many to index it densely, so
+    we look them up among its stored, sorted, row indices instead.'''
+    codes = new_states.dot(reverse_prod) + new_states[:, -1]
+    return index_vector.data[
+        searchsorted(index_vector.indices, codes)].astype(my_int)
+
+
+def moved_states(
+        states,
+        from_present,
+        from_position,
+        to_position,
+        index_vector,
+        reverse_prod):
+    '''Returns the rows of the states reached from states[from_present] when
+    one individual moves from from_position to to_position'''
+    new_states = states[from_present, :]
+    new_states[:, from_position] -= 1
+    new_states[:, to_position] += 1
+    return state_index(new_states, index_vector, reverse_prod)
+
 def inf_events(from_compartment,
                 to_compartment,
                 inf_compartment_list,
@@ -162,24 +147,25 @@ def inf_events(from_compartment,
 
     no_inf_compartments = len(inf_compartment_list) # Total number of compartments contributing to within-household infection
 
+    # Infectious individuals of each class, weighted by their infectivity
+    # and scaled by household size, in every state
+    infs = zeros((len(states), len(class_idx)))
+    for ic in range(no_inf_compartments):
+        infs += (states[:, inf_compartment_list[ic] + no_compartments * arange(len(class_idx))] /
+                                        (composition[class_idx]**density_expo)) * inf_scales[ic]
+
     for i in range(len(class_idx)):
         from_present = where(states[:, no_compartments*i+from_compartment] > 0)[0]
 
-        inf_to = zeros(len(from_present), dtype=my_int)
-        inf_rate = zeros(len(from_present))
-        for k in range(len(from_present)):
-            old_state = copy(states[from_present[k], :])
-            old_infs = zeros(len(class_idx))
-            for ic in range(no_inf_compartments):
-                old_infs += (old_state[inf_compartment_list[ic] + no_compartments * arange(len(class_idx))] /
-                                                (composition[class_idx]**density_expo)) * inf_scales[ic]
-            inf_rate[k] = old_state[no_compartments*i] * (
-                r_home[i, :].dot( old_infs ))
-            new_state = old_state.copy()
-            new_state[no_compartments*i + from_compartment] -= 1
-            new_state[no_compartments*i + to_compartment] += 1
-            inf_to[k] = index_vector[
-                new_state.dot(reverse_prod) + new_state[-1], 0]
+        inf_rate = states[from_present, no_compartments*i] * \
+            infs[from_present, :].dot(r_home[i, :])
+        inf_to = moved_states(
+            states,
+            from_present,
+            no_compartments*i + from_compartment,
+            no_compartments*i + to_compartment,
+            index_vector,
+            reverse_prod)
 
         Q_int += sparse(
             (inf_rate, (from_present, inf_to)),
@@ -259,16 +245,14 @@ def progression_events(from_compartment,
     for i in range(len(class_idx)):
         from_present = where(states[:, no_compartments*i+from_compartment] > 0)[0]
 
-        prog_to = zeros(len(from_present), dtype=my_int)
-        prog_rate = zeros(len(from_present))
-        for k in range(len(from_present)):
-            old_state = copy(states[from_present[k], :])
-            prog_rate[k] = pc_rate * old_state[no_compartments*i+from_compartment]
-            new_state = copy(old_state)
-            new_state[no_compartments*i+from_compartment] -= 1
-            new_state[no_compartments*i+to_compartment] += 1
-            prog_to[k] = index_vector[
-                new_state.dot(reverse_prod) + new_state[-1], 0]
+        prog_rate = pc_rate * states[from_present, no_compartments*i+from_compartment]
+        prog_to = moved_states(
+            states,
+            from_present,
+            no_compartments*i + from_compartment,
+            no_compartments*i + to_compartment,
+            index_vector,
+            reverse_prod)
 
         Q_int += sparse(
             (prog_rate, (from_present, prog_to)),
@@ -294,16 +278,14 @@ def stratified_progression_events(from_compartment,
     for i in range(len(class_idx)):
         from_present = where(states[:, no_compartments*i+from_compartment] > 0)[0]
 
-        prog_to = zeros(len(from_present), dtype=my_int)
-        prog_rate = zeros(len(from_present))
-        for k in range(len(from_present)):
-            old_state = copy(states[from_present[k], :])
-            prog_rate[k] = pc_rate_by_class[i] * old_state[no_compartments*i+from_compartment]
-            new_state = copy(old_state)
-            new_state[no_compartments*i+from_compartment] -= 1
-            new_state[no_compartments*i+to_compartment] += 1
-            prog_to[k] = index_vector[
-                new_state.dot(reverse_prod) + new_state[-1], 0]
+        prog_rate = pc_rate_by_class[i] * states[from_present, no_compartments*i+from_compartment]
+        prog_to = moved_states(
+            states,
+            from_present,
+            no_compartments*i + from_compartment,
+            no_compartments*i + to_compartment,
+            index_vector,
+            reverse_prod)
         Q_int += sparse(
             (prog_rate, (from_present, prog_to)),
             shape=matrix_shape)
@@ -473,7 +455,7 @@ def _seir_subsystem(self, household_spec):
     inf_event_class = array([], dtype=my_int)
 
     Q_int, inf_event_row, inf_event_col, inf_event_class = inf_events(s_comp,
-                i_comp,
+                e_comp,
                 [i_comp],
                 [1],
                 r_home,
@@ -491,7 +473,7 @@ def _seir_subsystem(self, household_spec):
                 inf_event_class)
     Q_int = progression_events(e_comp,
                     i_comp,
-                    gamma,
+                    alpha,
                     no_compartments,
                     states,
                     index_vector,
@@ -934,13 +916,244 @@ def _sedur_subsystem(self, household_spec):
         index_vector))
 
 
+def _semcrd_ch_subsystem(self, household_spec):
+    '''This function processes a composition to create subsystems i.e.
+    matrices and vectors describing all possible epdiemiological states
+    for a given household composition
+    Assuming frequency-dependent homogeneous within-household mixing
+    composition[i] is the number of individuals in age-class i inside the
+    household'''
+
+    no_compartments = household_spec.no_compartments
+
+    s_comp, e_comp, m_comp, c_comp, r_comp, d_comp = range(no_compartments)
+
+    composition = household_spec.composition
+    matrix_shape = household_spec.matrix_shape
+    sus = self.model_input.sus
+    K_home = self.model_input.k_home
+    inf_scales = copy(self.model_input.inf_scales)
+    alpha = self.model_input.alpha
+    crit_prob = self.model_input.crit_prob
+    gamma = self.model_input.gamma
+    covid_mortality_prob = self.model_input.covid_mortality_prob
+    baseline_exit_rate = self.model_input.baseline_exit_rate
+    density_expo = self.model_input.density_expo
+
+    # Set of individuals actually present here
+    class_idx = household_spec.class_indexes
+
+    K_home = K_home[ix_(class_idx, class_idx)]
+    sus = sus[class_idx]
+    r_home = atleast_2d(diag(sus).dot(K_home))
+    crit_prob = crit_prob[class_idx]
+    for i in range(len(inf_scales)):
+        inf_scales[i] = inf_scales[i][class_idx]
+    covid_mortality_prob = covid_mortality_prob[class_idx]
+    baseline_exit_rate = baseline_exit_rate[class_idx]
+
+    states, \
+        reverse_prod, \
+        index_vector, \
+        rows = build_state_matrix(household_spec)
+
+    Q_int = sparse(household_spec.matrix_shape,)
+    inf_event_row = array([], dtype=my_int)
+    inf_event_col = array([], dtype=my_int)
+    inf_event_class = array([], dtype=my_int)
+
+    Q_int, inf_event_row, inf_event_col, inf_event_class = inf_events(s_comp,
+                e_comp,
+                [m_comp, c_comp],
+                inf_scales,
+                r_home,
+                density_expo,
+                no_compartments,
+                composition,
+                states,
+                index_vector,
+                reverse_prod,
+                class_idx,
+                matrix_shape,
+                Q_int,
+                inf_event_row,
+                inf_event_col,
+                inf_event_class)
+    Q_int = stratified_progression_events(e_comp,
+                    m_comp,
+                    alpha*(1-crit_prob),
+                    no_compartments,
+                    states,
+                    index_vector,
+                    reverse_prod,
+                    class_idx,
+                    matrix_shape,
+                    Q_int)
+    Q_int = stratified_progression_events(e_comp,
+                    c_comp,
+                    alpha*crit_prob,
+                    no_compartments,
+                    states,
+                    index_vector,
+                    reverse_prod,
+                    class_idx,
+                    matrix_shape,
+                    Q_int)
+    Q_int = progression_events(m_comp,
+                    r_comp,
+                    gamma,
+                    no_compartments,
+                    states,
+                    index_vector,
+                    reverse_prod,
+                    class_idx,
+                    matrix_shape,
+                    Q_int)
+    Q_int = stratified_progression_events(c_comp,
+                    r_comp,
+                    gamma*(1-covid_mortality_prob),
+                    no_compartments,
+                    states,
+                    index_vector,
+                    reverse_prod,
+                    class_idx,
+                    matrix_shape,
+                    Q_int)
+    Q_int = stratified_progression_events(c_comp,
+                    d_comp,
+                    gamma*covid_mortality_prob,
+                    no_compartments,
+                    states,
+                    index_vector,
+                    reverse_prod,
+                    class_idx,
+                    matrix_shape,
+                    Q_int)
+
+    # '''Now do the non-disease related exit (to D) events - we can just cycle
+    # over the numerical index of the compartments since all compartments progress
+    # identically. This cycle only goes to range 5 since we assume no D->D
+    # events.'''
+    # for i in range(5):
+    #     Q_int = stratified_progression_events(i,
+    #                     d_comp,
+    #                     baseline_exit_rate,
+    #                     6,
+    #                     states,
+    #                     index_vector,
+    #                     reverse_prod,
+    #                     class_idx,
+    #                     matrix_shape,
+    #                     Q_int)
+    #
+    # Q_int = stratified_progression_events(d_comp,
+    #                 s_comp,
+    #                 baseline_exit_rate,
+    #                 6,
+    #                 states,
+    #                 index_vector,
+    #                 reverse_prod,
+    #                 class_idx,
+    #                 matrix_shape,
+    #                 Q_int)
+
+    S = Q_int.sum(axis=1).getA().squeeze()
+    Q_int += sparse((
+        -S, (
+            arange(household_spec.total_size),
+            arange(household_spec.total_size)
+        )))
+    return tuple((
+        Q_int,
+        states,
+        array(inf_event_row, dtype=my_int, ndmin=1),
+        array(inf_event_col, dtype=my_int, ndmin=1),
+        array(inf_event_class, dtype=my_int, ndmin=1),
+        reverse_prod,
+        index_vector))
+
+
 ''' Entries in the subsystem key are in the following order: 1, list of cont
 '''
 
+def single_class_subsystem(self, household_spec):
+    '''Builds the same subsystem as subsystem_key would for a household with
+    a single class, for the structures in single_class_key. With one class
+    the states are just the configurations of the household size, in order
+    of their codes, so states reached by each event are found by searching
+    the codes directly and Q_int is assembled in one go.'''
+    infection, inf_compartment_list, progressions, scaled = \
+        single_class_key[self.compartmental_structure]
+    model_input = self.model_input
+    class_size = household_spec.composition[household_spec.class_indexes[0]]
+    class_idx = household_spec.class_indexes
+    r_home = model_input.sus[class_idx[0]] * \
+        model_input.k_home[class_idx[0], class_idx[0]]
+    if scaled:
+        inf_scales = [scale[class_idx[0]] for scale in model_input.inf_scales]
+    else:
+        inf_scales = ones(len(inf_compartment_list))
+
+    states, reverse_prod, index_vector, codes = \
+        build_state_matrix(household_spec)
+
+    infs = zeros(len(states))
+    for ic, inf_comp in enumerate(inf_compartment_list):
+        infs += (states[:, inf_comp] /
+                 (class_size**model_input.density_expo)) * inf_scales[ic]
+
+    def moved(from_present, from_compartment, to_compartment):
+        new_states = states[from_present, :]
+        new_states[:, from_compartment] -= 1
+        new_states[:, to_compartment] += 1
+        return searchsorted(
+            codes, new_states.dot(reverse_prod) + new_states[:, -1])
+
+    from_compartment, to_compartment = infection
+    inf_event_row = where(states[:, from_compartment] > 0)[0]
+    inf_event_col = moved(inf_event_row, from_compartment, to_compartment)
+    rows = [inf_event_row]
+    cols = [inf_event_col]
+    rates = [states[inf_event_row, 0] * (infs[inf_event_row] * r_home)]
+    for from_compartment, to_compartment, rate_name in progressions:
+        from_present = where(states[:, from_compartment] > 0)[0]
+        rows.append(from_present)
+        cols.append(moved(from_present, from_compartment, to_compartment))
+        rates.append(
+            getattr(model_input, rate_name)
+            * states[from_present, from_compartment])
+    rows = concatenate(rows)
+    rates = concatenate(rates)
+    diagonal = arange(household_spec.total_size)
+    Q_int = sparse((
+        concatenate((rates, -bincount(rows, rates, len(states)))),
+        (concatenate((rows, diagonal)), concatenate(cols + [diagonal]))),
+        shape=household_spec.matrix_shape)
+    return tuple((
+        Q_int,
+        states,
+        inf_event_row,
+        inf_event_col,
+        zeros(len(inf_event_row), dtype=my_int) + class_idx[0],
+        reverse_prod,
+        index_vector))
+
 subsystem_key = {
 'SIR' : [_sir_subsystem, 3, [1]],
 'SEIR' : [_seir_subsystem, 4, [2]],
 'SEPIR' : [_sepir_subsystem,5, [2,3]],
 'SEPIRQ' : [_sepirq_subsystem,6, [2,3,5]],
 'SEDUR' : [_sedur_subsystem,5, [2,3]],
+'carehome_SEMCRD' : [_semcrd_ch_subsystem,6, [2,3]],
+}
+
+# Single class versions of the structures above whose households only have
+# infection and progression events: the compartments infection moves
+# individuals between, the infectious compartments, each progression as its
+# compartments and rate, and whether infectivity is scaled by inf_scales
+single_class_key = {
+'SIR' : [(0, 1), [1], [(1, 2, 'gamma')], False],
+'SEIR' : [(0, 1), [2], [(1, 2, 'alpha'), (2, 3, 'gamma')], False],
+'SEPIR' : [(0, 1), [2, 3],
+    [(1, 2, 'alpha_1'), (2, 3, 'alpha_2'), (3, 4, 'gamma')], True],
 }
@@ -1,11 +1,28 @@
 '''In this module we should place simple tests for the models.'''
-from numpy import arange, array, ones, where, zeros
+from os import utime
+from os.path import getmtime
+from shutil import copy
+from types import SimpleNamespace
+from numpy import arange, array, concatenate, diag, ones, where, zeros
 from numpy.linalg import norm
+from numpy.random import default_rng
+from scipy.integrate import solve_ivp
+from scipy.interpolate import interp1d
+from scipy.sparse import block_diag
 from numpy.testing import assert_almost_equal
-from pandas import read_csv
-from model.imports import NoImportModel
-from model.preprocessing import aggregate_vector_quantities, det_from_spec, make_aggregator, HouseholdPopulation, ModelInput
-from model.common import SEDURRateEquations, sparse
+from pandas import read_csv, read_excel
+from pytest import raises
+from model.imports import FixedImportModel, NoImportModel, StepImportModel
+from model.preprocessing import aggregate_vector_quantities, det_from_spec, make_aggregator, CombinedHouseholdPopulation, HouseholdPopulation, LumpedHouseholdPopulation, exchangeable_classes, HouseholdSubsystemSpec, ModelInput, SEIRInput, SEPIRInput, SEPIRQInput, add_vuln_class, convert_contact_matrices_to_npz, get_equilibrium_distribution, read_contact_matrix, stationary_block_distribution
+from model import preprocessing
+from model.specs import (
+    SINGLE_AGE_SEIR_SPEC, SINGLE_AGE_UK_SPEC, TWO_AGE_INT_SEPIRQ_SPEC,
+    TWO_AGE_SEPIR_SPEC, TWO_AGE_UK_SPEC)
+from model.projection import AdaptiveProjectionSolver
+from model.stochastic import HouseholdSimulator
+from model.subsystems import build_state_matrix, state_index, subsystem_key
+from model.common import (
+    SEDURRateEquations, SEPIRRateEquations, SensitivityEquations, sparse)
 
 TEST_SPEC = {
     # Interpretable parameters:
@@ -118,3 +135,441 @@ def test_simple():
     assert_almost_equal(7.776182090170313e-05, norm(dH))
     assert_almost_equal(2.7801365751414517e-05, max(dH))
     assert_almost_equal(-3.270492048199998e-05, min(dH))
+
+def random_generator(size, rng):
+    '''Returns a dense generator matrix with positive off-diagonal rates'''
+    Q = rng.random((size, size))
+    return Q - diag(Q.sum(axis=1))
+
+def test_equilibrium_distribution():
+    '''Check the sparse equilibrium solver balances each composition block'''
+    rng = default_rng(0)
+    blocks = [random_generator(n, rng) for n in [1, 4, 7]]
+    population = SimpleNamespace(
+        Q_int=block_diag(blocks, format='csc'),
+        offsets=array([0, 1, 5, 12]),
+        composition_distribution=array([0.2, 0.3, 0.5]))
+    H = get_equilibrium_distribution(population)
+    assert_almost_equal(0.0, norm(population.Q_int.T.dot(H)))
+    assert_almost_equal(H[0], 0.2)
+    assert_almost_equal(H[1:5].sum(), 0.3)
+    assert_almost_equal(H[5:].sum(), 0.5)
+
+def test_reducible_equilibrium():
+    '''Check reducible chains settle on the closed class they start into'''
+    # State 0 leaks into the closed class {1, 2} and state 3 is absorbing
+    Q = array([
+        [-1.0, 1.0, 0.0, 0.0],
+        [0.0, -2.0, 2.0, 0.0],
+        [0.0, 1.0, -1.0, 0.0],
+        [0.0, 0.0, 0.0, 0.0]])
+    assert_almost_equal(
+        stationary_block_distribution(Q, 0), [0, 1/3, 2/3, 0])
+    assert_almost_equal(stationary_block_distribution(Q, 3), [0, 0, 0, 1])
+    with raises(ValueError):
+        stationary_block_distribution(Q)
+    Q[0, :] = [-2.0, 1.0, 0.0, 1.0]
+    with raises(ValueError):
+        stationary_block_distribution(Q, 0)
+
+    # Without infection nothing happens to fully susceptible households
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0]])
+    composition_distribution = array([0.6, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    H = get_equilibrium_distribution(population)
+    fully_sus = where(
+        population.states[:, ::5].sum(axis=1)
+        == population.states.sum(axis=1))[0]
+    assert_almost_equal(H[fully_sus], composition_distribution)
+
+def test_contact_matrix_store(tmp_path):
+    '''Check the npz store matches its spreadsheet and follows its changes'''
+    file_name = str(tmp_path / 'MUestimates_home_2.xlsx')
+    copy('inputs/MUestimates_home_2.xlsx', file_name)
+    store_name = convert_contact_matrices_to_npz(file_name)
+    sheet_name = 'United Kingdom of Great Britain'
+    from_store = read_contact_matrix(file_name, sheet_name)
+    assert_almost_equal(
+        from_store,
+        read_excel(file_name, sheet_name=sheet_name, header=None).to_numpy())
+
+    # A spreadsheet newer than the store gets its store rebuilt
+    preprocessing._RAW_CONTACT_MATRIX_CACHE.clear()
+    utime(store_name, (0, 0))
+    assert_almost_equal(read_contact_matrix(file_name, sheet_name), from_store)
+    assert getmtime(store_name) >= getmtime(file_name)
+
+    # Reading with a header row uses its own store and leaves this one alone
+    utime(store_name, (1e9, 1e9))
+    header_store_name = convert_contact_matrices_to_npz(file_name, 0)
+    assert header_store_name != store_name
+    assert_almost_equal(
+        read_contact_matrix(file_name, sheet_name, 0),
+        read_excel(file_name, sheet_name=sheet_name, header=0).to_numpy())
+    assert getmtime(store_name) == 1e9
+
+def test_with_updates():
+    '''Check variants match inputs built from scratch and share storage'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+
+    variant = model_input.with_updates(AR=0.3)
+    direct = SEPIRInput(
+        {**spec, 'AR': 0.3}, composition_list, composition_distribution)
+    assert_almost_equal(variant.k_home, direct.k_home)
+    assert_almost_equal(variant.k_ext, direct.k_ext)
+    assert model_input.spec['AR'] == spec['AR']
+
+    intervention = model_input.with_updates(
+        rescale=False, sus=0.5 * model_input.sus)
+    assert_almost_equal(intervention.k_home, model_input.k_home)
+    assert_almost_equal(intervention.sus, 0.5 * model_input.sus)
+    assert not intervention.k_home.flags.writeable
+
+def test_with_updates_derived_attributes():
+    '''Check overrides reach the attributes derived from them'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+
+    scaling = array([0.2, 0.8])
+    variant = model_input.with_updates(prodromal_trans_scaling=scaling)
+    direct = SEPIRInput(
+        {**spec, 'prodromal_trans_scaling': scaling},
+        composition_list,
+        composition_distribution)
+    assert_almost_equal(variant.inf_scales[0], scaling)
+    assert_almost_equal(variant.k_home, direct.k_home)
+    assert_almost_equal(variant.k_ext, direct.k_ext)
+    assert_almost_equal(model_input.inf_scales[0], spec['prodromal_trans_scaling'])
+    with raises(ValueError):
+        model_input.with_updates(
+            prodromal_trans_scaling=scaling, inf_scales=direct.inf_scales)
+
+    quarantine_spec = {
+        **TWO_AGE_INT_SEPIRQ_SPEC, **TWO_AGE_UK_SPEC, 'adult_bd': 1}
+    quarantine_input = SEPIRQInput(
+        quarantine_spec, composition_list, composition_distribution)
+    quarantine_variant = quarantine_input.with_updates(
+        exp_iso_rate=array([0.5, 0.25]))
+    assert_almost_equal(quarantine_variant.iso_rates[1], [0.5, 0.25])
+    assert_almost_equal(
+        quarantine_input.iso_rates[1], quarantine_spec['exp_iso_rate'])
+
+    expanded = add_vuln_class(model_input, 0.1)
+    assert expanded.unscaled_k_home.shape == (3, 3)
+    assert expanded.unscaled_k_ext.shape == (3, 3)
+    rescaled = expanded.with_updates(AR=spec['AR'])
+    assert rescaled.k_home.shape == (3, 3)
+    assert rescaled.k_ext.shape == (3, 3)
+    with raises(ValueError):
+        expanded.with_updates(prodromal_trans_scaling=scaling)
+def test_step_import_model():
+    '''Check step imports agree with nearest neighbour interpolation'''
+    rng = default_rng(0)
+    time = arange(7.0, 100.0, 7.0)
+    import_rates = rng.random((2, len(time)))
+    import_model = StepImportModel(1, 2, time, import_rates)
+    reference = interp1d(
+        time, import_rates,
+        kind='nearest',
+        bounds_error=False,
+        fill_value='extrapolate',
+        assume_sorted=True)
+    t = concatenate((rng.uniform(0.0, 110.0, 50), time, [10.5, 3.5]))
+    assert_almost_equal(import_model.cases(t), reference(t))
+    for s in sorted(t):
+        assert_almost_equal(import_model.cases(s), reference(s))
+
+def test_with_distribution():
+    '''Check redistributed populations share their within-household system'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+
+    new_distribution = array([0.5, 0.1, 0.4])
+    view = population.with_distribution(new_distribution)
+    rebuilt = HouseholdPopulation(
+        composition_list, new_distribution, model_input, False)
+    assert view.Q_int is population.Q_int
+    assert norm((view.Q_int - rebuilt.Q_int).toarray()) == 0
+    assert_almost_equal(view.composition_distribution, new_distribution)
+    assert_almost_equal(view.ave_hh_size, new_distribution.dot([2, 2, 3]))
+    assert_almost_equal(
+        population.composition_distribution, composition_distribution)
+
+def test_sensitivity_equations():
+    '''Check augmented sensitivities against central finite differences'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    import_model = FixedImportModel(6, 2, array([1e-3, 1e-3]))
+
+    def final_recovereds(model_input, parameters=None):
+        population = HouseholdPopulation(
+            composition_list, composition_distribution, model_input, False)
+        rhs = SEPIRRateEquations(model_input, population, import_model)
+        H0 = zeros(len(population.which_composition))
+        fully_sus = where(
+            population.states[:, ::5].sum(axis=1)
+            == population.states.sum(axis=1))[0]
+        H0[fully_sus] = composition_distribution
+        R = population.states[:, 4::5].sum(axis=1)
+        if parameters is None:
+            H = solve_ivp(rhs, (0, 30), H0, rtol=1e-10, atol=1e-14).y
+            return R.dot(H[:, -1])
+        sensitivities = SensitivityEquations(rhs, parameters)
+        y = solve_ivp(
+            sensitivities,
+            (0, 30),
+            sensitivities.initial_condition(H0),
+            rtol=1e-10,
+            atol=1e-14).y
+        return sensitivities.outcome_sensitivities(y[:, -1], R)[1]
+
+    derivatives = final_recovereds(
+        model_input, ['k_home', 'k_ext', ('sus', 1), ('rate', 3, 4)])
+    h = 1e-4
+    for k, scale in enumerate([
+            lambda x: model_input.with_updates(k_home=x * model_input.k_home),
+            lambda x: model_input.with_updates(k_ext=x * model_input.k_ext),
+            lambda x: model_input.with_updates(
+                rescale=False, sus=array([1, x]) * model_input.sus),
+            lambda x: model_input.with_updates(
+                rescale=False, recovery_rate=x * spec['recovery_rate'])]):
+        difference = (
+            final_recovereds(scale(1 + h))
+            - final_recovereds(scale(1 - h))) / (2 * h)
+        assert_almost_equal(derivatives[k] / difference, 1.0, decimal=5)
+
+def test_state_matrix():
+    '''Check every household state appears once and can be looked up'''
+    household_spec = HouseholdSubsystemSpec(array([3, 0, 2]), 6)
+    states, reverse_prod, index_vector, _ = build_state_matrix(household_spec)
+    assert states.shape == (56 * 21, 12)
+    assert (states[:, :6].sum(axis=1) == 3).all()
+    assert (states[:, 6:].sum(axis=1) == 2).all()
+    assert len(set(map(tuple, states))) == len(states)
+    assert (
+        state_index(states, index_vector, reverse_prod)
+        == arange(len(states))).all()
+
+def test_combined_population():
+    '''Check combined populations leave their members unchanged'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0]])
+    composition_distribution = array([0.6, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    unvaccinated = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    vaccinated = HouseholdPopulation(
+        composition_list,
+        composition_distribution,
+        model_input.with_updates(rescale=False, sus=0.5 * model_input.sus),
+        False)
+    no_states = len(unvaccinated.which_composition)
+
+    combined = CombinedHouseholdPopulation(
+        [unvaccinated, vaccinated], [0.3, 0.7])
+    assert norm((combined.Q_int - block_diag(
+        (unvaccinated.Q_int, vaccinated.Q_int))).toarray()) == 0
+    assert_almost_equal(
+        combined.composition_distribution, [0.18, 0.12, 0.42, 0.28])
+    assert (combined.inf_event_row[len(unvaccinated.inf_event_row):]
+        == vaccinated.inf_event_row + no_states).all()
+    assert (combined.which_composition[no_states:]
+        == vaccinated.which_composition + 2).all()
+    assert_almost_equal(combined.offsets[-1], 2 * no_states)
+    assert len(unvaccinated.which_composition) == no_states
+    assert_almost_equal(
+        unvaccinated.composition_distribution, composition_distribution)
+
+    reweighted = combined.with_weightings([0.5, 0.5])
+    assert reweighted.Q_int is combined.Q_int
+    assert_almost_equal(reweighted.ave_hh_size, 2.0)
+
+def test_household_simulator():
+    '''Check simulated households follow the master equation on average'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    import_model = FixedImportModel(6, 2, array([1e-2, 2e-2]))
+    # Households are independent when there is no transmission between them
+    rhs = SEPIRRateEquations(model_input, population, import_model, 0.0)
+    fully_sus = where(
+        population.states[:, ::5].sum(axis=1)
+        == population.states.sum(axis=1))[0]
+    H0 = zeros(len(population.which_composition))
+    H0[fully_sus] = composition_distribution
+    t_out = arange(0.0, 31.0, 10.0)
+    H = solve_ivp(
+        rhs, (0, 30), H0, t_eval=t_out, rtol=1e-9, atol=1e-12).y.T
+
+    simulator = HouseholdSimulator(population, import_model)
+    statistics = simulator.summary_statistics(H0, t_out, 20000, rng=0)
+    assert abs(statistics['distribution'] - H).max() < 0.02
+    assert abs(statistics['mean'] - H.dot(population.states)).max() < 0.02
+
+def test_projection_solver():
+    '''Check the projection error bound holds for independent households'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    import_model = FixedImportModel(6, 2, array([1e-3, 2e-3]))
+    rhs = SEPIRRateEquations(model_input, population, import_model, 0.0)
+    fully_sus = where(
+        population.states[:, ::5].sum(axis=1)
+        == population.states.sum(axis=1))[0]
+    H0 = zeros(len(population.which_composition))
+    H0[fully_sus] = composition_distribution
+    t_out = arange(0.0, 31.0, 10.0)
+    H = solve_ivp(
+        rhs, (0, 30), H0, t_eval=t_out, rtol=1e-9, atol=1e-12).y
+
+    solver = AdaptiveProjectionSolver(rhs, tol=1e-4, drop_tol=1e-8)
+    solution = solver.solve((0, 30), H0, t_out, rtol=1e-9, atol=1e-12)
+    assert solution.active_size[0] == len(fully_sus)
+    assert solution.error_bound[-1] <= 1e-4
+    assert (abs(solution.y - H).sum(axis=0)
+        <= solution.error_bound + 1e-7).all()
+
+def test_projection_restriction():
+    '''Check extended and rebuilt restrictions match fresh ones'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    import_model = FixedImportModel(6, 2, array([1e-3, 2e-3]))
+    rhs = SEPIRRateEquations(model_input, population, import_model, 0.5)
+    active = where(
+        population.states[:, ::5].sum(axis=1)
+        == population.states.sum(axis=1))[0]
+    solver = AdaptiveProjectionSolver(rhs)
+    solver._restrict(active)
+    rng = default_rng(0)
+    for _ in range(3):
+        # Extend by the successors, then prune every other state
+        active = concatenate((active, solver.successors(active)))
+        for active in [active, active[::2]]:
+            z = rng.random(len(active) + 1)
+            fresh = AdaptiveProjectionSolver(rhs)._restrict(active)
+            assert_almost_equal(solver._restrict(active)(0.0, z), fresh(0.0, z))
+
+def test_lumped_population():
+    '''Check lumping exchangeable classes and lifting back is exact'''
+    spec = {**TWO_AGE_SEPIR_SPEC, **TWO_AGE_UK_SPEC}
+    composition_list = array([[1, 1], [2, 0], [1, 2]])
+    composition_distribution = array([0.3, 0.3, 0.4])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    assert exchangeable_classes(population) == [[0], [1]]
+
+    model_input = model_input.with_updates(
+        rescale=False,
+        density_expo=0.0,
+        k_home=0.3 * ones((2, 2)),
+        k_ext=array([[0.1, 0.2], [0.1, 0.2]]))
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    lumped = LumpedHouseholdPopulation(population)
+    assert lumped.groups == [[0, 1]]
+    assert len(lumped.which_composition) < len(population.which_composition)
+
+    import_model = FixedImportModel(6, 2, array([1e-3, 1e-3]))
+    fully_sus = where(
+        population.states[:, ::5].sum(axis=1)
+        == population.states.sum(axis=1))[0]
+    H0 = zeros(len(population.which_composition))
+    H0[fully_sus] = composition_distribution
+    t_out = arange(0.0, 31.0, 10.0)
+    H = solve_ivp(
+        SEPIRRateEquations(model_input, population, import_model),
+        (0, 30), H0, t_eval=t_out, rtol=1e-9, atol=1e-12).y
+    lumped_H = solve_ivp(
+        SEPIRRateEquations(model_input, lumped, import_model),
+        (0, 30), lumped.lump(H0), t_eval=t_out, rtol=1e-9, atol=1e-12).y
+    assert_almost_equal(lumped.lift(lumped_H), H, decimal=8)
+    assert_almost_equal(
+        lumped.states.T.dot(lumped_H), population.states.T.dot(H), decimal=8)
+
+def test_single_class_population():
+    '''Check single class households match the general subsystem'''
+    spec = {
+        **TWO_AGE_SEPIR_SPEC,
+        **SINGLE_AGE_UK_SPEC,
+        'sus': array([1]),
+        'prodromal_trans_scaling': array([0.5])}
+    composition_list = array([[1], [3], [4], [3]])
+    composition_distribution = array([0.2, 0.3, 0.3, 0.2])
+    model_input = SEPIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    Q_int = population.Q_int.tocsr()
+    for i, composition in enumerate(composition_list):
+        part = subsystem_key['SEPIR'][0](
+            population, HouseholdSubsystemSpec(composition, 5))
+        block = slice(population.offsets[i], population.offsets[i+1])
+        assert norm((Q_int[block, block] - part[0]).toarray()) < 1e-12
+        assert (population.states[block] == part[1]).all()
+        events = (population.inf_event_row >= population.offsets[i]) \
+            & (population.inf_event_row < population.offsets[i+1])
+        assert (population.inf_event_col[events]
+            == part[3] + population.offsets[i]).all()
+    # Equal sizes share their block but not their index vector
+    assert population.index_vector[3].data[0] == population.offsets[3]
+    assert population.index_vector[1].data[0] == population.offsets[1]
+
+def test_single_class_seir():
+    '''Check SEIR households match the general subsystem, infect into E and
+    progress E to I to R'''
+    spec = {**SINGLE_AGE_SEIR_SPEC, **SINGLE_AGE_UK_SPEC}
+    composition_list = array([[1], [2], [2]])
+    composition_distribution = array([0.4, 0.3, 0.3])
+    model_input = SEIRInput(spec, composition_list, composition_distribution)
+    population = HouseholdPopulation(
+        composition_list, composition_distribution, model_input, False)
+    Q_int = population.Q_int.tocsr()
+    for i, composition in enumerate(composition_list):
+        part = subsystem_key['SEIR'][0](
+            population, HouseholdSubsystemSpec(composition, 4))
+        block = slice(population.offsets[i], population.offsets[i+1])
+        assert norm((Q_int[block, block] - part[0]).toarray()) < 1e-12
+        assert (population.states[block] == part[1]).all()
+        events = (population.inf_event_row >= population.offsets[i]) \
+            & (population.inf_event_row < population.offsets[i+1])
+        assert (population.inf_event_col[events]
+            == part[3] + population.offsets[i]).all()
+
+    def rate(from_state, to_state):
+        return Q_int[
+            population.states.tolist().index(from_state),
+            population.states.tolist().index(to_state)]
+    assert_almost_equal(
+        rate([0, 1, 0, 0], [0, 0, 1, 0]), spec['incubation_rate'])
+    assert_almost_equal(rate([0, 0, 1, 0], [0, 0, 0, 1]), spec['recovery_rate'])
+    assert_almost_equal(
+        rate([1, 0, 1, 0], [0, 1, 1, 0]),
+        model_input.k_home[0, 0] / 2**spec['density_expo'])
+    assert rate([1, 0, 1, 0], [0, 0, 2, 0]) == 0
+    events = population.states[population.inf_event_col] \
+        - population.states[population.inf_event_row]
+    assert (events == [-1, 1, 0, 0]).all()